@@ -0,0 +1,187 @@
+"""Conversions driven by an asyncio event loop (see pdf.asgi).
+
+wkhtmltopdf_async() runs the same command as wkhtmltopdf() as an asyncio
+subprocess, so that a single process can wait for many conversions at once;
+AsyncConversionPool bounds them to ``PDF_ASYNC_MAX_CONCURRENT``, with the
+queue of the conversion pool (``PDF_POOL_QUEUE_SIZE`` waiting at most
+``PDF_POOL_QUEUE_TIMEOUT`` seconds).
+"""
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from pdf import metrics
+from pdf.pool import PoolBusy, _Waiter, next_waiter
+from pdf.wkhtmltopdf import OutputTooLarge, _command, _resource_limiter
+
+
+class AsyncConversionPool(object):
+    """Same as pdf.pool.ConversionPool for coroutines of one event loop."""
+
+    def __init__(self, max_concurrent, queue_size=None, queue_timeout=None):
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self._running_by_owner = {}
+        self._waiters = []
+        self._seq = 0
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _start(self, owner):
+        self.running += 1
+        self._running_by_owner[owner] = self._running_by_owner.get(owner, 0) + 1
+
+    async def acquire(self, timeout=None, owner=None, priority=0):
+        """Waits for a free slot, raises PoolBusy if none can be obtained."""
+        if timeout is None or (self.queue_timeout is not None and timeout > self.queue_timeout):
+            timeout = self.queue_timeout
+        if self.running < self.max_concurrent and not self._waiters:
+            self._start(owner)
+            return
+        if self.queue_size is not None and len(self._waiters) >= self.queue_size:
+            raise PoolBusy("conversion queue is full")
+        self._seq += 1
+        waiter = _Waiter(owner, priority, self._seq)
+        # Bound to the running loop
+        waiter.future = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                raise PoolBusy("timed out waiting for a conversion slot")
+        except asyncio.CancelledError:
+            if waiter.granted:
+                self.release(owner)
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, owner=None):
+        self.running -= 1
+        count = self._running_by_owner.get(owner, 0) - 1
+        if count > 0:
+            self._running_by_owner[owner] = count
+        else:
+            self._running_by_owner.pop(owner, None)
+        if self._waiters and self.running < self.max_concurrent:
+            waiter = next_waiter(self._waiters, self._running_by_owner)
+            self._waiters.remove(waiter)
+            waiter.granted = True
+            self._start(waiter.owner)
+            waiter.future.set_result(None)
+
+
+_pool = None
+
+
+def get_async_pool():
+    """Returns the process-wide asynchronous conversion pool, built from settings."""
+    global _pool
+    metrics.start_flusher()
+    if _pool is None:
+        _pool = AsyncConversionPool(
+            max_concurrent=getattr(settings, 'PDF_ASYNC_MAX_CONCURRENT', 8),
+            queue_size=getattr(settings, 'PDF_POOL_QUEUE_SIZE', 10),
+            queue_timeout=getattr(settings, 'PDF_POOL_QUEUE_TIMEOUT', 30),
+        )
+    return _pool
+
+
+@receiver(setting_changed)
+def _reset_pool(setting, **kwargs):
+    global _pool
+    if setting.startswith('PDF_ASYNC_') or setting.startswith('PDF_POOL_'):
+        _pool = None
+
+
+async def _feed(stdin, input):
+    try:
+        stdin.write(input)
+        await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # wkhtmltopdf exited early, its return code tells why
+        pass
+    finally:
+        stdin.close()
+
+
+async def _read_output(process, args, max_output_size, chunk_size=64 * 1024):
+    chunks = []
+    size = 0
+    while True:
+        chunk = await process.stdout.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_output_size is not None and size > max_output_size:
+            raise OutputTooLarge(args, max_output_size)
+        chunks.append(chunk)
+    await process.wait()
+    return b''.join(chunks)
+
+
+def _kill(process):
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+async def wkhtmltopdf_async(pages, input=None, timeout=None, max_output_size=None, **kwargs):
+    """Coroutine version of pdf.wkhtmltopdf.wkhtmltopdf(), ``input`` being
+    bytes written to wkhtmltopdf's standard input."""
+    if timeout is None:
+        timeout = getattr(settings, 'WKHTMLTOPDF_TIMEOUT', None)
+    if max_output_size is None:
+        max_output_size = getattr(settings, 'WKHTMLTOPDF_MAX_OUTPUT_SIZE', None)
+
+    args, env = _command(pages, **kwargs)
+    stderr = tempfile.TemporaryFile()
+    logging.debug("CMDLINE: %s", str(args))
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args, env=env, stdout=subprocess.PIPE, stderr=stderr,
+            stdin=subprocess.PIPE if input is not None else None, start_new_session=True)
+        limiter = _resource_limiter(max_output_size=max_output_size)
+        if limiter is not None:
+            limiter(process.pid)
+    except:
+        stderr.close()
+        raise
+
+    feeder = None
+    try:
+        if input is not None:
+            feeder = asyncio.ensure_future(_feed(process.stdin, input))
+        try:
+            output = await asyncio.wait_for(_read_output(process, args, max_output_size), timeout)
+        except asyncio.TimeoutError:
+            _kill(process)
+            await process.wait()
+            stderr.seek(0)
+            raise subprocess.TimeoutExpired(args, timeout, output=b'', stderr=stderr.read())
+        if process.returncode:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(process.returncode, args, output=b'', stderr=stderr.read())
+        return output
+    finally:
+        if feeder is not None and not feeder.done():
+            feeder.cancel()
+        if process.returncode is None:
+            _kill(process)
+            await process.wait()
+        stderr.close()
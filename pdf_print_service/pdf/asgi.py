@@ -0,0 +1,303 @@
+"""ASGI application (see pdf_print_service/asgi.py).
+
+Conversions posted to /pdf are handled by AsyncMakePDFView in the event
+loop, so that one process drives many renderers at once (see pdf.aio). The
+blocking parts of a request (authentication, template rendering, database
+and cache accesses) run in a pool of ``PDF_ASGI_THREADS`` threads, which
+also runs the Django WSGI application for every other request, and for
+conversions the event loop doesn't handle: streamed ones, other backends
+than wkhtmltopdf, and render workers (WKHTMLTOPDF_WARM_WORKERS).
+
+Unlike the WSGI path, conversions of the event loop are neither coalesced
+nor timed in Server-Timing.
+"""
+import asyncio
+import io
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import jinja2
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+
+from pdf import metrics
+from pdf.aio import get_async_pool, wkhtmltopdf_async
+from pdf.authentication import _authenticate_request
+from pdf.backends import BackendError, WkhtmltopdfBackend, get_backend
+from pdf.cache import get_cache
+from pdf.logs import log_request
+from pdf.payload import PayloadError, read_params
+from pdf.pool import PoolBusy, UnknownPriority
+from pdf.profiles import UnknownProfile, get_profile_options
+from pdf.ratelimit import CHECKED_KEY, rate_limit_response
+from pdf.views import CONVERSION_ERRORS, MakePDFViewFromHtml, check_numbers, resolve_template, response_outcome, \
+    service_unavailable
+from pdf.warm import get_warm_pool
+from pdf.wkhtmltopdf import PDFResponse
+
+PDF_PATH = re.compile(r'^/pdf/?$')
+
+
+def build_environ(scope, body):
+    """Returns the WSGI environ of the HTTP ``scope`` with ``body`` (bytes)."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    # The body has been read whole
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+class AsyncMakePDFView(MakePDFViewFromHtml):
+    """/pdf converting in the event loop."""
+
+    def __init__(self, executor, **kwargs):
+        super(AsyncMakePDFView, self).__init__(**kwargs)
+        self.executor = executor
+
+    def run_in_thread(self, func, *args):
+        """Runs ``func(*args)``, which may use the database, in the thread pool."""
+        def call():
+            try:
+                return func(*args)
+            finally:
+                close_old_connections()
+        return asyncio.get_event_loop().run_in_executor(self.executor, call)
+
+    def accepts(self, params):
+        """Tells whether the conversion described by ``params`` can run in the
+        event loop."""
+        if not isinstance(params, dict) or get_warm_pool() is not None:
+            return False
+        try:
+            get_profile_options(params.get('profile'))
+            return isinstance(get_backend(params.get('backend')), WkhtmltopdfBackend) \
+                and not self.use_stream(params)
+        except (BackendError, UnknownProfile):
+            return False
+
+    async def handle(self, request):
+        """Returns the response to ``request``, or None to leave it to the
+        WSGI application."""
+        # Unauthenticated and rate limited requests are answered before their
+        # body is decompressed and parsed
+        user = await self.run_in_thread(_authenticate_request, request)
+        if user is None:
+            response = HttpResponse(status=401)
+        else:
+            request.user = user
+            response = rate_limit_response(request)
+            if response is None:
+                try:
+                    # Decompression and parsing of large bodies would stall the loop
+                    params = await self.run_in_thread(read_params, request)
+                except PayloadError:
+                    # The WSGI application answers with the error
+                    return None
+                if not self.accepts(params):
+                    return None
+                response = await self.post_async(request, params)
+        metrics.inc('pdf_requests_total', view=self.metrics_name, outcome=response_outcome(response))
+        return response
+
+    async def post_async(self, request, params):
+        log_request(request, mode='url' if 'url' in params else 'template')
+        error = await self.run_in_thread(resolve_template, request, params)
+        if error is not None:
+            return error
+        error = check_numbers(params)
+        if error is not None:
+            return error
+        try:
+            self.set_scheduling(request.user.get_username(), params)
+        except UnknownPriority as ex:
+            return HttpResponseBadRequest(str(ex))
+        if 'url' in params:
+            pdf_filename = params.get('filename', 'document.pdf')
+            show_content_in_browser = None
+        else:
+            pdf_filename = 'expense-claim.pdf'
+            show_content_in_browser = False
+        try:
+            # Renders and writes the header and footer
+            cmd_options = await self.run_in_thread(self.get_cmd_options, params)
+        except jinja2.TemplateError as ex:
+            return HttpResponseBadRequest("Template error: %s" % ex)
+
+        pdf_content = None
+        etag = None
+        cache = get_cache() if params.get('cache', True) else None
+        if cache is not None:
+            key = await self.run_in_thread(self.get_cache_key, params, cmd_options)
+            etag = quote_etag(key)
+            pdf_content = await self.run_in_thread(cache.get, key)
+            if pdf_content is not None:
+                if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+                if key in if_none_match or '*' in if_none_match:
+                    response = HttpResponseNotModified()
+                    response['ETag'] = etag
+                    return response
+
+        if pdf_content is None:
+            try:
+                pdf_content = await self.render_pdf_async(params, cmd_options)
+            except PoolBusy as ex:
+                return service_unavailable("PDF service is busy: %s" % ex)
+            except CONVERSION_ERRORS as ex:
+                return self.conversion_error_response(ex, params.get('url'))
+            except jinja2.TemplateError as ex:
+                return HttpResponseBadRequest("Template error: %s" % ex)
+            if cache is not None:
+                await self.run_in_thread(cache.set, key, pdf_content, params.get('cache-ttl', None))
+
+        response = PDFResponse(pdf_content, show_content_in_browser=show_content_in_browser,
+                               filename=pdf_filename)
+        if etag is not None:
+            response['ETag'] = etag
+        return response
+
+    async def render_pdf_async(self, params, cmd_options):
+        """Returns the PDF document described by ``params``."""
+        if 'url' in params:
+            pages = [params['url']]
+            input = None
+        else:
+            content = await self.run_in_thread(self.render_jinja2, params)
+            pages = ['-']
+            input = content.encode('utf-8')
+
+        pool = get_async_pool()
+        await pool.acquire(timeout=params.get('queue-timeout', None), owner=self.owner, priority=self.priority)
+        try:
+            start = time.time()
+            pdf_content = await wkhtmltopdf_async(pages, input=input, timeout=self.get_timeout(params),
+                                                  **dict(self.cmd_options, **cmd_options))
+            metrics.observe('pdf_conversion_seconds', time.time() - start, backend='wkhtmltopdf')
+            metrics.observe('pdf_output_bytes', len(pdf_content))
+            return pdf_content
+        finally:
+            pool.release(self.owner)
+
+
+class ASGIApplication(object):
+    """ASGI 3 application serving /pdf conversions asynchronously and the
+    rest through ``wsgi_application``."""
+
+    def __init__(self, wsgi_application, threads=None):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(threads or getattr(settings, 'PDF_ASGI_THREADS', 10))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError("Unsupported scope type '%s'" % scope['type'])
+
+        body = []
+        size = 0
+        max_body_size = getattr(settings, 'PDF_MAX_BODY_SIZE', None)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            size += len(body[-1])
+            if max_body_size and size > max_body_size:
+                error = PayloadError("Request body is larger than %d bytes" % max_body_size, status=413)
+                return await self.send_response(error.response(), send)
+            if not message.get('more_body', False):
+                break
+        body = b''.join(body)
+
+        if scope['method'] == 'POST' and PDF_PATH.match(scope['path']):
+            view = AsyncMakePDFView(self.executor)
+            request = WSGIRequest(build_environ(scope, body))
+            response = await view.handle(request)
+            if response is not None:
+                return await self.send_response(response, send)
+            # The request has been counted by the rate limiter
+            environ = build_environ(scope, body)
+            environ[CHECKED_KEY] = request.META.get(CHECKED_KEY, False)
+            return await self.call_wsgi(environ, send)
+        await self.call_wsgi(build_environ(scope, body), send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def send_response(self, response, send):
+        headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in response.items()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': response.content})
+        response.close()
+
+    async def call_wsgi(self, environ, send):
+        """Runs the WSGI application in the thread pool, sending its response
+        as it is produced."""
+        loop = asyncio.get_event_loop()
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            response_start = {}
+
+            def start_response(status, headers, exc_info=None):
+                response_start.update(type='http.response.start', status=int(status.split(' ', 1)[0]),
+                                      headers=[(name.encode('latin-1'), value.encode('latin-1'))
+                                               for name, value in headers])
+
+            result = self.wsgi_application(environ, start_response)
+            try:
+                started = False
+                for chunk in result:
+                    if not started:
+                        send_from_thread(response_start)
+                        started = True
+                    if chunk:
+                        send_from_thread({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if not started:
+                    send_from_thread(response_start)
+                send_from_thread({'type': 'http.response.body', 'body': b''})
+            finally:
+                close = getattr(result, 'close', None)
+                if close is not None:
+                    close()
+
+        await loop.run_in_executor(self.executor, run)
@@ -0,0 +1,291 @@
+"""Local cache of the external assets of rendered templates.
+
+Images, stylesheets and fonts referenced by absolute http(s) URLs in a
+rendered template are downloaded once into ``PDF_ASSETS_DIR`` and the
+references rewritten to ``file://`` URLs, so wkhtmltopdf doesn't fetch them
+again for every document. The files are content-addressed (two URLs serving
+the same logo share one file); the URL index entries expire after
+``PDF_ASSETS_TTL`` seconds and the least recently used files are evicted
+once the cache holds more than ``PDF_ASSETS_MAX_BYTES``. Stylesheets are
+stored with their own url() references (fonts, backgrounds) rewritten.
+
+Assets that can't be downloaded are left to wkhtmltopdf, and not tried
+again for ``PDF_ASSETS_FAILURE_TTL`` seconds. The downloads of a document
+stop after ``PDF_ASSETS_FETCH_BUDGET`` seconds in total, the remaining assets
+being left to wkhtmltopdf too. The cache is
+opt-in through ``PDF_ASSETS_ENABLED`` and can be filled in advance with the
+``seed_pdf_assets`` management command.
+"""
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import time
+
+from urllib.parse import urljoin, urlparse
+from urllib.request import urlopen
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .wkhtmltopdf import pathname2fileurl
+
+log = logging.getLogger('pdf.assets')
+
+# References to external assets in HTML: src attributes, <link> hrefs and
+# CSS url() (links of <a> elements are left alone)
+HTML_ASSET_PATTERNS = [
+    re.compile(r'''(\bsrc\s*=\s*["'])(https?://[^"']+)(["'])''', re.IGNORECASE),
+    re.compile(r'''(<link\b[^>]*?\bhref\s*=\s*["'])(https?://[^"']+)(["'])''', re.IGNORECASE),
+    re.compile(r'''(url\(\s*["']?)(https?://[^"')\s]+)(["']?\s*\))''', re.IGNORECASE),
+]
+# Any url() of a stylesheet, relative ones included
+CSS_URL_PATTERN = re.compile(r'''(url\(\s*["']?)([^"')\s]+)(["']?\s*\))''', re.IGNORECASE)
+# Also rewrite what the stylesheets of stylesheets (@import) reference, up to this depth
+MAX_CSS_DEPTH = 2
+
+
+class AssetCache(object):
+    """Content-addressed directory of downloaded assets with a URL index."""
+
+    def __init__(self, directory, ttl=86400, max_bytes=None, fetch_timeout=10,
+                 max_asset_size=10 * 1024 * 1024, evict_interval=60, failure_ttl=60, fetch_budget=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.fetch_timeout = fetch_timeout
+        self.failure_ttl = failure_ttl
+        self.fetch_budget = fetch_budget
+        self.max_asset_size = max_asset_size
+        self.evict_interval = evict_interval
+        self.hits = 0
+        self.misses = 0
+        self._last_eviction = 0
+        self._failures = {}  # url -> time until which it isn't downloaded again
+        self._lock = threading.Lock()
+
+    def _index_path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'urls', key[:2], key + '.json')
+
+    def _blob_path(self, digest, extension):
+        return os.path.join(self.directory, 'blobs', digest[:2], digest + extension)
+
+    @staticmethod
+    def _write(path, content):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def lookup(self, url):
+        """Returns the local path of the cached ``url``, or None."""
+        try:
+            with open(self._index_path(url)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry['expires'] < time.time():
+            return None
+        try:
+            # Recently used files are evicted last
+            os.utime(entry['path'])
+        except OSError:
+            return None
+        return entry['path']
+
+    def resolve(self, url, depth=0, deadline=None):
+        """Returns the local path of ``url``, downloading it if needed, or None
+        if it can't be downloaded (before ``deadline``, a time.time() value)."""
+        path = self.lookup(url)
+        if path is not None:
+            self.hits += 1
+            return path
+        self.misses += 1
+        now = time.time()
+        if self._failures.get(url, 0) > now:
+            return None
+        if deadline is not None and deadline <= now:
+            log.warning("Not caching asset %s: the document took more than %ss to download", url,
+                        self.fetch_budget)
+            return None
+        try:
+            return self.fetch(url, depth, deadline)
+        except (IOError, OSError, ValueError) as ex:
+            log.warning("Can't cache asset %s: %s", url, ex)
+            self._add_failure(url)
+            return None
+
+    def _add_failure(self, url):
+        now = time.time()
+        with self._lock:
+            if len(self._failures) >= 1000:
+                self._failures = {key: until for key, until in self._failures.items() if until > now}
+            self._failures[url] = now + self.failure_ttl
+
+    def fetch(self, url, depth=0, deadline=None):
+        """Downloads ``url`` into the cache and returns its local path."""
+        timeout = self.fetch_timeout
+        if deadline is not None:
+            timeout = max(0.1, min(timeout, deadline - time.time()))
+        content, content_type = self._download(url, timeout)
+        extension = os.path.splitext(urlparse(url).path)[1]
+        if not re.match(r'^\.[A-Za-z0-9]{1,8}$', extension):
+            extension = mimetypes.guess_extension(content_type or '') or ''
+        if extension == '.css' or (content_type or '').startswith('text/css'):
+            content = self.rewrite_css(content.decode('utf-8', 'replace'), url, depth + 1,
+                                       deadline).encode('utf-8')
+
+        path = self._blob_path(hashlib.sha256(content).hexdigest(), extension)
+        if not os.path.exists(path):
+            self._write(path, content)
+        entry = {'url': url, 'path': path, 'expires': time.time() + self.ttl}
+        self._write(self._index_path(url), json.dumps(entry).encode('utf-8'))
+        log.debug("Cached asset %s as %s", url, path)
+
+        if time.time() - self._last_eviction > self.evict_interval:
+            self.evict()
+        return path
+
+    def _download(self, url, timeout):
+        """Returns the content and the content type served at ``url``."""
+        response = urlopen(url, timeout=timeout)
+        try:
+            content = response.read(self.max_asset_size + 1)
+            if len(content) > self.max_asset_size:
+                raise ValueError("larger than %d bytes" % self.max_asset_size)
+            return content, response.headers.get_content_type()
+        finally:
+            response.close()
+
+    def rewrite_css(self, content, base_url, depth=1, deadline=None):
+        """Returns the stylesheet ``content`` downloaded from ``base_url`` with
+        its url() references pointing to cached files."""
+        def replace(match):
+            url = match.group(2)
+            if url.startswith('data:') or url.startswith('#'):
+                return match.group(0)
+            url = urljoin(base_url, url)
+            if depth > MAX_CSS_DEPTH or not url.startswith(('http://', 'https://')):
+                return match.group(1) + url + match.group(3)
+            path = self.resolve(url, depth, deadline)
+            if path is None:
+                return match.group(1) + url + match.group(3)
+            return match.group(1) + pathname2fileurl(path) + match.group(3)
+        return CSS_URL_PATTERN.sub(replace, content)
+
+    def rewrite_html(self, content):
+        """Returns the HTML ``content`` with its external assets pointing to
+        cached files."""
+        deadline = time.time() + self.fetch_budget if self.fetch_budget else None
+
+        def replace(match):
+            path = self.resolve(match.group(2), deadline=deadline)
+            if path is None:
+                return match.group(0)
+            return match.group(1) + pathname2fileurl(path) + match.group(3)
+        for pattern in HTML_ASSET_PATTERNS:
+            content = pattern.sub(replace, content)
+        return content
+
+    def evict(self):
+        """Deletes expired index entries, then the least recently used files
+        until the cache holds at most ``max_bytes``."""
+        with self._lock:
+            self._last_eviction = time.time()
+            now = time.time()
+            for root, dirs, files in os.walk(os.path.join(self.directory, 'urls')):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        with open(path) as f:
+                            expired = json.load(f)['expires'] < now
+                    except (IOError, OSError, ValueError, KeyError):
+                        expired = True
+                    if expired:
+                        self._unlink(path)
+
+            if not self.max_bytes:
+                return
+            blobs = []
+            for root, dirs, files in os.walk(os.path.join(self.directory, 'blobs')):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    blobs.append((stat.st_mtime, stat.st_size, path))
+            size = sum(blob[1] for blob in blobs)
+            # Index entries of evicted files are ignored by lookup()
+            for mtime, blob_size, path in sorted(blobs):
+                if size <= self.max_bytes:
+                    break
+                self._unlink(path)
+                size -= blob_size
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_asset_cache():
+    """Returns the process-wide asset cache, or None if it is disabled."""
+    global _cache
+    if not getattr(settings, 'PDF_ASSETS_ENABLED', False):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                directory = getattr(settings, 'PDF_ASSETS_DIR', None) \
+                    or os.path.join(tempfile.gettempdir(), 'pdf-assets')
+                _cache = AssetCache(directory,
+                                    ttl=getattr(settings, 'PDF_ASSETS_TTL', 86400),
+                                    max_bytes=getattr(settings, 'PDF_ASSETS_MAX_BYTES', None),
+                                    fetch_timeout=getattr(settings, 'PDF_ASSETS_FETCH_TIMEOUT', 10),
+                                    max_asset_size=getattr(settings, 'PDF_ASSETS_MAX_SIZE',
+                                                           10 * 1024 * 1024),
+                                    failure_ttl=getattr(settings, 'PDF_ASSETS_FAILURE_TTL', 60),
+                                    fetch_budget=getattr(settings, 'PDF_ASSETS_FETCH_BUDGET', None))
+    return _cache
+
+
+def resolve_assets(content):
+    """Returns the HTML ``content`` with its external assets pointing to the
+    local cache, or unchanged if the cache is disabled."""
+    cache = get_asset_cache()
+    if cache is None:
+        return content
+    return cache.rewrite_html(content)
+
+
+@receiver(setting_changed)
+def _reset_cache(setting, **kwargs):
+    global _cache
+    if setting.startswith('PDF_ASSETS_'):
+        _cache = None
@@ -1,39 +1,169 @@
 import base64
+import hashlib
+import hmac
 import logging
+import threading
+import time
+from collections import OrderedDict
 
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.contrib.auth.models import User
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.http import HttpResponse
 from django.utils.six import wraps
 from django.views.decorators.csrf import csrf_exempt
 
+from pdf.timing import stage
+
+
+class CredentialCache(object):
+    """LRU of recently verified Authorization headers, so that a client
+    sending the same credentials again skips authenticate() (a database
+    query and a password hash) for ``ttl`` seconds.
+
+    Headers are only kept as a keyed hash. Entries of a user are dropped when
+    the user is saved or deleted in this process; the other processes notice
+    at the latest when their entry expires.
+    """
+
+    def __init__(self, ttl, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires, user)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(authorization):
+        return hmac.new(settings.SECRET_KEY.encode('utf-8'), authorization.encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+    def get(self, authorization):
+        """Returns the user verified for ``authorization``, or None."""
+        key = self.key(authorization)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, authorization, user):
+        with self._lock:
+            self._entries[self.key(authorization)] = (time.time() + self.ttl, user)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, pk):
+        with self._lock:
+            for key, (expires, user) in list(self._entries.items()):
+                if user.pk == pk:
+                    del self._entries[key]
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_credential_cache():
+    """Returns the process-wide credential cache, or None if it is disabled."""
+    global _cache
+    ttl = getattr(settings, 'PDF_AUTH_CACHE_TTL', 60)
+    if not ttl:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CredentialCache(ttl, getattr(settings, 'PDF_AUTH_CACHE_SIZE', 1000))
+    return _cache
+
+
+def authenticate_api_key(username, password):
+    """Returns a (not saved) user for credentials matching PDF_API_KEYS, a
+    dict of user names to the SHA-256 hex digest of their key, or None."""
+    digest = getattr(settings, 'PDF_API_KEYS', {}).get(username)
+    if digest is None or password is None:
+        return None
+    if not hmac.compare_digest(digest, hashlib.sha256(password.encode('utf-8')).hexdigest()):
+        return None
+    return User(username=username)
+
 
 def basic_auth_required(view_func):
     """Decorator which ensures the credentials (user and api key) are corrects."""
 
     @wraps(view_func)
     def _wrapped_view(request, *args, **kwargs):
-        username = None
-        password = None
-
         if hasattr(request, "user") and request.user.is_authenticated():
             return view_func(request, *args, **kwargs)
 
-        basic_auth = request.META.get('HTTP_AUTHORIZATION')
-        # print(basic_auth)
+        with stage('auth'):
+            user = _authenticate_request(request)
+        if user is None:
+            return HttpResponse(status=401)
+        request.user = user
+        return view_func(request, *args, **kwargs)
 
-        if basic_auth:
-            auth_method, token = basic_auth.split(' ', 1)
+    return _wrapped_view
 
-            if auth_method.lower() == 'basic':
-                token = base64.b64decode(token.strip()).decode()
-                username, password = token.split(':', 1)
 
-        user = authenticate(username=username, password=password)
+def _authenticate_request(request):
+    """Returns the active user authenticated by the BASIC-AUTH credentials of
+    ``request``, or None."""
+    username = None
+    password = None
+
+    basic_auth = request.META.get('HTTP_AUTHORIZATION')
+    # print(basic_auth)
+
+    cache = get_credential_cache() if basic_auth else None
+    if cache is not None:
+        user = cache.get(basic_auth)
         if user is not None:
-            if user.is_active:
-                request.user = user
-                return view_func(request, *args, **kwargs)
-        logging.getLogger("auth").warning("Bad password for user '%s'", username)
-        return HttpResponse(status=401)
+            return user
 
-    return _wrapped_view
+    if basic_auth:
+        auth_method, token = basic_auth.split(' ', 1)
+
+        if auth_method.lower() == 'basic':
+            token = base64.b64decode(token.strip()).decode()
+            username, password = token.split(':', 1)
+
+    user = authenticate_api_key(username, password)
+    if user is None:
+        user = authenticate(username=username, password=password)
+    if user is not None:
+        if user.is_active:
+            if cache is not None:
+                cache.set(basic_auth, user)
+            return user
+    logging.getLogger("auth").warning("Bad password for user '%s'", username)
+    return None
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def _invalidate_user(sender, instance, **kwargs):
+    if _cache is not None:
+        _cache.invalidate_user(instance.pk)
+
+
+@receiver(setting_changed)
+def _reset_cache(setting, **kwargs):
+    global _cache
+    if setting.startswith('PDF_AUTH_') or setting in ('PDF_API_KEYS', 'SECRET_KEY'):
+        _cache = None
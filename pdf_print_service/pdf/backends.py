@@ -0,0 +1,191 @@
+"""Rendering backends converting HTML pages to PDF.
+
+``PDF_BACKENDS`` maps the backend names to their classes; ``PDF_BACKEND``
+names the default one, and requests can choose another with the ``backend``
+parameter. Shipped backends:
+
+- WkhtmltopdfBackend: the wkhtmltopdf command (or the render workers of
+  pdf.warm when enabled).
+- WeasyPrintBackend: WeasyPrint, in process. Cheaper for simple documents
+  but it ignores most wkhtmltopdf options, and conversions can't be aborted
+  at their timeout.
+- FakeBackend: returns a constant document, for tests.
+"""
+from __future__ import absolute_import
+
+import logging
+import subprocess
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .warm import WarmUnsupported, get_warm_pool
+from .wkhtmltopdf import wkhtmltopdf, wkhtmltopdf_stream
+
+try:
+    import weasyprint
+except ImportError:
+    weasyprint = None
+
+log = logging.getLogger('pdf.backends')
+
+DEFAULT_BACKENDS = {
+    'wkhtmltopdf': 'pdf.backends.WkhtmltopdfBackend',
+    'weasyprint': 'pdf.backends.WeasyPrintBackend',
+}
+
+
+class BackendError(ValueError):
+    """Raised for an unknown or unavailable backend."""
+
+
+class Backend(object):
+    """Base class of the rendering backends."""
+
+    name = None
+    # Whether render() can return the document while it is produced
+    supports_stream = False
+    # Whether render() can write the document to a file
+    supports_output = False
+
+    def render(self, pages, input=None, timeout=None, stream=False, output=None, **options):
+        """Converts ``pages`` to PDF.
+
+        pages: List of file paths or URLs, '-' standing for ``input``.
+        input: Optional iterable of bytes of HTML.
+        timeout: Seconds after which the conversion is aborted with
+                 TimeoutExpired, if the backend can.
+        stream: When True, returns an iterator over the chunks of the
+                document with add_close_callback() and close() methods
+                (see pdf.wkhtmltopdf.PDFStream) instead of bytes.
+        output: Optional path of the file to write the document to instead
+                of returning it.
+        **options: wkhtmltopdf command-line options.
+
+        Failed conversions raise CalledProcessError.
+        """
+        raise NotImplementedError
+
+
+class WkhtmltopdfBackend(Backend):
+    name = 'wkhtmltopdf'
+    supports_stream = True
+    supports_output = True
+
+    def render(self, pages, input=None, timeout=None, stream=False, output=None, **options):
+        if stream:
+            return wkhtmltopdf_stream(
+                pages=pages,
+                buffer_size=getattr(settings, 'PDF_STREAM_BUFFER_SIZE', 1024 * 1024),
+                chunk_size=getattr(settings, 'PDF_STREAM_CHUNK_SIZE', 64 * 1024),
+                input=input,
+                timeout=timeout,
+                **options)
+        warm_pool = get_warm_pool()
+        # Render workers send the document through a pipe
+        if warm_pool is not None and output is None:
+            try:
+                return warm_pool.render(pages=pages, input=input, timeout=timeout, **options)
+            except WarmUnsupported as ex:
+                log.debug("Render workers can't convert this (%s), running wkhtmltopdf", ex)
+        return wkhtmltopdf(pages=pages, output=output, input=input, timeout=timeout, **options)
+
+
+class WeasyPrintBackend(Backend):
+    """Converts in process with WeasyPrint. Of the wkhtmltopdf options, only
+    the page size, orientation and margins are applied."""
+
+    name = 'weasyprint'
+
+    def __init__(self):
+        if weasyprint is None:
+            raise BackendError("WeasyPrint is not installed")
+
+    @staticmethod
+    def page_stylesheet(options):
+        """Returns the CSS equivalent to the page options of wkhtmltopdf."""
+        size = ' '.join(filter(None, (options.get('page-size', options.get('page_size')),
+                                      options.get('orientation'))))
+        rules = []
+        if size:
+            rules.append('size: %s;' % size.lower())
+        for side in ('top', 'right', 'bottom', 'left'):
+            margin = options.get('margin-' + side, options.get('margin_' + side))
+            if margin is not None:
+                rules.append('margin-%s: %s;' % (side, margin))
+        if not rules:
+            return None
+        return weasyprint.CSS(string='@page { %s }' % ' '.join(rules))
+
+    def render(self, pages, input=None, timeout=None, stream=False, output=None, **options):
+        if stream or output is not None:
+            raise NotImplementedError("WeasyPrint can't stream or write to a file")
+        stylesheet = self.page_stylesheet(options)
+        stylesheets = [stylesheet] if stylesheet is not None else None
+        html = None
+        try:
+            documents = []
+            for page in pages:
+                if page == '-':
+                    if html is None:
+                        html = b''.join(input).decode('utf-8')
+                    document = weasyprint.HTML(string=html, base_url=getattr(settings, 'BASE_DIR', None))
+                else:
+                    document = weasyprint.HTML(page)
+                documents.append(document.render(stylesheets=stylesheets))
+            all_pages = [p for document in documents for p in document.pages]
+            return documents[0].copy(all_pages).write_pdf()
+        except (IOError, ValueError, weasyprint.urls.URLFetchingError) as ex:
+            raise subprocess.CalledProcessError(1, 'weasyprint', output=b'',
+                                                stderr=str(ex).encode('utf-8'))
+
+
+FAKE_PDF = b'%PDF-1.4\n%%EOF\n'
+
+
+class FakeBackend(Backend):
+    """Returns FAKE_PDF, after reading the input."""
+
+    name = 'fake'
+
+    def render(self, pages, input=None, timeout=None, stream=False, output=None, **options):
+        if stream or output is not None:
+            raise NotImplementedError("The fake backend can't stream or write to a file")
+        if input is not None:
+            for chunk in input:
+                pass
+        return FAKE_PDF
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=None):
+    """Returns the backend called ``name`` (default: PDF_BACKEND).
+
+    Raises BackendError if it is unknown or can't be used.
+    """
+    if name is None:
+        name = getattr(settings, 'PDF_BACKEND', 'wkhtmltopdf')
+    if not isinstance(name, str):
+        raise BackendError("Unknown backend '%s'" % (name,))
+    backend = _backends.get(name)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(name)
+            if backend is None:
+                path = getattr(settings, 'PDF_BACKENDS', DEFAULT_BACKENDS).get(name)
+                if path is None:
+                    raise BackendError("Unknown backend '%s'" % name)
+                backend = _backends[name] = import_string(path)()
+    return backend
+
+
+@receiver(setting_changed)
+def _reset_backends(setting, **kwargs):
+    if setting.startswith('PDF_BACKEND'):
+        _backends.clear()
@@ -0,0 +1,293 @@
+"""Benchmarks of the service, runnable offline.
+
+Microbenchmarks time the hot paths of a request (command line building,
+path rewriting, template rendering) on large inputs; the load test sends
+conversions to /pdf at increasing concurrency and reports the throughput
+and latency percentiles of each level. Conversions are made by
+stub_wkhtmltopdf.py, whose latency and output size are set on its command
+line (see stub_command()), so that only the service is measured.
+
+Profile benchmarks convert a sample document with each render profile (see
+pdf.profiles) using the configured renderer, to tell what each one costs.
+
+See the pdf_benchmark, pdf_load_test and pdf_profile_benchmark management
+commands.
+"""
+import base64
+import json
+import math
+import os
+import shlex
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.six.moves.urllib.request import Request, urlopen
+from django.utils.six.moves.urllib.error import HTTPError
+
+STUB_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_wkhtmltopdf.py')
+
+ROWS_TEMPLATE = '''<html><head><link rel="stylesheet" href="/static/css/invoice.css"></head><body>
+<h1>{{ title }}</h1>
+<table>
+{% for row in rows %}<tr><td><img src="/static/img/{{ row.icon }}.png"></td><td>{{ row.label }}</td>
+<td>{{ row.quantity }}</td><td>{{ "%.2f"|format(row.price) }}</td></tr>
+{% endfor %}</table>
+<p>{{ rows|sum(attribute='price') }}</p>
+</body></html>'''
+
+
+def stub_command(latency=0, size=10 * 1024):
+    """Returns a WKHTMLTOPDF_CMD running the stub renderer."""
+    return '%s %s --stub-latency %s --stub-size %d' % (shlex.quote(sys.executable), shlex.quote(STUB_SCRIPT),
+                                                      latency, size)
+
+
+def percentile(values, percent):
+    """Returns the ``percent`` percentile of ``values`` (nearest rank)."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def make_rows(count):
+    return [{'icon': 'item%d' % (i % 10), 'label': 'Item <%d> & co' % i, 'quantity': i % 7 + 1,
+             'price': i * 1.25} for i in range(count)]
+
+
+def make_large_html(images):
+    """Returns an HTML document of ``images`` static references (one line
+    each), external links and text."""
+    lines = ['<html><head><link rel="stylesheet" href="/static/css/invoice.css"></head><body>']
+    for i in range(images):
+        lines.append('<p><img src="/static/img/item%d.png"> <a href="https://example.com/%d">line %d</a></p>'
+                     % (i % 10, i, i))
+    lines.append('</body></html>')
+    return '\n'.join(lines)
+
+
+def _options_to_args_benchmark(size):
+    from pdf.wkhtmltopdf import _options_to_args
+
+    options = {
+        'encoding': 'utf8', 'quiet': True, 'page-size': 'A4', 'orientation': 'Portrait',
+        'margin-top': '10mm', 'margin-bottom': '10mm', 'print-media-type': True,
+        'cookie': [('sessionid', 'abc'), ('csrftoken', 'def')], 'javascript-delay': None,
+    }
+    return lambda: _options_to_args(**options)
+
+
+def _make_absolute_paths_benchmark(size):
+    from pdf.wkhtmltopdf import make_absolute_paths
+
+    content = make_large_html(size)
+    return lambda: make_absolute_paths(content)
+
+
+def _render_jinja2_benchmark(size):
+    from pdf.views import MakePDFViewFromHtml
+
+    view = MakePDFViewFromHtml()
+    params = {'template': ROWS_TEMPLATE, 'data': {'title': 'Benchmark', 'rows': make_rows(size)}}
+    return lambda: view.render_jinja2(params)
+
+
+def _generate_jinja2_benchmark(size):
+    from pdf.views import MakePDFViewFromHtml
+
+    view = MakePDFViewFromHtml()
+    params = {'template': ROWS_TEMPLATE, 'data': {'title': 'Benchmark', 'rows': make_rows(size)}}
+    return lambda: sum(len(chunk) for chunk in view.generate_jinja2(params))
+
+
+# name: (factory of the function to time given the input size, default size)
+MICROBENCHMARKS = OrderedDict([
+    ('options_to_args', (_options_to_args_benchmark, 1)),
+    ('make_absolute_paths', (_make_absolute_paths_benchmark, 20000)),
+    ('render_jinja2', (_render_jinja2_benchmark, 10000)),
+    ('generate_jinja2', (_generate_jinja2_benchmark, 10000)),
+])
+
+
+def run_microbenchmark(name, repeat=20, size=None):
+    """Times ``repeat`` calls of the microbenchmark ``name`` (after a warm-up
+    call) and returns a dict of statistics in seconds."""
+    factory, default_size = MICROBENCHMARKS[name]
+    size = default_size if size is None else size
+    func = factory(size)
+    func()
+    # Fast functions are called in loops long enough for the clock
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= 0.01:
+            break
+        number *= 10
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return OrderedDict([
+        ('name', name),
+        ('size', size),
+        ('calls', repeat * number),
+        ('min', min(timings)),
+        ('p50', percentile(timings, 50)),
+        ('p95', percentile(timings, 95)),
+    ])
+
+
+def run_profile_benchmark(profile, repeat=5, rows=100):
+    """Converts ROWS_TEMPLATE with ``rows`` rows and ``profile`` ``repeat``
+    times (after a warm-up conversion) and returns a dict of statistics:
+    times in seconds, size of the document in bytes."""
+    from pdf.views import MakePDFViewFromHtml
+
+    view = MakePDFViewFromHtml()
+    params = {'template': ROWS_TEMPLATE, 'data': {'title': 'Benchmark', 'rows': make_rows(rows)},
+              'profile': profile}
+    cmd_options = view.get_cmd_options(params)
+    content = view.render_pdf(params, cmd_options, debug=False)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        content = view.render_pdf(params, cmd_options, debug=False)
+        timings.append(time.perf_counter() - start)
+    return OrderedDict([
+        ('profile', profile),
+        ('rows', rows),
+        ('min', min(timings)),
+        ('p50', percentile(timings, 50)),
+        ('size', len(content)),
+    ])
+
+
+def client_sender(username, password):
+    """Returns a function posting a JSON body to the service in this process
+    (through the Django test client) and returning the response status."""
+    from django.test import Client
+
+    local = threading.local()
+    authorization = 'Basic %s' % base64.b64encode(('%s:%s' % (username, password)).encode()).decode()
+
+    def send(path, body):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = Client()
+        response = client.post(path, body, content_type='application/json', HTTP_AUTHORIZATION=authorization)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        response.close()
+        return response.status_code
+    return send
+
+
+def http_sender(base_url, username, password):
+    """Returns a function posting a JSON body to the service at ``base_url``
+    and returning the response status."""
+    authorization = 'Basic %s' % base64.b64encode(('%s:%s' % (username, password)).encode()).decode()
+
+    def send(path, body):
+        request = Request(base_url.rstrip('/') + path, body.encode('utf-8'), {
+            'Content-Type': 'application/json',
+            'Authorization': authorization,
+        })
+        try:
+            response = urlopen(request)
+        except HTTPError as ex:
+            ex.read()
+            return ex.code
+        with response:
+            while response.read(64 * 1024):
+                pass
+        return response.status
+    return send
+
+
+def run_load_level(send, path, body, concurrency, requests):
+    """Sends ``requests`` requests from ``concurrency`` threads and returns a
+    dict of statistics (latencies in seconds)."""
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                status = send(path, body)
+            except (IOError, OSError):
+                status = 'error'
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker, name='pdf-load-%d' % i) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return OrderedDict([
+        ('concurrency', concurrency),
+        ('requests', requests),
+        ('ok', statuses.get(200, 0)),
+        ('statuses', statuses),
+        ('throughput', requests / elapsed if elapsed else None),
+        ('p50', percentile(latencies, 50)),
+        ('p95', percentile(latencies, 95)),
+        ('p99', percentile(latencies, 99)),
+    ])
+
+
+def load_test_body(rows=100, **params):
+    """Returns the JSON body of a template conversion of ``rows`` rows."""
+    return json.dumps(dict(params, template=ROWS_TEMPLATE, data={'title': 'Load test', 'rows': make_rows(rows)}))
+
+
+def run_load_test(send, levels, requests, body, path='/pdf/'):
+    """Runs run_load_level() for each concurrency of ``levels``, returns the
+    list of their statistics."""
+    return [run_load_level(send, path, body, concurrency, requests) for concurrency in levels]
+
+
+def is_regression(result, baseline, tolerance):
+    """Tells whether ``result`` is more than ``tolerance`` (a fraction) slower
+    than ``baseline``, comparing the medians."""
+    return result['p50'] > baseline['p50'] * (1 + tolerance)
+
+
+def default_load_settings(latency, size, max_concurrent, coalesce=False):
+    """Returns the settings the in-process load test runs with: the stub
+    renderer, no result cache, and a queue long enough for every thread.
+    All requests being identical, they are only coalesced when ``coalesce``
+    is True."""
+    return {
+        'PDF_COALESCE_ENABLED': coalesce,
+        'WKHTMLTOPDF_CMD': stub_command(latency, size),
+        'WKHTMLTOPDF_WARM_WORKERS': 0,
+        'PDF_CACHE_ENABLED': False,
+        'PDF_POOL_MAX_CONCURRENT': max_concurrent or getattr(settings, 'PDF_POOL_MAX_CONCURRENT', 2),
+        'PDF_POOL_QUEUE_SIZE': None,
+        'PDF_POOL_QUEUE_TIMEOUT': None,
+        'PDF_METRICS_DIR': None,
+        'PDF_SLOW_REQUEST_THRESHOLD': None,
+        'ALLOWED_HOSTS': ['testserver'],
+    }
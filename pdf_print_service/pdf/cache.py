@@ -0,0 +1,242 @@
+"""Content-addressed cache of rendered PDF documents.
+
+Entries are keyed by a hash of everything that determines the output (see
+:func:`cache_key`). The cache has two tiers: an in-process LRU bounded by
+``PDF_CACHE_MEMORY_BYTES`` and, when ``PDF_CACHE_DIR`` is set, a directory
+shared by all uwsgi workers of the host, swept of expired entries and
+bounded by ``PDF_CACHE_DISK_BYTES``. The whole cache is opt-in through
+``PDF_CACHE_ENABLED``.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+log = logging.getLogger('pdf.cache')
+
+
+def cache_key(**parts):
+    """Returns a hex digest identifying ``parts`` (any JSON-serializable values)."""
+    payload = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class MemoryCache(object):
+    """Thread-safe LRU of byte strings bounded by their total size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (expires, content)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, content = entry
+            if expires < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return content
+
+    def set(self, key, content, ttl):
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + ttl, content)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        expires, content = self._entries.pop(key)
+        self.size -= len(content)
+
+
+class DiskCache(object):
+    """Directory of cached documents shared between processes.
+
+    The expiry date of an entry is stored as the modification time of its
+    file, and files are written atomically so readers never see partial
+    content. Writers sweep the directory at most every ``sweep_interval``
+    seconds: expired entries are deleted, then those expiring first while
+    the files hold more than ``max_bytes``.
+    """
+
+    def __init__(self, directory, max_bytes=None, sweep_interval=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pdf')
+
+    def get(self, key):
+        """Returns a (expires, content) tuple, or None if there is no fresh entry."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires = os.fstat(f.fileno()).st_mtime
+                content = f.read() if expires >= time.time() else None
+        except (IOError, OSError):
+            return None
+        if content is None:
+            self._unlink(path)
+            return None
+        return expires, content
+
+    def set(self, key, content, ttl):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(content)
+                expires = time.time() + ttl
+                os.utime(temp_path, (expires, expires))
+                os.replace(temp_path, path)
+            except:
+                self._unlink(temp_path)
+                raise
+        except (IOError, OSError) as ex:
+            log.warning("Can't write cache entry %s: %s", path, ex)
+        self.sweep_if_due()
+
+    def sweep_if_due(self):
+        with self._lock:
+            if time.time() - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = time.time()
+        self.sweep()
+
+    def sweep(self):
+        """Deletes the expired entries (and temporary files left by dead
+        writers), then the entries expiring first until the directory holds at
+        most ``max_bytes``."""
+        now = time.time()
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.startswith('.tmp-'):
+                    # Being written, unless it is an hour old
+                    if stat.st_mtime < now - 3600:
+                        self._unlink(path)
+                elif stat.st_mtime < now:
+                    self._unlink(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        if not self.max_bytes:
+            return
+        size = sum(entry[1] for entry in entries)
+        for expires, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            self._unlink(path)
+            size -= entry_size
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class ResultCache(object):
+    """Two-tier (memory, then disk) cache of rendered documents."""
+
+    def __init__(self, memory, disk=None, default_ttl=3600, max_ttl=None):
+        self.memory = memory
+        self.disk = disk
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def ttl(self, requested=None):
+        """Returns the TTL to use for a request asking for ``requested`` seconds."""
+        if requested is None:
+            return self.default_ttl
+        if self.max_ttl is not None:
+            return min(requested, self.max_ttl)
+        return requested
+
+    def get(self, key):
+        content = self.memory.get(key)
+        if content is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                expires, content = entry
+                # Promote the entry for the time it has left on disk
+                self.memory.set(key, content, expires - time.time())
+        if content is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return content
+
+    def set(self, key, content, ttl=None):
+        ttl = self.ttl(ttl)
+        if ttl <= 0:
+            return
+        self.memory.set(key, content, ttl)
+        if self.disk is not None:
+            self.disk.set(key, content, ttl)
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the process-wide result cache, or None if caching is disabled."""
+    global _cache
+    if not getattr(settings, 'PDF_CACHE_ENABLED', False):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                directory = getattr(settings, 'PDF_CACHE_DIR', None)
+                disk = DiskCache(directory, getattr(settings, 'PDF_CACHE_DISK_BYTES', None)) if directory else None
+                _cache = ResultCache(
+                    memory=MemoryCache(getattr(settings, 'PDF_CACHE_MEMORY_BYTES', 64 * 1024 * 1024)),
+                    disk=disk,
+                    default_ttl=getattr(settings, 'PDF_CACHE_TTL', 3600),
+                    max_ttl=getattr(settings, 'PDF_CACHE_MAX_TTL', 24 * 3600),
+                )
+    return _cache
+
+
+@receiver(setting_changed)
+def _reset_cache(setting, **kwargs):
+    global _cache
+    if setting.startswith('PDF_CACHE_'):
+        _cache = None
@@ -0,0 +1,226 @@
+"""Single-flight execution of identical conversions.
+
+Requests for the same document (same result cache key) arriving while it is
+being converted wait for that conversion and get the same bytes instead of
+starting their own. Within a process the first request leads and the others
+wait on an event; failed conversions are shared too. Across the processes of
+a host, leaders hold an flock() on a file of ``PDF_COALESCE_DIR``: a leader
+finding the lock taken says it waits (a ``.wait`` file), then blocks on the
+lock, and the holder writes its result for it (``.pdf`` file) before
+deleting and releasing the lock. Results and the files of processes that
+died are swept after ``PDF_COALESCE_RESULT_TTL`` seconds.
+"""
+import errno
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from pdf import metrics
+from pdf.timing import stage
+
+log = logging.getLogger('pdf.coalesce')
+
+
+class _Flight(object):
+    """A conversion in progress in this process."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self, directory=None, result_ttl=60):
+        """
+        directory: Directory of the lock and result files shared with the
+                   other processes (None: coalesce within this process only).
+        result_ttl: Seconds after which left-over files are deleted.
+        """
+        self.directory = directory
+        self.result_ttl = result_ttl
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def run(self, key, func, shared_errors=()):
+        """Returns the result (usually bytes) of ``func()``, or of the identical call
+        ``key`` in progress. Exceptions of ``shared_errors`` are raised by all
+        waiters of the failed call; waiters of calls failing otherwise (e.g. a
+        full conversion queue) retry on their own."""
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+            if leader:
+                break
+            metrics.inc('pdf_coalesced_requests_total', scope='process')
+            with stage('coalesce'):
+                flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.result is not None:
+                return flight.result
+
+        try:
+            if self.directory:
+                flight.result = self._run_locked(key, func)
+            else:
+                flight.result = func()
+            return flight.result
+        except shared_errors as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+            self._sweep()
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _run_locked(self, key, func):
+        """Runs ``func()`` holding the host-wide lock of ``key``, or returns
+        the result of the process which held it."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key, '.lock')
+        while True:
+            with open(path, 'a') as lock_file:
+                if not _try_lock(lock_file):
+                    result = self._wait(key, lock_file)
+                    if result is not None:
+                        metrics.inc('pdf_coalesced_requests_total', scope='host')
+                        return result
+                if not _is_current(lock_file, path):
+                    # Deleted by its holder meanwhile: other processes may
+                    # lock the new file
+                    continue
+                try:
+                    result = func()
+                    # Spooled documents (pdf.spool) are only shared within the process
+                    if isinstance(result, bytes) and os.path.exists(self._path(key, '.wait')):
+                        self._write_result(key, result)
+                    return result
+                finally:
+                    # Deleted before being released, see _is_current()
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _wait(self, key, lock_file):
+        """Waits for the lock of ``key`` and returns the result written by its
+        previous holder, or None (the lock being held then)."""
+        started = time.time()
+        with open(self._path(key, '.wait'), 'a'):
+            pass
+        with stage('coalesce'):
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        path = self._path(key, '.pdf')
+        try:
+            with open(path, 'rb') as f:
+                # File times are coarser than time.time()
+                if os.fstat(f.fileno()).st_mtime >= started - 1:
+                    return f.read()
+        except (IOError, OSError):
+            pass
+        return None
+
+    def _write_result(self, key, result):
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(result)
+            os.replace(temp_path, self._path(key, '.pdf'))
+            os.unlink(self._path(key, '.wait'))
+        except (IOError, OSError) as ex:
+            log.warning("Can't share conversion %s: %s", key, ex)
+
+    def _sweep(self):
+        """Deletes the files left for ``result_ttl`` seconds (checked at most
+        once per ``result_ttl``)."""
+        if not self.directory or time.time() - self._last_sweep < self.result_ttl:
+            return
+        self._last_sweep = time.time()
+        expired = time.time() - self.result_ttl
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime >= expired:
+                    continue
+                if name.endswith('.lock'):
+                    # Only delete locks nobody holds, as their holder would
+                    with open(path, 'a') as lock_file:
+                        if _try_lock(lock_file) and _is_current(lock_file, path):
+                            os.unlink(path)
+                else:
+                    os.unlink(path)
+            except (IOError, OSError):
+                continue
+
+
+def _try_lock(lock_file):
+    """Takes the flock of ``lock_file`` if it is free, returns whether it did."""
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as ex:
+        if ex.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+def _is_current(lock_file, path):
+    """Returns whether ``lock_file`` is still the file at ``path``.
+
+    Lock files are deleted while locked, so a process that opened one
+    before it was deleted must not take its flock for the lock of the key.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    current = os.fstat(lock_file.fileno())
+    return (stat.st_dev, stat.st_ino) == (current.st_dev, current.st_ino)
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """Returns the process-wide SingleFlight, or None if coalescing is disabled."""
+    global _single_flight
+    if not getattr(settings, 'PDF_COALESCE_ENABLED', True):
+        return None
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight(
+                    directory=getattr(settings, 'PDF_COALESCE_DIR', None),
+                    result_ttl=getattr(settings, 'PDF_COALESCE_RESULT_TTL', 60),
+                )
+    return _single_flight
+
+
+@receiver(setting_changed)
+def _reset_single_flight(setting, **kwargs):
+    global _single_flight
+    if setting.startswith('PDF_COALESCE_'):
+        _single_flight = None
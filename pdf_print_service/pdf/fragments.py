@@ -0,0 +1,134 @@
+"""Header and footer fragments rendered once and reused.
+
+wkhtmltopdf reads headers and footers from HTML files (--header-html,
+--footer-html). A fragment (template source, data and assets) is rendered
+into a file of ``PDF_FRAGMENTS_DIR`` named by the hash of what it is made of,
+so the documents using the same header share that file instead of rendering
+it again. Files unused for ``PDF_FRAGMENTS_TTL`` seconds are deleted.
+"""
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.encoding import smart_text
+
+from pdf.assets import resolve_assets
+from pdf.cache import cache_key
+from pdf.jinja import get_template
+from pdf.timing import stage
+from pdf.wkhtmltopdf import make_absolute_paths
+
+
+class FragmentCache(object):
+    """Directory of rendered fragments named by their content hash."""
+
+    def __init__(self, directory, ttl=24 * 3600):
+        self.directory = directory
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._last_eviction = 0
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.html')
+
+    def get_file(self, source, data=None, assets=None):
+        """Returns the path of the HTML file of the template ``source``
+        rendered with ``data`` (and the URLs of ``assets``)."""
+        data = data or {}
+        key = cache_key(source=source, data=data, assets=assets)
+        path = self.path(key)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is not None:
+            self.hits += 1
+            if mtime < time.time() - self.ttl / 2:
+                # Keeps the files in use away from evict()
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            return path
+
+        self.misses += 1
+        context = data if assets is None else dict(data, assets=assets)
+        content = smart_text(get_template(source).render(context))
+        content = resolve_assets(make_absolute_paths(content))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-', suffix='.html')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        os.replace(temp_path, path)
+        self.evict_if_due()
+        return path
+
+    def evict_if_due(self):
+        with self._lock:
+            if time.time() - self._last_eviction < min(self.ttl, 3600):
+                return
+            self._last_eviction = time.time()
+        self.evict()
+
+    def evict(self):
+        """Deletes the fragments unused for ``ttl`` seconds."""
+        expired = time.time() - self.ttl
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_mtime < expired:
+                        os.unlink(path)
+                except OSError:
+                    continue
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_fragment_cache():
+    """Returns the process-wide fragment cache, built from settings."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = FragmentCache(
+                    getattr(settings, 'PDF_FRAGMENTS_DIR', os.path.join(tempfile.gettempdir(), 'pdf-fragments')),
+                    ttl=getattr(settings, 'PDF_FRAGMENTS_TTL', 24 * 3600),
+                )
+    return _cache
+
+
+def fragment_options(params):
+    """Returns the wkhtmltopdf options of the ``header`` and ``footer`` of
+    ``params`` (template sources rendered with ``header_data`` and
+    ``footer_data``)."""
+    options = {}
+    for part in ('header', 'footer'):
+        source = params.get(part)
+        if source is not None:
+            with stage('fragments'):
+                options[part + '-html'] = get_fragment_cache().get_file(
+                    source, params.get(part + '_data'), params.get(part + '_assets'))
+    return options
+
+
+@receiver(setting_changed)
+def _reset_cache(setting, **kwargs):
+    global _cache
+    if setting.startswith('PDF_FRAGMENTS_'):
+        _cache = None
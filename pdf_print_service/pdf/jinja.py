@@ -0,0 +1,108 @@
+"""Shared Jinja2 environment with a cache of compiled templates.
+
+Templates are compiled once per distinct source and kept in an LRU of
+``PDF_JINJA2_CACHE_SIZE`` entries keyed by a hash of the source. When
+``PDF_JINJA2_BYTECODE_CACHE_DIR`` is set, the compiled bytecode is also
+stored on disk so freshly started workers don't have to compile again.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import jinja2
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+class TemplateCache(object):
+    """LRU of compiled templates keyed by the hash of their source."""
+
+    def __init__(self, environment, max_size=100):
+        self.environment = environment
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(source):
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def get_template(self, source):
+        """Returns the compiled jinja2.Template for ``source``."""
+        key = self.key(source)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self.hits += 1
+                self._templates.move_to_end(key)
+                return template
+            self.misses += 1
+
+        template = self.compile(key, source)
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return template
+
+    def compile(self, key, source):
+        # Same steps as jinja2.BaseLoader.load(), without a loader.
+        environment = self.environment
+        bcc = environment.bytecode_cache
+        bucket = None
+        code = None
+        if bcc is not None:
+            bucket = bcc.get_bucket(environment, key, None, source)
+            code = bucket.code
+        if code is None:
+            code = environment.compile(source, name=key)
+            if bucket is not None:
+                bucket.code = code
+                bcc.set_bucket(bucket)
+        return environment.template_class.from_code(environment, code,
+                                                    environment.make_globals(None))
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._templates),
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_template_cache():
+    """Returns the process-wide template cache, built from settings."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                bytecode_cache = None
+                directory = getattr(settings, 'PDF_JINJA2_BYTECODE_CACHE_DIR', None)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                    bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+                environment = jinja2.Environment(bytecode_cache=bytecode_cache)
+                _cache = TemplateCache(environment,
+                                       max_size=getattr(settings, 'PDF_JINJA2_CACHE_SIZE', 100))
+    return _cache
+
+
+def get_template(source):
+    """Returns the compiled template for ``source`` from the shared cache."""
+    return get_template_cache().get_template(source)
+
+
+@receiver(setting_changed)
+def _reset_cache(setting, **kwargs):
+    global _cache
+    if setting.startswith('PDF_JINJA2_'):
+        _cache = None
@@ -0,0 +1,172 @@
+"""Background PDF conversions.
+
+Jobs are stored as :class:`pdf.models.ConversionJob` rows and their results
+are written to ``PDF_JOBS_DIR``, where they are kept ``PDF_JOBS_RESULT_TTL``
+seconds. With ``PDF_JOBS_WORKERS`` > 0 jobs run in threads of the web
+process; otherwise (or for jobs left over by a restart) the ``run_pdf_jobs``
+management command runs them. Jobs still running ``PDF_JOBS_STALE_AFTER``
+seconds after their last conversion attempt started were interrupted by the
+death of their worker: they are marked failed.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from pdf.models import ConversionJob
+from pdf.pool import PoolBusy, get_priorities
+
+log = logging.getLogger('pdf.jobs')
+
+
+def get_jobs_dir():
+    return getattr(settings, 'PDF_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'pdf-jobs'))
+
+
+def result_path(job):
+    """Returns the path of the PDF file produced by ``job``."""
+    return os.path.join(get_jobs_dir(), '%s.pdf' % job.id)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the in-process job executor, or None if jobs run out of process."""
+    global _executor
+    workers = getattr(settings, 'PDF_JOBS_WORKERS', 1)
+    if not workers:
+        return None
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def submit_job(owner, params, filename):
+    """Records a conversion of ``params`` for ``owner`` and schedules it."""
+    purge_expired_jobs()
+    fail_stale_jobs()
+    job = ConversionJob.objects.create(owner=owner, params=json.dumps(params), filename=filename)
+    executor = get_executor()
+    if executor is not None:
+        executor.submit(_run_job_in_thread, job.id)
+    return job
+
+
+def _run_job_in_thread(job_id):
+    try:
+        run_job(job_id)
+    except Exception:
+        log.exception("Job %s crashed", job_id)
+    finally:
+        close_old_connections()
+
+
+def run_job(job_id):
+    """Runs the pending job ``job_id``.
+
+    Returns False if the job was not pending anymore (e.g. another worker
+    took it).
+    """
+    if not ConversionJob.objects.filter(pk=job_id, status=ConversionJob.PENDING) \
+            .update(status=ConversionJob.RUNNING, started=timezone.now()):
+        return False
+    job = ConversionJob.objects.get(pk=job_id)
+    log.info("Running job %s", job.id)
+
+    from pdf.views import CONVERSION_ERRORS, MakePDFViewFromHtml
+    view = MakePDFViewFromHtml()
+    params = json.loads(job.params)
+    try:
+        # Jobs are bulk work by default
+        view.set_scheduling(job.owner, params, get_priorities()[-1])
+        while True:
+            try:
+                pdf_content = view.render_coalesced(params, view.get_cmd_options(params), debug=False)
+                break
+            except PoolBusy:
+                # Jobs are not in a hurry: wait for a renderer instead of failing
+                time.sleep(getattr(settings, 'PDF_POOL_RETRY_AFTER', 5))
+                # Still alive, see fail_stale_jobs()
+                ConversionJob.objects.filter(pk=job.id).update(started=timezone.now())
+        _write_result(job, pdf_content)
+        job.status = ConversionJob.DONE
+    except CONVERSION_ERRORS as ex:
+        job.status = ConversionJob.FAILED
+        job.error = view.conversion_error_response(ex, params.get('url')).content.decode('utf-8')
+    except Exception as ex:
+        log.exception("Job %s failed", job.id)
+        job.status = ConversionJob.FAILED
+        job.error = str(ex)
+
+    job.finished = timezone.now()
+    job.expires = job.finished + timedelta(seconds=getattr(settings, 'PDF_JOBS_RESULT_TTL', 3600))
+    job.save()
+    log.info("Job %s %s", job.id, job.status)
+    return True
+
+
+def _write_result(job, pdf_content):
+    directory = get_jobs_dir()
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(pdf_content)
+    os.replace(temp_path, result_path(job))
+
+
+def purge_expired_jobs():
+    """Deletes expired jobs and their results."""
+    for job in ConversionJob.objects.filter(expires__lt=timezone.now()):
+        try:
+            os.unlink(result_path(job))
+        except OSError:
+            pass
+        job.delete()
+
+
+def fail_stale_jobs():
+    """Marks failed the jobs left running by a worker that died (e.g. on a
+    restart), which would otherwise be reported running forever."""
+    stale_after = getattr(settings, 'PDF_JOBS_STALE_AFTER', 900)
+    if stale_after is None:
+        return
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=stale_after)
+    # Jobs started before their start was recorded: by their creation
+    stale = Q(started__lt=cutoff) | Q(started__isnull=True, created__lt=cutoff)
+    count = ConversionJob.objects.filter(stale, status=ConversionJob.RUNNING).update(
+        status=ConversionJob.FAILED, error="Interrupted: its worker stopped while converting it",
+        finished=now, expires=now + timedelta(seconds=getattr(settings, 'PDF_JOBS_RESULT_TTL', 3600)))
+    if count:
+        log.warning("Marked %d interrupted job(s) failed", count)
+
+
+def describe_job(job, request):
+    """Returns the JSON-serializable status of ``job``."""
+    description = {
+        'id': str(job.id),
+        'status': job.status,
+        'created': job.created.isoformat(),
+        'finished': job.finished.isoformat() if job.finished else None,
+        'expires': job.expires.isoformat() if job.expires else None,
+        'url': request.build_absolute_uri(reverse('pdf-job', args=[job.id])),
+    }
+    if job.status == ConversionJob.DONE:
+        description['result'] = request.build_absolute_uri(reverse('pdf-job-result', args=[job.id]))
+    if job.status == ConversionJob.FAILED:
+        description['error'] = job.error
+    return description
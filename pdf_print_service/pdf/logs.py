@@ -0,0 +1,142 @@
+"""Request logging that stays cheap on big documents.
+
+log_request() writes one record per API request (logger ``pdf.requests``)
+where the body is summarized by its size, its SHA-1 and its first
+``PDF_LOG_PAYLOAD_MAX_CHARS`` characters; a fraction
+``PDF_LOG_PAYLOAD_SAMPLE_RATE`` of the requests are logged with their full
+body. The fields are also attached to the record as ``record.fields`` for
+JSONFormatter.
+
+BackgroundHandler moves the actual writing (files, console) to a thread fed
+through a bounded queue, dropping records rather than blocking requests
+when it is full.
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+
+from django.conf import settings
+from django.utils.six.moves import queue
+
+log = logging.getLogger('pdf.requests')
+
+
+def describe_payload(body):
+    """Returns the fields describing the request ``body`` (bytes) in logs."""
+    max_chars = getattr(settings, 'PDF_LOG_PAYLOAD_MAX_CHARS', 200)
+    fields = {
+        'size': len(body),
+        'sha1': hashlib.sha1(body).hexdigest(),
+    }
+    sample_rate = getattr(settings, 'PDF_LOG_PAYLOAD_SAMPLE_RATE', 0)
+    if sample_rate and random.random() < sample_rate:
+        fields['body'] = body.decode('utf-8', errors='replace')
+    elif max_chars:
+        # A character takes at most 4 bytes in UTF-8
+        text = body[:max_chars * 4].decode('utf-8', errors='replace')
+        excerpt = text[:max_chars]
+        if len(text) > max_chars or len(body) > max_chars * 4:
+            excerpt += '...'
+        fields['excerpt'] = excerpt
+    return fields
+
+
+def log_request(request, **fields):
+    """Logs the API ``request`` with ``fields`` and a summary of its body."""
+    if not log.isEnabledFor(logging.INFO):
+        return
+    user = getattr(request, 'user', None)
+    fields = dict(fields, method=request.method, path=request.path,
+                  user=user.get_username() if user is not None and user.is_authenticated() else None)
+    # Set by pdf.payload.read_body(), which consumed the body
+    body = getattr(request, 'payload', None)
+    if body is None:
+        body = request.body
+    if request.META.get('HTTP_CONTENT_ENCODING'):
+        fields['encoding'] = request.META['HTTP_CONTENT_ENCODING']
+    fields.update(describe_payload(body))
+    log.info(' '.join('%s=%s' % (name, json.dumps(fields[name])) for name in sorted(fields)),
+             extra={'fields': fields})
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as JSON objects, with the ``fields`` of log_request()."""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """Passes records to the handlers named ``handlers`` (handlers of the
+    LOGGING setting attached to no logger) from a background thread.
+
+    At most ``queue_size`` records wait; further ones are dropped and
+    counted in ``dropped``.
+    """
+
+    def __init__(self, handlers, queue_size=10000):
+        super(BackgroundHandler, self).__init__(queue.Queue(queue_size))
+        self.handler_names = handlers
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # The thread doesn't survive the fork of uwsgi workers: start one per process
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # logging keeps the handlers configured by dictConfig by name
+            targets = [logging._handlers[name] for name in self.handler_names]
+            self._listener = logging.handlers.QueueListener(self.queue, *targets,
+                                                            respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Render the message now, the arguments may change once the call returns
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        super(BackgroundHandler, self).emit(record)
+
+    def close(self):
+        # Called by logging.shutdown() at exit, before the targets are closed
+        with self._lock:
+            if self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+        super(BackgroundHandler, self).close()
@@ -0,0 +1,53 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pdf.benchmarks import MICROBENCHMARKS, is_regression, run_microbenchmark
+
+
+class Command(BaseCommand):
+    help = "Times the hot paths of a conversion request on large inputs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', metavar='name',
+                            help="Benchmarks to run among %s (default: all)." % ', '.join(MICROBENCHMARKS))
+        parser.add_argument('--repeat', type=int, default=20, help="Number of timings of each benchmark.")
+        parser.add_argument('--size', type=int, default=None,
+                            help="Input size (HTML lines, template rows) instead of each benchmark's default.")
+        parser.add_argument('--save', metavar='FILE', help="Write the results to FILE (JSON).")
+        parser.add_argument('--compare', metavar='FILE',
+                            help="Fail if a benchmark is slower than in the results saved in FILE.")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Slowdown accepted by --compare, as a fraction (default: 0.2).")
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(MICROBENCHMARKS)
+        unknown = set(names) - set(MICROBENCHMARKS)
+        if unknown:
+            raise CommandError("Unknown benchmark(s): %s" % ', '.join(sorted(unknown)))
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = dict((result['name'], result) for result in json.load(f))
+
+        results = []
+        regressions = []
+        self.stdout.write("%-20s %8s %8s %12s %12s %12s" % ('benchmark', 'size', 'calls', 'min', 'p50', 'p95'))
+        for name in names:
+            result = run_microbenchmark(name, options['repeat'], options['size'])
+            results.append(result)
+            line = "%-20s %8d %8d %10.3fms %10.3fms %10.3fms" % (
+                name, result['size'], result['calls'], result['min'] * 1000, result['p50'] * 1000,
+                result['p95'] * 1000)
+            previous = baseline.get(name)
+            if previous is not None and previous['size'] == result['size']:
+                line += "  (%+.0f%%)" % ((result['p50'] / previous['p50'] - 1) * 100)
+                if is_regression(result, previous, options['tolerance']):
+                    regressions.append(name)
+            self.stdout.write(line)
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if regressions:
+            raise CommandError("Slower than the baseline: %s" % ', '.join(regressions))
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from pdf.benchmarks import (client_sender, default_load_settings, http_sender, is_regression, load_test_body,
+                            run_load_test)
+
+USERNAME = 'load-test'
+PASSWORD = 'load-test'
+
+
+def _levels(value):
+    try:
+        levels = [int(level) for level in value.split(',')]
+    except ValueError:
+        levels = None
+    if not levels or min(levels) < 1:
+        raise ValueError("expected positive integers separated by commas")
+    return levels
+
+
+class Command(BaseCommand):
+    help = ("Sends template conversions to /pdf at increasing concurrency and reports the throughput and "
+            "latency percentiles. Runs the service in this process with a stub renderer, unless --url is given.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=_levels, default=[1, 2, 4, 8, 16],
+                            help="Comma-separated concurrency levels (default: 1,2,4,8,16).")
+        parser.add_argument('--requests', type=int, default=50, help="Requests sent at each level.")
+        parser.add_argument('--rows', type=int, default=100, help="Rows of the rendered template.")
+        parser.add_argument('--stream', action='store_true', help="Request streamed conversions.")
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help="Seconds each stub conversion takes (default: 0.05).")
+        parser.add_argument('--output-size', type=int, default=100 * 1024,
+                            help="Bytes of each stub document (default: 100 KiB).")
+        parser.add_argument('--max-concurrent', type=int, default=None,
+                            help="PDF_POOL_MAX_CONCURRENT of the service in this process.")
+        parser.add_argument('--coalesce', action='store_true',
+                            help="Let the service in this process coalesce the (identical) requests.")
+        parser.add_argument('--url', help="Base URL of a running service to test instead, e.g. "
+                                          "http://localhost:8000 (its own renderer is used).")
+        parser.add_argument('--user', default=USERNAME, help="User name for --url.")
+        parser.add_argument('--password', default=PASSWORD, help="API key for --url.")
+        parser.add_argument('--save', metavar='FILE', help="Write the results to FILE (JSON).")
+        parser.add_argument('--compare', metavar='FILE',
+                            help="Fail if a level's median latency is worse than in the results saved in FILE.")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Slowdown accepted by --compare, as a fraction (default: 0.2).")
+
+    def handle(self, *args, **options):
+        body = load_test_body(options['rows'], stream=options['stream'], cache=False)
+        if options['url']:
+            send = http_sender(options['url'], options['user'], options['password'])
+            results = self.run(send, body, options)
+        else:
+            overrides = default_load_settings(options['latency'], options['output_size'],
+                                              options['max_concurrent'], options['coalesce'])
+            overrides['PDF_API_KEYS'] = {USERNAME: hashlib.sha256(PASSWORD.encode('utf-8')).hexdigest()}
+            # Request logs would measure the console
+            logging.disable(logging.WARNING)
+            try:
+                with override_settings(**overrides):
+                    results = self.run(client_sender(USERNAME, PASSWORD), body, options)
+            finally:
+                logging.disable(logging.NOTSET)
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = dict((result['concurrency'], result) for result in json.load(f))
+            regressions = [str(result['concurrency']) for result in results
+                           if result['concurrency'] in baseline
+                           and is_regression(result, baseline[result['concurrency']], options['tolerance'])]
+            if regressions:
+                raise CommandError("Slower than the baseline at concurrency %s" % ', '.join(regressions))
+
+    def run(self, send, body, options):
+        self.stdout.write("%11s %8s %8s %10s %10s %10s %10s" % (
+            'concurrency', 'requests', 'ok', 'req/s', 'p50', 'p95', 'p99'))
+        results = run_load_test(send, options['concurrency'], options['requests'], body)
+        for result in results:
+            self.stdout.write("%11d %8d %8d %10.1f %8.1fms %8.1fms %8.1fms" % (
+                result['concurrency'], result['requests'], result['ok'], result['throughput'],
+                result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000))
+            if result['ok'] != result['requests']:
+                self.stderr.write("  statuses: %s" % ', '.join(
+                    '%s: %d' % item for item in sorted(result['statuses'].items(), key=str)))
+        return results
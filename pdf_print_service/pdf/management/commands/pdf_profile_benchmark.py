@@ -0,0 +1,40 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from pdf.benchmarks import run_profile_benchmark
+from pdf.profiles import get_profiles
+
+
+class Command(BaseCommand):
+    help = ("Converts a sample document with each render profile (WKHTMLTOPDF_PROFILES) and reports the "
+            "conversion time and the document size, compared to the default profile.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('profiles', nargs='*', metavar='profile', help="Profiles to run (default: all).")
+        parser.add_argument('--repeat', type=int, default=5, help="Number of conversions with each profile.")
+        parser.add_argument('--rows', type=int, default=100, help="Number of table rows of the document.")
+        parser.add_argument('--save', metavar='FILE', help="Write the results to FILE (JSON).")
+
+    def handle(self, *args, **options):
+        profiles = options['profiles'] or sorted(get_profiles())
+        unknown = set(profiles) - set(get_profiles())
+        if unknown:
+            raise CommandError("Unknown profile(s): %s" % ', '.join(sorted(unknown)))
+
+        results = [run_profile_benchmark(profile, options['repeat'], options['rows']) for profile in profiles]
+        default = dict((result['profile'], result) for result in results).get(
+            getattr(settings, 'WKHTMLTOPDF_DEFAULT_PROFILE', None))
+        self.stdout.write("%-12s %12s %12s %12s" % ('profile', 'min', 'p50', 'size'))
+        for result in results:
+            line = "%-12s %10.1fms %10.1fms %10.1fKB" % (
+                result['profile'], result['min'] * 1000, result['p50'] * 1000, result['size'] / 1024.0)
+            if default is not None and result is not default:
+                line += "  (time %+.0f%%, size %+.0f%%)" % ((result['p50'] / default['p50'] - 1) * 100,
+                                                            (result['size'] / default['size'] - 1) * 100)
+            self.stdout.write(line)
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from pdf.jobs import fail_stale_jobs, purge_expired_jobs, run_job
+from pdf.models import ConversionJob
+
+
+class Command(BaseCommand):
+    help = "Runs pending background PDF conversions, purges expired results and fails interrupted jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Run the pending jobs then exit instead of polling.")
+        parser.add_argument('--interval', type=float, default=2,
+                            help="Seconds between two polls of the job table.")
+
+    def handle(self, *args, **options):
+        while True:
+            purge_expired_jobs()
+            fail_stale_jobs()
+            pending = ConversionJob.objects.filter(status=ConversionJob.PENDING) \
+                .values_list('pk', flat=True)
+            for job_id in list(pending):
+                if run_job(job_id):
+                    self.stdout.write("Job %s processed" % job_id)
+            if options['once']:
+                break
+            time.sleep(options['interval'])
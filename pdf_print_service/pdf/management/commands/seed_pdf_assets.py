@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pdf.assets import get_asset_cache
+
+
+class Command(BaseCommand):
+    help = "Downloads assets into the local asset cache before templates need them."
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='*', metavar='url',
+                            help="URL of an image, stylesheet or font to cache.")
+        parser.add_argument('--file', dest='files', action='append', default=[],
+                            help="File listing URLs to cache, one per line.")
+        parser.add_argument('--evict', action='store_true',
+                            help="Delete expired and least recently used assets afterwards.")
+
+    def handle(self, *args, **options):
+        cache = get_asset_cache()
+        if cache is None:
+            raise CommandError("The asset cache is disabled (PDF_ASSETS_ENABLED)")
+        urls = list(options['urls'])
+        for filename in options['files']:
+            with open(filename) as f:
+                urls.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+
+        failed = 0
+        for url in urls:
+            try:
+                path = cache.fetch(url)
+            except (IOError, OSError, ValueError) as ex:
+                failed += 1
+                self.stderr.write("%s: %s" % (url, ex))
+            else:
+                self.stdout.write("%s -> %s" % (url, path))
+        if options['evict']:
+            cache.evict()
+        if failed:
+            raise CommandError("%d asset(s) could not be cached" % failed)
@@ -0,0 +1,299 @@
+"""Service metrics in the Prometheus text format.
+
+Each process counts in memory. When ``PDF_METRICS_DIR`` is set, a thread
+writes the process' values to a file of that directory every
+``PDF_METRICS_FLUSH_INTERVAL`` seconds, and /metrics adds up the files of
+all processes (uwsgi workers, job runners): counters and histograms of every
+process ever started, gauges of running processes only. The directory should
+be emptied when the service starts.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+log = logging.getLogger('pdf.metrics')
+
+TIME_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'pdf_requests_total': ('counter', "API requests by view and outcome.", None),
+    'pdf_template_render_seconds': ('histogram', "Time spent rendering Jinja2 templates.", TIME_BUCKETS),
+    'pdf_conversion_seconds': ('histogram', "Wall time of PDF conversions by backend.", TIME_BUCKETS),
+    'pdf_output_bytes': ('histogram', "Size of the produced PDF documents.", SIZE_BUCKETS),
+    'pdf_conversions_in_flight': ('gauge', "Conversions running.", None),
+    'pdf_conversions_waiting': ('gauge', "Conversions waiting for a free renderer.", None),
+    'pdf_coalesced_requests_total': ('counter', "Requests served by an identical conversion in progress, "
+                                                "by scope (process, host).", None),
+    'pdf_result_cache_requests_total': ('counter', "Result cache lookups by result (hit, miss).", None),
+    'pdf_template_cache_requests_total': ('counter', "Compiled template cache lookups by result.", None),
+    'pdf_auth_cache_requests_total': ('counter', "Verified credential cache lookups by result.", None),
+    'pdf_asset_cache_requests_total': ('counter', "Asset cache lookups by result.", None),
+    'pdf_fragment_cache_requests_total': ('counter', "Rendered header/footer lookups by result.", None),
+    'pdf_log_records_dropped_total': ('counter', "Log records dropped because the log queue was full.", None),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry(object):
+    """Metric values of one process."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}  # key -> [count per bucket..., sum]
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = _key(name, labels)
+        with self._lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    values[index] += 1
+                    break
+            else:
+                values[len(buckets)] += 1
+            values[-1] += value
+
+    def snapshot(self):
+        """Returns the JSON-serializable values of this process, collected
+        values included."""
+        with self._lock:
+            counters = [[name, dict(labels), value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, dict(labels), list(values)]
+                          for (name, labels), values in self.histograms.items()]
+        gauges = []
+        for kind, name, labels, value in collect():
+            (counters if kind == 'counter' else gauges).append([name, labels, value])
+        return {'pid': os.getpid(), 'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+
+def collect():
+    """Returns the values kept by the other modules of the service, as
+    (type, name, labels, value) tuples."""
+    from pdf.aio import get_async_pool
+    from pdf.assets import get_asset_cache
+    from pdf.authentication import get_credential_cache
+    from pdf.cache import get_cache
+    from pdf.fragments import get_fragment_cache
+    from pdf.jinja import get_template_cache
+    from pdf.pool import get_pool
+
+    values = []
+    # Conversions of the WSGI and ASGI (event loop) paths
+    pools = (get_pool(), get_async_pool())
+    values.append(('gauge', 'pdf_conversions_in_flight', {}, sum(pool.running for pool in pools)))
+    values.append(('gauge', 'pdf_conversions_waiting', {}, sum(pool.waiting for pool in pools)))
+    for name, cache in (('pdf_result_cache_requests_total', get_cache()),
+                        ('pdf_template_cache_requests_total', get_template_cache()),
+                        ('pdf_auth_cache_requests_total', get_credential_cache()),
+                        ('pdf_asset_cache_requests_total', get_asset_cache()),
+                        ('pdf_fragment_cache_requests_total', get_fragment_cache())):
+        if cache is not None:
+            stats = cache.stats()
+            values.append(('counter', name, {'result': 'hit'}, stats['hits']))
+            values.append(('counter', name, {'result': 'miss'}, stats['misses']))
+    dropped = sum(getattr(handler, 'dropped', 0) for handler in logging.getLogger().handlers)
+    values.append(('counter', 'pdf_log_records_dropped_total', {}, dropped))
+    return values
+
+
+_registry = Registry()
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+# Distinguishes processes that reuse the pid of a previous one
+_process_id = None
+
+
+def get_metrics_dir():
+    return getattr(settings, 'PDF_METRICS_DIR', None)
+
+
+def _process_file(directory):
+    return os.path.join(directory, '%d-%s.json' % (os.getpid(), _process_id))
+
+
+def write_snapshot():
+    """Writes the values of this process to PDF_METRICS_DIR."""
+    directory = get_metrics_dir()
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(_registry.snapshot(), f)
+    os.replace(temp_path, _process_file(directory))
+
+
+def _flush_forever():
+    # Written even when no counter changed: the gauges and cache statistics
+    # are collected from the other modules
+    while True:
+        time.sleep(getattr(settings, 'PDF_METRICS_FLUSH_INTERVAL', 1))
+        try:
+            write_snapshot()
+        except (IOError, OSError) as ex:
+            log.warning("Can't write metrics: %s", ex)
+
+
+def start_flusher():
+    """Starts the thread writing the values of this process to
+    PDF_METRICS_DIR, once per process."""
+    # One thread per process: uwsgi forks workers after loading the application
+    global _flusher_pid, _process_id
+    if _flusher_pid == os.getpid() or not get_metrics_dir():
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            _process_id = uuid.uuid4().hex[:8]
+            thread = threading.Thread(target=_flush_forever, name='pdf-metrics')
+            thread.daemon = True
+            thread.start()
+            _flusher_pid = os.getpid()
+
+
+def inc(name, value=1, **labels):
+    """Adds ``value`` to the counter ``name``."""
+    start_flusher()
+    _registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    """Records ``value`` in the histogram ``name``."""
+    start_flusher()
+    _registry.observe(name, value, **labels)
+
+
+class timer(object):
+    """Context manager observing its duration in the histogram ``name``."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.time() - self.start, **self.labels)
+
+
+def timed_iter(name, iterable, **labels):
+    """Yields the items of ``iterable``, observing the time spent producing
+    them in the histogram ``name``."""
+    iterator = iter(iterable)
+    elapsed = 0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.time() - start
+            yield item
+    finally:
+        observe(name, elapsed, **labels)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def load_snapshots():
+    """Returns the snapshots of all processes (only this one's without
+    PDF_METRICS_DIR)."""
+    directory = get_metrics_dir()
+    if not directory:
+        return [_registry.snapshot()]
+    start_flusher()
+    write_snapshot()
+    snapshots = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshots.append(json.load(f))
+        except (IOError, OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in sorted(labels.items()))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshots):
+    """Returns the metrics of ``snapshots`` added up, in the Prometheus text
+    exposition format."""
+    values = {}
+    for snapshot in snapshots:
+        alive = snapshot['pid'] == os.getpid() or _alive(snapshot['pid'])
+        series = [(name, labels, value) for name, labels, value in snapshot['counters']]
+        if alive:
+            series.extend((name, labels, value) for name, labels, value in snapshot['gauges'])
+        for name, labels, value in series:
+            key = _key(name, labels)
+            values[key] = values.get(key, 0) + value
+        for name, labels, histogram in snapshot['histograms']:
+            key = _key(name, labels)
+            total = values.setdefault(key, [0] * len(histogram))
+            for index, value in enumerate(histogram):
+                total[index] += value
+
+    lines = []
+    for name in sorted(METRICS):
+        kind, help_text, buckets = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (series_name, labels), value in sorted(values.items()):
+            if series_name != name:
+                continue
+            labels = dict(labels)
+            if kind != 'histogram':
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + [float('inf')], value[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _format_labels(dict(labels, le=_format_value(bound))),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(value[-1])))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
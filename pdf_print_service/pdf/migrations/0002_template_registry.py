@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Template',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('owner', models.CharField(max_length=254)),
+                ('name', models.CharField(max_length=100)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ('owner', 'name'),
+            },
+        ),
+        migrations.CreateModel(
+            name='TemplateAsset',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('path', models.CharField(max_length=255)),
+                ('digest', models.CharField(max_length=64, db_index=True)),
+                ('size', models.PositiveIntegerField()),
+            ],
+            options={
+                'ordering': ('version', 'path'),
+            },
+        ),
+        migrations.CreateModel(
+            name='TemplateVersion',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('version', models.PositiveIntegerField()),
+                ('source', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('template', models.ForeignKey(related_name='versions', to='pdf.Template')),
+            ],
+            options={
+                'ordering': ('template', 'version'),
+            },
+        ),
+        migrations.AddField(
+            model_name='templateasset',
+            name='version',
+            field=models.ForeignKey(related_name='assets', to='pdf.TemplateVersion'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='template',
+            unique_together=set([('owner', 'name')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='templateversion',
+            unique_together=set([('template', 'version')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='templateasset',
+            unique_together=set([('version', 'path')]),
+        ),
+    ]
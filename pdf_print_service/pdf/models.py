@@ -1,3 +1,84 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class ConversionJob(models.Model):
+    """PDF conversion run in the background (see pdf.jobs)."""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.CharField(max_length=254, db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    params = models.TextField()
+    filename = models.CharField(max_length=255)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    # Last time a worker started converting it (see pdf.jobs.fail_stale_jobs)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    expires = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        ordering = ('created', )
+
+    def __str__(self):
+        return '%s (%s)' % (self.id, self.status)
+
+
+class Template(models.Model):
+    """Named template registered by a user (see pdf.registry)."""
+
+    owner = models.CharField(max_length=254)
+    name = models.CharField(max_length=100)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('owner', 'name')
+        unique_together = (('owner', 'name'), )
+
+    def __str__(self):
+        return '%s/%s' % (self.owner, self.name)
+
+
+class TemplateVersion(models.Model):
+    """Immutable source of a registered template."""
+
+    template = models.ForeignKey(Template, related_name='versions')
+    version = models.PositiveIntegerField()
+    source = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('template', 'version')
+        unique_together = (('template', 'version'), )
+
+    def __str__(self):
+        return '%s@%d' % (self.template, self.version)
+
+
+class TemplateAsset(models.Model):
+    """Static file (image, stylesheet, font) of a template version, stored on
+    disk by the SHA-256 of its content."""
+
+    version = models.ForeignKey(TemplateVersion, related_name='assets')
+    path = models.CharField(max_length=255)
+    digest = models.CharField(max_length=64, db_index=True)
+    size = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ('version', 'path')
+        unique_together = (('version', 'path'), )
+
+    def __str__(self):
+        return '%s:%s' % (self.version, self.path)
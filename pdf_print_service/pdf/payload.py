@@ -0,0 +1,120 @@
+"""Request bodies of the API, read within limits.
+
+Bodies may be compressed (``Content-Encoding: gzip`` or ``deflate``); they
+are decompressed as they are read. Bodies larger than ``PDF_MAX_BODY_SIZE``
+bytes as sent, or ``PDF_MAX_DATA_SIZE`` bytes once decompressed, are
+rejected with 413 before anything is parsed, other encodings with 415.
+
+JSON is parsed by ``PDF_JSON_PARSER`` ('orjson', 'ujson' or 'json'), by
+default the fastest one installed.
+"""
+import json
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Installed JSON parsers, fastest first
+JSON_PARSERS = OrderedDict((name, module.loads) for name, module in (
+    ('orjson', orjson),
+    ('ujson', ujson),
+    ('json', json),
+) if module is not None)
+
+DECOMPRESSORS = {
+    'gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'x-gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'deflate': lambda: zlib.decompressobj(zlib.MAX_WBITS),
+}
+
+
+class PayloadError(ValueError):
+    """Raised for a request body that can't be read, ``status`` being the
+    status code of the response."""
+
+    def __init__(self, message, status=400):
+        super(PayloadError, self).__init__(message)
+        self.status = status
+
+    def response(self):
+        return HttpResponse(str(self), status=self.status, content_type='text/plain')
+
+
+def read_body(request, chunk_size=64 * 1024):
+    """Returns the (decompressed) body of ``request``, also kept as
+    ``request.payload``. Raises PayloadError."""
+    max_body_size = getattr(settings, 'PDF_MAX_BODY_SIZE', None)
+    max_data_size = getattr(settings, 'PDF_MAX_DATA_SIZE', None)
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower() or 'identity'
+    if encoding == 'identity':
+        decompressor = None
+    elif encoding in DECOMPRESSORS:
+        decompressor = DECOMPRESSORS[encoding]()
+    else:
+        raise PayloadError("Unsupported Content-Encoding '%s'" % encoding, status=415)
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if max_body_size and length > max_body_size:
+        raise PayloadError("Request body is larger than %d bytes" % max_body_size, status=413)
+
+    size = 0
+    data = []
+    data_size = 0
+    while True:
+        chunk = request.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_body_size and size > max_body_size:
+            raise PayloadError("Request body is larger than %d bytes" % max_body_size, status=413)
+        if decompressor is not None:
+            try:
+                # Stops one byte past the limit: zip bombs aren't inflated
+                chunk = decompressor.decompress(chunk, max_data_size - data_size + 1 if max_data_size else 0)
+            except zlib.error as ex:
+                raise PayloadError("Invalid %s body: %s" % (encoding, ex))
+        data_size += len(chunk)
+        if max_data_size and data_size > max_data_size:
+            raise PayloadError("Request data is larger than %d bytes" % max_data_size, status=413)
+        data.append(chunk)
+    if decompressor is not None:
+        if not decompressor.eof:
+            raise PayloadError("Truncated %s body" % encoding)
+        data.append(decompressor.flush())
+
+    request.payload = b''.join(data)
+    return request.payload
+
+
+def get_json_parser():
+    """Returns the loads() function of the JSON parser to use."""
+    name = getattr(settings, 'PDF_JSON_PARSER', None)
+    if name is None:
+        return next(iter(JSON_PARSERS.values()))
+    if name not in JSON_PARSERS:
+        raise ValueError("JSON parser '%s' is not installed" % name)
+    return JSON_PARSERS[name]
+
+
+def read_params(request):
+    """Returns the JSON parameters sent in the body of ``request``. Raises
+    PayloadError."""
+    loads = get_json_parser()
+    body = read_body(request)
+    try:
+        return loads(body)
+    except ValueError as ex:
+        raise PayloadError("Invalid JSON: %s" % ex)
@@ -0,0 +1,185 @@
+"""Bounded pool limiting the number of concurrent PDF conversions.
+
+Conversions beyond ``PDF_POOL_MAX_CONCURRENT`` wait in a bounded queue
+(``PDF_POOL_QUEUE_SIZE``) for at most ``PDF_POOL_QUEUE_TIMEOUT`` seconds.
+When the queue is full, or the wait times out, :class:`PoolBusy` is raised
+so the view can answer with a fast 503 instead of piling up renderers.
+
+The queue is fair: a freed slot goes to a waiter of the highest priority
+class (``PDF_POOL_PRIORITIES``, e.g. interactive before bulk), and among
+them to the owner (user) running the fewest conversions, so that one client
+sending thousands of documents can't starve the others.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from pdf import metrics
+
+
+class PoolBusy(Exception):
+    """Raised when no conversion slot can be obtained."""
+
+
+class UnknownPriority(ValueError):
+    pass
+
+
+def get_priorities():
+    """Returns the names of the priority classes, highest first."""
+    return list(getattr(settings, 'PDF_POOL_PRIORITIES', None) or ['interactive', 'bulk'])
+
+
+def get_priority(name=None, owner=None, default=None):
+    """Returns the rank (0 for the highest) of the priority class ``name``
+    asked for by ``owner``, ``default`` standing for None.
+
+    Owners of ``PDF_POOL_USER_PRIORITIES`` get their class by default, and
+    can't ask for a higher one. Raises UnknownPriority.
+    """
+    priorities = get_priorities()
+    user_priority = getattr(settings, 'PDF_POOL_USER_PRIORITIES', {}).get(owner)
+    if name is None:
+        name = user_priority or default or priorities[0]
+    if name not in priorities:
+        raise UnknownPriority("Unknown priority '%s' (available: %s)" % (name, ', '.join(priorities)))
+    rank = priorities.index(name)
+    if user_priority in priorities:
+        rank = max(rank, priorities.index(user_priority))
+    return rank
+
+
+class _Waiter(object):
+    """A conversion waiting for a slot."""
+
+    def __init__(self, owner, priority, seq):
+        self.owner = owner
+        self.priority = priority
+        self.seq = seq
+        self.granted = False
+
+
+def next_waiter(waiters, running_by_owner):
+    """Returns the waiter of ``waiters`` to give the next slot to: the first
+    of the highest priority whose owner runs the fewest conversions."""
+    return min(waiters, key=lambda waiter: (waiter.priority, running_by_owner.get(waiter.owner, 0), waiter.seq))
+
+
+class ConversionPool(object):
+
+    def __init__(self, max_concurrent, queue_size=None, queue_timeout=None):
+        """
+        max_concurrent: Number of conversions allowed to run at once.
+        queue_size: Maximum number of waiting conversions (None: unbounded).
+        queue_timeout: Default number of seconds a conversion may wait for a
+                       free slot (None: wait forever).
+        """
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._running = 0
+        self._running_by_owner = {}
+        self._waiters = []
+        self._seq = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _start(self, owner):
+        self._running += 1
+        self._running_by_owner[owner] = self._running_by_owner.get(owner, 0) + 1
+
+    def acquire(self, timeout=None, owner=None, priority=0):
+        """Waits for a free slot, raises PoolBusy if none can be obtained.
+
+        timeout: Per-call queue timeout; it can only shorten the pool's
+                 default timeout.
+        owner: Who the conversion is for (e.g. a user name), to share the
+               slots fairly between owners.
+        priority: Rank of the priority class of the conversion (lower ranks
+                  first, see get_priority()).
+        """
+        if timeout is None or (self.queue_timeout is not None and timeout > self.queue_timeout):
+            timeout = self.queue_timeout
+
+        with self._cond:
+            if self._running < self.max_concurrent and not self._waiters:
+                self._start(owner)
+                return
+            if self.queue_size is not None and len(self._waiters) >= self.queue_size:
+                raise PoolBusy("conversion queue is full")
+
+            deadline = None if timeout is None else time.monotonic() + timeout
+            self._seq += 1
+            waiter = _Waiter(owner, priority, self._seq)
+            self._waiters.append(waiter)
+            while not waiter.granted:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._waiters.remove(waiter)
+                    raise PoolBusy("timed out waiting for a conversion slot")
+                self._cond.wait(remaining)
+
+    def release(self, owner=None):
+        """Frees the slot of a conversion of ``owner``, handing it over to the
+        next waiter."""
+        with self._cond:
+            self._running -= 1
+            count = self._running_by_owner.get(owner, 0) - 1
+            if count > 0:
+                self._running_by_owner[owner] = count
+            else:
+                self._running_by_owner.pop(owner, None)
+            if self._waiters and self._running < self.max_concurrent:
+                waiter = next_waiter(self._waiters, self._running_by_owner)
+                self._waiters.remove(waiter)
+                waiter.granted = True
+                self._start(waiter.owner)
+                self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, timeout=None, owner=None, priority=0):
+        """Context manager holding a conversion slot."""
+        self.acquire(timeout=timeout, owner=owner, priority=priority)
+        try:
+            yield
+        finally:
+            self.release(owner)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns the process-wide conversion pool, built from settings."""
+    global _pool
+    # Its gauges are written even by processes not counting anything yet
+    metrics.start_flusher()
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConversionPool(
+                    max_concurrent=getattr(settings, 'PDF_POOL_MAX_CONCURRENT', os.cpu_count() or 1),
+                    queue_size=getattr(settings, 'PDF_POOL_QUEUE_SIZE', 10),
+                    queue_timeout=getattr(settings, 'PDF_POOL_QUEUE_TIMEOUT', 30),
+                )
+    return _pool
+
+
+@receiver(setting_changed)
+def _reset_pool(setting, **kwargs):
+    global _pool
+    if setting.startswith('PDF_POOL_'):
+        _pool = None
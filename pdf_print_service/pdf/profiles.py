@@ -0,0 +1,32 @@
+"""Named render profiles trading fidelity for speed.
+
+A profile is a set of wkhtmltopdf options defined by the server in
+``WKHTMLTOPDF_PROFILES`` (image resolution and quality, JavaScript, error
+handling...); requests pick one by name with the ``profile`` parameter, or
+get ``WKHTMLTOPDF_DEFAULT_PROFILE``. The options of the request itself
+(headers, footers, URL options) override those of the profile.
+
+The pdf_profile_benchmark command measures the time and size of each one.
+"""
+from django.conf import settings
+
+
+class UnknownProfile(ValueError):
+    pass
+
+
+def get_profiles():
+    return getattr(settings, 'WKHTMLTOPDF_PROFILES', None) or {}
+
+
+def get_profile_options(name=None):
+    """Returns the wkhtmltopdf options of the profile ``name`` (None for the
+    default one). Raises UnknownProfile."""
+    profiles = get_profiles()
+    if name is None:
+        name = getattr(settings, 'WKHTMLTOPDF_DEFAULT_PROFILE', None)
+        if name is None:
+            return {}
+    if not isinstance(name, str) or name not in profiles:
+        raise UnknownProfile("Unknown profile '%s' (available: %s)" % (name, ', '.join(sorted(profiles))))
+    return dict(profiles[name])
@@ -0,0 +1,116 @@
+"""Per-user rate limits of conversion requests.
+
+Each user has a token bucket refilled at ``rate`` requests per second up to
+``burst`` requests, configured in ``PDF_RATE_LIMITS`` by user name, ``'*'``
+applying to the users not listed (a None limit means unlimited). A request
+finding the bucket of its user empty is answered with 429 and a Retry-After
+header telling when a token will be available.
+
+Buckets live in the memory of each process: with several processes, a user
+can send up to ``rate`` requests per second to each of them.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, cost=1):
+        """Takes ``cost`` tokens, returns 0 or the seconds to wait for them
+        (nothing being taken then)."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        if not self.rate:
+            return float('inf')
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """Token buckets of the users, the least recently used beyond
+    ``max_users`` being dropped."""
+
+    def __init__(self, limits, max_users=10000):
+        self.limits = limits
+        self.max_users = max_users
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_limit(self, user):
+        """Returns the (rate, burst) limit of ``user``, or None."""
+        return self.limits.get(user, self.limits.get('*'))
+
+    def check(self, user, cost=1):
+        """Returns 0 if ``user`` may send a request, or the seconds to wait."""
+        limit = self.get_limit(user)
+        if limit is None:
+            return 0
+        with self._lock:
+            bucket = self._buckets.get(user)
+            if bucket is None:
+                bucket = self._buckets[user] = TokenBucket(*limit)
+                while len(self._buckets) > self.max_users:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(user)
+            return bucket.take(cost)
+
+
+# request.META key of the requests already counted, e.g. by the ASGI
+# application before handing them to the WSGI one
+CHECKED_KEY = 'pdf.rate_limit_checked'
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Returns the process-wide rate limiter, or None without limits."""
+    global _limiter
+    limits = getattr(settings, 'PDF_RATE_LIMITS', None)
+    if not limits:
+        return None
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(limits)
+    return _limiter
+
+
+def rate_limit_response(request):
+    """Returns a 429 response if the user of ``request`` sent too many
+    requests, None otherwise."""
+    limiter = get_rate_limiter()
+    if limiter is None or request.META.get(CHECKED_KEY):
+        return None
+    request.META[CHECKED_KEY] = True
+    wait = limiter.check(request.user.get_username())
+    if not wait:
+        return None
+    response = HttpResponse("Too many requests, retry in %.1f seconds" % wait, status=429,
+                            content_type='text/plain')
+    response['Retry-After'] = str(int(math.ceil(min(wait, 24 * 3600))))
+    return response
+
+
+@receiver(setting_changed)
+def _reset_limiter(setting, **kwargs):
+    global _limiter
+    if setting.startswith('PDF_RATE_'):
+        _limiter = None
@@ -0,0 +1,203 @@
+"""Templates registered by name, so that requests only send their data.
+
+Each upload of a template creates a new immutable version, compiled at
+upload time, with its static files (assets) stored on disk in
+``PDF_TEMPLATES_DIR`` by the SHA-256 of their content; files not sent with a
+version are inherited from the previous one. Templates reach them through the
+``assets`` variable, a dict of their paths to file:// URLs.
+
+Workers keep the versions they render in memory (at most
+``PDF_TEMPLATES_CACHE_SIZE``) by their primary key, which a template deleted
+then registered again doesn't reuse; only that key is looked up in the
+database for each request.
+"""
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.dispatch import receiver
+
+from pdf.jinja import get_template
+from pdf.models import Template, TemplateAsset, TemplateVersion
+from pdf.wkhtmltopdf import pathname2fileurl
+
+NAME_PATTERN = r'[A-Za-z0-9][A-Za-z0-9_.-]{0,99}'
+
+RegisteredTemplate = namedtuple('RegisteredTemplate', 'name version source assets')
+
+
+class TemplateNotFound(LookupError):
+    pass
+
+
+def get_templates_dir():
+    return getattr(settings, 'PDF_TEMPLATES_DIR', os.path.join(tempfile.gettempdir(), 'pdf-templates'))
+
+
+def asset_file(digest, path):
+    """Returns the file holding the asset of SHA-256 ``digest`` uploaded as
+    ``path`` (whose extension is kept, for the renderer)."""
+    extension = posixpath.splitext(path)[1][:10]
+    return os.path.join(get_templates_dir(), 'assets', digest[:2], digest + extension)
+
+
+def validate_asset_path(path):
+    """Raises ValueError unless ``path`` is a relative path without '..'."""
+    parts = path.split('/')
+    if not path or len(path) > 255 or path.startswith('/') or '\\' in path \
+            or any(part in ('', '.', '..') for part in parts):
+        raise ValueError("Invalid asset path '%s'" % path)
+
+
+def store_asset(content, path):
+    """Writes ``content`` (bytes) to disk and returns its digest."""
+    digest = hashlib.sha256(content).hexdigest()
+    filename = asset_file(digest, path)
+    if not os.path.exists(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, filename)
+    return digest
+
+
+def create_version(owner, name, source, assets=None):
+    """Registers ``source`` as the next version of the template ``name`` of
+    ``owner`` with ``assets`` (dict of paths to bytes) and returns the
+    TemplateVersion.
+
+    Raises ValueError for invalid names or paths, and
+    jinja2.TemplateSyntaxError for invalid sources.
+    """
+    if not re.match(r'^%s$' % NAME_PATTERN, name):
+        raise ValueError("Invalid template name '%s'" % name)
+    assets = assets or {}
+    for path in assets:
+        validate_asset_path(path)
+    # Compiles the template (into the bytecode cache too, for the other workers)
+    get_template(source)
+    files = dict((path, (store_asset(content, path), len(content))) for path, content in assets.items())
+
+    for attempt in range(3):
+        try:
+            with transaction.atomic():
+                template, created = Template.objects.get_or_create(owner=owner, name=name)
+                previous = template.versions.order_by('-version').first()
+                version = TemplateVersion.objects.create(
+                    template=template, version=previous.version + 1 if previous else 1, source=source)
+                if previous is not None:
+                    for asset in previous.assets.exclude(path__in=list(files)):
+                        files[asset.path] = (asset.digest, asset.size)
+                TemplateAsset.objects.bulk_create(
+                    TemplateAsset(version=version, path=path, digest=digest, size=size)
+                    for path, (digest, size) in files.items())
+            return version
+        except IntegrityError:
+            # Another upload of the same template took the version number
+            if attempt == 2:
+                raise
+
+
+def delete_template(owner, name):
+    """Deletes the template ``name`` of ``owner`` with its versions and the
+    asset files no other template uses. Raises TemplateNotFound."""
+    try:
+        template = Template.objects.get(owner=owner, name=name)
+    except Template.DoesNotExist:
+        raise TemplateNotFound("Template '%s' not found" % name)
+    assets = list(TemplateAsset.objects.filter(version__template=template).values_list('digest', 'path'))
+    template.delete()
+    used = set(TemplateAsset.objects.filter(digest__in=[digest for digest, path in assets])
+               .values_list('digest', flat=True))
+    for digest, path in assets:
+        if digest not in used:
+            try:
+                os.unlink(asset_file(digest, path))
+            except OSError:
+                pass
+
+
+class VersionCache(object):
+    """LRU of the registered templates rendered by this process, versions
+    being immutable."""
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self._versions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, version_id):
+        """Returns the RegisteredTemplate of the TemplateVersion of primary key
+        ``version_id``."""
+        with self._lock:
+            registered = self._versions.get(version_id)
+            if registered is not None:
+                self._versions.move_to_end(version_id)
+                return registered
+
+        template_version = TemplateVersion.objects.select_related('template').get(pk=version_id)
+        registered = RegisteredTemplate(
+            name=template_version.template.name, version=template_version.version, source=template_version.source,
+            assets=dict((asset.path, pathname2fileurl(asset_file(asset.digest, asset.path)))
+                        for asset in template_version.assets.all()))
+        # Compiled once per process
+        get_template(registered.source)
+        with self._lock:
+            self._versions[version_id] = registered
+            while len(self._versions) > self.max_size:
+                self._versions.popitem(last=False)
+        return registered
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_version_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = VersionCache(getattr(settings, 'PDF_TEMPLATES_CACHE_SIZE', 100))
+    return _cache
+
+
+def get_registered_template(owner, name, version=None):
+    """Returns the RegisteredTemplate of the ``version`` (None for the latest)
+    of the template ``name`` of ``owner``. Raises TemplateNotFound."""
+    # Also tells whether the version still exists
+    versions = TemplateVersion.objects.filter(template__owner=owner, template__name=name)
+    if version is not None:
+        versions = versions.filter(version=version)
+    version_id = versions.order_by('-version').values_list('pk', flat=True).first()
+    if version_id is None:
+        if version is None:
+            raise TemplateNotFound("Template '%s' not found" % name)
+        raise TemplateNotFound("Version %s of template '%s' not found" % (version, name))
+    return get_version_cache().get(version_id)
+
+
+def describe_version(version):
+    """Returns the JSON-serializable description of a TemplateVersion."""
+    return {
+        'name': version.template.name,
+        'version': version.version,
+        'created': version.created.isoformat(),
+        'assets': dict((asset.path, {'size': asset.size, 'sha256': asset.digest})
+                       for asset in version.assets.all()),
+    }
+
+
+@receiver(setting_changed)
+def _reset_cache(setting, **kwargs):
+    global _cache
+    if setting.startswith('PDF_TEMPLATES_'):
+        _cache = None
@@ -0,0 +1,126 @@
+"""Large documents written to disk instead of memory.
+
+When ``PDF_SPOOL_ENABLED`` is set, wkhtmltopdf writes the documents of /pdf
+to a file of ``PDF_SPOOL_DIR`` (its ``output`` argument). Documents smaller
+than ``PDF_SPOOL_THRESHOLD`` bytes are read back and answered as usual; the
+bigger ones never enter the worker's memory: the response hands the file
+over to nginx (``X-Accel-Redirect`` to ``PDF_SPOOL_ACCEL_REDIRECT`` followed
+by the file name, an ``internal`` location aliasing ``PDF_SPOOL_DIR``), or
+is a FileResponse that the WSGI server sends with sendfile().
+
+The files may be shared by coalesced requests and are read by nginx after
+the response, so they are deleted after ``PDF_SPOOL_TTL`` seconds.
+"""
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from pdf.wkhtmltopdf import FilePDFResponse, PDFResponse
+
+
+class SpooledPDF(object):
+    """A document left in the spool."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class Spool(object):
+
+    def __init__(self, directory, threshold=10 * 1024 * 1024, ttl=600, accel_redirect=None):
+        self.directory = directory
+        self.threshold = threshold
+        self.ttl = ttl
+        self.accel_redirect = accel_redirect
+        self._last_sweep = 0
+        self._lock = threading.Lock()
+
+    def create(self):
+        """Returns the path of a new empty file of the spool."""
+        self.sweep_if_due()
+        os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.pdf')
+        os.close(fd)
+        return path
+
+    def collect(self, path):
+        """Returns the document written to ``path``: bytes (the file being
+        deleted) below the threshold, a SpooledPDF otherwise."""
+        size = os.path.getsize(path)
+        if size >= self.threshold:
+            return SpooledPDF(path, size)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.unlink(path)
+
+    def response(self, spooled, filename=None, show_content_in_browser=None):
+        """Returns the response sending the SpooledPDF ``spooled``."""
+        if self.accel_redirect:
+            response = PDFResponse(b'', filename=filename, show_content_in_browser=show_content_in_browser)
+            response['X-Accel-Redirect'] = self.accel_redirect + os.path.basename(spooled.path)
+            return response
+        response = FilePDFResponse(open(spooled.path, 'rb'), filename=filename,
+                                   show_content_in_browser=show_content_in_browser)
+        response['Content-Length'] = str(spooled.size)
+        return response
+
+    def sweep_if_due(self):
+        with self._lock:
+            if time.time() - self._last_sweep < min(self.ttl, 60):
+                return
+            self._last_sweep = time.time()
+        self.sweep()
+
+    def sweep(self):
+        """Deletes the files older than ``ttl`` seconds."""
+        expired = time.time() - self.ttl
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < expired:
+                    os.unlink(path)
+            except OSError:
+                continue
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    """Returns the process-wide spool, or None if spooling is disabled."""
+    global _spool
+    if not getattr(settings, 'PDF_SPOOL_ENABLED', False):
+        return None
+    if _spool is None:
+        with _spool_lock:
+            if _spool is None:
+                _spool = Spool(
+                    getattr(settings, 'PDF_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'pdf-spool')),
+                    threshold=getattr(settings, 'PDF_SPOOL_THRESHOLD', 10 * 1024 * 1024),
+                    ttl=getattr(settings, 'PDF_SPOOL_TTL', 600),
+                    accel_redirect=getattr(settings, 'PDF_SPOOL_ACCEL_REDIRECT', None),
+                )
+    return _spool
+
+
+@receiver(setting_changed)
+def _reset_spool(setting, **kwargs):
+    global _spool
+    if setting.startswith('PDF_SPOOL_'):
+        _spool = None
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Stand-in for wkhtmltopdf in benchmarks and load tests.
+
+Usage: stub_wkhtmltopdf.py [--stub-latency SECONDS] [--stub-size BYTES]
+                           [wkhtmltopdf options...] page... output
+
+Reads the pages ('-' being the standard input) like wkhtmltopdf would,
+waits ``--stub-latency`` seconds, then writes a PDF-looking document of
+``--stub-size`` bytes to ``output`` ('-' for the standard output). Other
+options are ignored.
+"""
+import argparse
+import sys
+import time
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stub-latency', type=float, default=0)
+    parser.add_argument('--stub-size', type=int, default=10 * 1024)
+    options, args = parser.parse_known_args(argv)
+    # The last arguments not starting with '-' (or '-' itself) are the pages and the output
+    positional = [arg for arg in args if arg == '-' or not arg.startswith('-')]
+    pages, output = positional[:-1], positional[-1] if positional else '-'
+
+    for page in pages:
+        if page == '-':
+            sys.stdin.buffer.read()
+        elif '://' not in page:
+            try:
+                with open(page, 'rb') as f:
+                    f.read()
+            except IOError:
+                pass
+    time.sleep(options.stub_latency)
+
+    header = b'%PDF-1.4\n'
+    trailer = b'\n%%EOF\n'
+    content = header + b'0' * max(0, options.stub_size - len(header) - len(trailer)) + trailer
+    if output == '-':
+        sys.stdout.buffer.write(content)
+    else:
+        with open(output, 'wb') as f:
+            f.write(content)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
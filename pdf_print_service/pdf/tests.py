@@ -1,8 +1,58 @@
-from django.test import TestCase
+import asyncio
+import base64
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import authenticate
+from django.core.wsgi import get_wsgi_application
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
 
 # Create your tests here.
-from pdf.wkhtmltopdf import _options_to_args
+import jinja2
+
+from pdf.asgi import ASGIApplication
+from pdf.assets import AssetCache
+from pdf.backends import FAKE_PDF, BackendError, get_backend
+from pdf.benchmarks import client_sender, default_load_settings, load_test_body, percentile, run_load_level, \
+    stub_command
+from pdf.cache import DiskCache, MemoryCache
+from pdf.coalesce import SingleFlight
+from pdf.fragments import FragmentCache
+from pdf.jinja import TemplateCache
+from pdf.jobs import fail_stale_jobs, run_job
+from pdf.logs import BackgroundHandler, describe_payload
+from pdf.metrics import render as render_metrics
+from pdf.models import ConversionJob
+from pdf.payload import read_params
+from pdf.pool import ConversionPool, PoolBusy, get_pool
+from pdf.registry import create_version
+from pdf.warm import WarmRendererPool, WarmUnsupported, translate_options
+from pdf.warmup import WarmUp
+from pdf.wkhtmltopdf import OutputTooLarge, _options_to_args, iter_absolute_paths, make_absolute_paths, wkhtmltopdf, \
+    wkhtmltopdf_stream
+
+
+def python_command(code):
+    """Returns a WKHTMLTOPDF_CMD running ``code`` instead of wkhtmltopdf."""
+    return '%s -c %s' % (shlex.quote(sys.executable), shlex.quote(code))
 
 
 class WkHtmlToPdfTestCase(TestCase):
@@ -19,3 +69,926 @@ class WkHtmlToPdfTestCase(TestCase):
                                  boolean_param=True,
                                  removed_param=None
                              ))
+
+
+class WkHtmlToPdfStreamTestCase(TestCase):
+    @override_settings(WKHTMLTOPDF_CMD=python_command(
+        "import sys; sys.stdout.buffer.write(b'%PDF' + b'x' * 100000)"))
+    def test_stream(self):
+        closed = []
+        stream = wkhtmltopdf_stream(pages=['page.html'], buffer_size=10, chunk_size=4096)
+        stream.add_close_callback(lambda: closed.append(True))
+        content = b''.join(stream)
+        stream.close()
+        self.assertEqual(b'%PDF' + b'x' * 100000, content)
+        self.assertEqual([True], closed)
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command(
+        "import sys; sys.stderr.write('ContentNotFoundError'); sys.exit(1)"))
+    def test_early_error(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            wkhtmltopdf_stream(pages=['page.html'])
+        self.assertEqual(b'ContentNotFoundError', cm.exception.stderr)
+
+
+class WkHtmlToPdfInputTestCase(TestCase):
+    def test_iter_absolute_paths(self):
+        content = ''.join('<img src="/static/img/%d.png"> <a href=\'/static/%d\'>\n' % (i, i) for i in range(50))
+        chunks = [content[i:i + 7] for i in range(0, len(content), 7)]
+        self.assertEqual(make_absolute_paths(content), ''.join(iter_absolute_paths(chunks, buffer_size=16)))
+        self.assertIn('file://', make_absolute_paths(content))
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import sys; sys.stdout.buffer.write(sys.stdin.buffer.read())"))
+    def test_input(self):
+        self.assertEqual(b'<html></html>', wkhtmltopdf(pages=['-'], input=iter([b'<html>', b'</html>'])))
+
+        def failing_input():
+            yield b'<html>'
+            raise ValueError("rendering failed")
+        self.assertRaises(ValueError, wkhtmltopdf, pages=['-'], input=failing_input())
+
+
+class WkHtmlToPdfLimitsTestCase(TestCase):
+    @override_settings(WKHTMLTOPDF_CMD=python_command(
+        "import subprocess, sys, time; subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)']); "
+        "time.sleep(30)"))
+    def test_timeout_kills_process_group(self):
+        start = time.monotonic()
+        self.assertRaises(subprocess.TimeoutExpired, wkhtmltopdf, pages=['page.html'], timeout=0.5)
+        # The grandchild holding stdout open was killed too
+        self.assertLess(time.monotonic() - start, 10)
+
+    @override_settings(WKHTMLTOPDF_MEMORY_LIMIT=2 ** 33, WKHTMLTOPDF_CMD=python_command(
+        "import resource, sys, time; time.sleep(0.5); sys.stdout.write(str(resource.getrlimit(resource.RLIMIT_AS)[0]))"))
+    def test_memory_limit(self):
+        self.assertEqual(str(2 ** 33).encode(), wkhtmltopdf(pages=['page.html']))
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import sys; sys.stdout.buffer.write(b'x' * 100000)"))
+    def test_max_output_size(self):
+        self.assertRaises(OutputTooLarge, wkhtmltopdf, pages=['page.html'], max_output_size=1000)
+        self.assertEqual(100000, len(wkhtmltopdf(pages=['page.html'], max_output_size=100000)))
+
+
+# Render worker answering with its pid, or a 404 for 'missing.html'
+FAKE_RENDER_WORKER = """
+import json, os, sys
+sys.stdout.buffer.write(b'{"ready": true}\\n')
+sys.stdout.buffer.flush()
+for line in sys.stdin.buffer:
+    request = json.loads(line.decode())
+    html = sys.stdin.buffer.read(request['html_size'])
+    pdf = str(os.getpid()).encode() + html
+    ok = 'missing.html' not in request['pages']
+    reply = {'ok': ok, 'size': len(pdf) if ok else 0, 'errors': ['Failed'],
+             'http_error_code': 0 if ok else 404, 'rss': 1000}
+    sys.stdout.buffer.write(json.dumps(reply).encode() + b'\\n' + (pdf if ok else b''))
+    sys.stdout.buffer.flush()
+"""
+
+
+class WarmRendererTestCase(TestCase):
+    def setUp(self):
+        self.pool = WarmRendererPool([sys.executable, '-c', FAKE_RENDER_WORKER], size=2, max_jobs=2)
+        self.addCleanup(self.pool.close)
+
+    def test_translate_options(self):
+        self.assertEqual(({'orientation': 'Landscape'},
+                          {'web.printMediaType': 'true', 'web.defaultEncoding': 'utf8'}),
+                         translate_options({'orientation': 'Landscape', 'print_media_type': True,
+                                            'encoding': 'utf8', 'quiet': True, 'cookie': None}))
+        self.assertRaises(WarmUnsupported, translate_options, {'cookie': [('name', 'value')]})
+        self.assertRaises(WarmUnsupported, translate_options, {'print-media-type': 'yes'})
+
+    def test_workers_are_reused_then_recycled(self):
+        first = self.pool.render(['page.html'])
+        self.assertEqual(first, self.pool.render(['page.html']))
+        self.assertNotEqual(first, self.pool.render(['page.html']))
+
+    def test_input(self):
+        self.assertTrue(self.pool.render(['-'], input=iter([b'<html>', b'</html>'])).endswith(b'<html></html>'))
+
+    def test_error(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            self.pool.render(['missing.html'])
+        self.assertIn(b'ContentNotFoundError', cm.exception.stderr)
+        self.assertRaises(WarmUnsupported, self.pool.render, ['page.html'], cookie=[('name', 'value')])
+
+    def test_startup_failure(self):
+        pool = WarmRendererPool([sys.executable, '-c', 'import sys; sys.exit(3)'], size=1)
+        input = iter([b'<html></html>'])
+        with self.assertRaises(WarmUnsupported) as cm:
+            pool.render(['-'], input=input)
+        self.assertIn('code 3', str(cm.exception))
+        self.assertEqual([b'<html></html>'], list(input))
+        with mock.patch('pdf.warm.WarmWorker') as worker:
+            self.assertRaises(WarmUnsupported, pool.start)
+        self.assertEqual(0, worker.call_count)
+
+
+class MetricsTestCase(TestCase):
+    def test_render_adds_up_processes(self):
+        dead_pid = subprocess.Popen([sys.executable, '-c', '']).pid
+        os.waitpid(dead_pid, 0)
+        snapshots = [
+            {'pid': os.getpid(), 'counters': [['pdf_requests_total', {'view': 'pdf', 'outcome': 'ok'}, 2]],
+             'gauges': [['pdf_conversions_in_flight', {}, 1]],
+             'histograms': [['pdf_output_bytes', {}, [1, 0, 0, 0, 0, 0, 0, 500]]]},
+            {'pid': dead_pid, 'counters': [['pdf_requests_total', {'view': 'pdf', 'outcome': 'ok'}, 3]],
+             'gauges': [['pdf_conversions_in_flight', {}, 4]],
+             'histograms': [['pdf_output_bytes', {}, [0, 1, 0, 0, 0, 0, 1, 10 ** 9]]]},
+        ]
+        text = render_metrics(snapshots)
+        self.assertIn('pdf_requests_total{outcome="ok",view="pdf"} 5\n', text)
+        self.assertIn('pdf_conversions_in_flight 1\n', text)
+        self.assertIn('pdf_output_bytes_bucket{le="10240"} 2\n', text)
+        self.assertIn('pdf_output_bytes_bucket{le="+Inf"} 3\n', text)
+        self.assertIn('pdf_output_bytes_count 3\n', text)
+
+    def test_gauges_are_written_without_counters(self):
+        def render_files(directory):
+            snapshots = []
+            for name in os.listdir(directory):
+                if name.endswith('.json'):
+                    with open(os.path.join(directory, name)) as f:
+                        snapshots.append(json.load(f))
+            return render_metrics(snapshots)
+
+        def wait_for(text, directory):
+            deadline = time.monotonic() + 10
+            while text not in render_files(directory) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertIn(text, render_files(directory))
+
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(PDF_METRICS_DIR=directory, PDF_METRICS_FLUSH_INTERVAL=0.05):
+            pool = get_pool()
+            pool.acquire()
+            try:
+                wait_for('pdf_conversions_in_flight 1\n', directory)
+            finally:
+                pool.release()
+            wait_for('pdf_conversions_in_flight 0\n', directory)
+
+
+class RequestLogTestCase(TestCase):
+    @override_settings(PDF_LOG_PAYLOAD_MAX_CHARS=10, PDF_LOG_PAYLOAD_SAMPLE_RATE=0)
+    def test_describe_payload(self):
+        fields = describe_payload(b'{"template": "' + b'x' * 10000 + b'"}')
+        self.assertEqual(10016, fields['size'])
+        self.assertEqual('{"template...', fields['excerpt'])
+        self.assertNotIn('body', fields)
+        with self.settings(PDF_LOG_PAYLOAD_SAMPLE_RATE=1):
+            self.assertEqual('{}', describe_payload(b'{}')['body'])
+
+    def test_background_handler(self):
+        target = logging.handlers.BufferingHandler(100)
+        target.name = 'test-target'
+        self.addCleanup(target.close)
+        handler = BackgroundHandler(['test-target'], queue_size=100)
+        logger = logging.getLogger('pdf.tests.background')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.warning("Hello %s", 'World')
+        handler.close()
+        self.assertEqual(['Hello World'], [record.getMessage() for record in target.buffer])
+
+        handler = BackgroundHandler(['test-target'], queue_size=1)
+        handler.enqueue(logging.makeLogRecord({}))
+        handler.enqueue(logging.makeLogRecord({}))
+        self.assertEqual(1, handler.dropped)
+
+
+class BenchmarkTestCase(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 95), 3)
+
+    @override_settings(WKHTMLTOPDF_CMD=stub_command(size=5000))
+    def test_stub_renderer(self):
+        pdf = wkhtmltopdf(['-'], input=[b'<html></html>'])
+        self.assertEqual(len(pdf), 5000)
+        self.assertTrue(pdf.startswith(b'%PDF-'))
+
+    def test_load_level(self):
+        overrides = default_load_settings(latency=0, size=1000, max_concurrent=2)
+        overrides['PDF_API_KEYS'] = {'bench': hashlib.sha256(b'secret').hexdigest()}
+        with override_settings(**overrides):
+            result = run_load_level(client_sender('bench', 'secret'), '/pdf/', load_test_body(rows=5),
+                                    concurrency=2, requests=4)
+        self.assertEqual(result['ok'], 4)
+        self.assertGreater(result['throughput'], 0)
+        self.assertLessEqual(result['p50'], result['p99'])
+
+
+class SingleFlightTestCase(TestCase):
+    def run_concurrently(self, flights, func, count=5):
+        results = []
+
+        def target():
+            try:
+                results.append(flights.run('key', func, shared_errors=(subprocess.CalledProcessError,)))
+            except subprocess.CalledProcessError as ex:
+                results.append(ex)
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_calls_share_one_run(self):
+        calls = []
+
+        def render():
+            calls.append(1)
+            time.sleep(0.2)
+            return b'%PDF-1.4'
+        self.assertEqual([b'%PDF-1.4'] * 5, self.run_concurrently(SingleFlight(), render))
+        self.assertEqual(1, len(calls))
+
+        def fail():
+            time.sleep(0.2)
+            raise subprocess.CalledProcessError(1, 'wkhtmltopdf')
+        results = self.run_concurrently(SingleFlight(), fail)
+        self.assertEqual(1, len(set(map(id, results))))
+
+    def test_result_shared_between_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            flights = SingleFlight(directory)
+            # Another open file description of the lock stands for another process
+            with open(os.path.join(directory, 'key.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                results = []
+                thread = threading.Thread(target=lambda: results.append(flights.run('key', lambda: b'own')))
+                thread.start()
+                while not os.path.exists(os.path.join(directory, 'key.wait')):
+                    time.sleep(0.01)
+                flights._write_result('key', b'shared')
+            thread.join()
+            self.assertEqual([b'shared'], results)
+            self.assertEqual(b'own', flights.run('key', lambda: b'own'))
+            self.assertFalse(os.path.exists(os.path.join(directory, 'key.lock')))
+
+    def test_deleted_lock_is_not_taken(self):
+        with tempfile.TemporaryDirectory() as directory:
+            flights = SingleFlight(directory)
+            path = os.path.join(directory, 'key.lock')
+            calls = []
+            results = []
+            with open(path, 'a') as old_lock:
+                fcntl.flock(old_lock, fcntl.LOCK_EX)
+                thread = threading.Thread(target=lambda: results.append(flights.run('key', lambda: calls.append(1))))
+                thread.start()
+                while not os.path.exists(os.path.join(directory, 'key.wait')):
+                    time.sleep(0.01)
+                # The holder deletes its lock, another process locks a new one
+                os.unlink(path)
+                new_lock = open(path, 'a')
+                fcntl.flock(new_lock, fcntl.LOCK_EX)
+            time.sleep(0.2)
+            self.assertEqual([], calls)
+            flights._write_result('key', b'shared')
+            new_lock.close()
+            thread.join()
+            self.assertEqual([b'shared'], results)
+
+
+class ASGITestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.application = ASGIApplication(get_wsgi_application(), threads=4)
+        self.authorization = b'Basic ' + base64.b64encode(b'client:secret')
+        self.settings_override = override_settings(
+            PDF_API_KEYS={'client': hashlib.sha256(b'secret').hexdigest()}, ALLOWED_HOSTS=['localhost'])
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.application.executor.shutdown()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    async def call(self, method, path, body=b''):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            messages.append(message)
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+                 'headers': [(b'host', b'localhost'), (b'authorization', self.authorization),
+                             (b'content-type', b'application/json')]}
+        await self.application(scope, receive, send)
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    def post(self, *params_list):
+        calls = [self.call('POST', '/pdf', json.dumps(params).encode()) for params in params_list]
+        return self.loop.run_until_complete(asyncio.gather(*calls))
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command(
+        "import sys, time; time.sleep(0.5); sys.stdout.buffer.write(sys.stdin.buffer.read())"),
+        PDF_ASYNC_MAX_CONCURRENT=4)
+    def test_concurrent_conversions(self):
+        start = time.time()
+        results = self.post(*[{'template': 'Hello {{ name }}', 'data': {'name': i}} for i in range(4)])
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual([(200, ('Hello %d' % i).encode()) for i in range(4)], results)
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import sys; sys.stderr.write('oops'); sys.exit(1)"))
+    def test_errors(self):
+        (status, content), = self.post({'template': 'Hello', 'data': {}})
+        self.assertEqual(500, status)
+        self.assertIn(b'oops', content)
+        self.authorization = b'Basic ' + base64.b64encode(b'client:wrong')
+        self.assertEqual(401, self.post({'template': 'Hello', 'data': {}})[0][0])
+        self.authorization = b'Basic ' + base64.b64encode(b'client:secret')
+        (status, content), (body_status, _) = self.post(
+            {'template': 'Hello', 'data': {}, 'header': '{{ title.text.value }}'},
+            {'template': '{{ title.text.value }}', 'data': {}})
+        self.assertEqual((400, 400), (status, body_status))
+        self.assertIn(b'Template error', content)
+
+    @override_settings(PDF_BACKENDS={'wkhtmltopdf': 'pdf.backends.WkhtmltopdfBackend',
+                                     'fake': 'pdf.backends.FakeBackend'},
+                       PDF_RATE_LIMITS={'*': (0, 1)})
+    def test_rejected_before_parsing(self):
+        with mock.patch('pdf.asgi.read_params', wraps=read_params) as parse:
+            # Handed to the WSGI application, counted once by the rate limiter
+            self.assertEqual((200, FAKE_PDF), self.post({'template': 'Hello', 'data': {}, 'backend': 'fake'})[0])
+            self.assertEqual(1, parse.call_count)
+            self.assertEqual(429, self.post({'template': 'Hello', 'data': {}})[0][0])
+            self.authorization = b'Basic ' + base64.b64encode(b'client:wrong')
+            self.assertEqual(401, self.post({'template': 'Hello', 'data': {}})[0][0])
+            self.assertEqual(1, parse.call_count)
+
+    def test_other_requests_use_wsgi(self):
+        status, content = self.loop.run_until_complete(self.call('GET', '/metrics'))
+        self.assertEqual(200, status)
+        self.assertIn(b'pdf_requests_total', content)
+
+
+class ConversionPoolTestCase(TestCase):
+    def test_rejects_when_queue_is_full(self):
+        pool = ConversionPool(max_concurrent=1, queue_size=0)
+        pool.acquire()
+        self.assertRaises(PoolBusy, pool.acquire)
+        pool.release()
+        with pool.slot():
+            self.assertEqual(1, pool.running)
+        self.assertEqual(0, pool.running)
+
+    def test_queue_timeout(self):
+        pool = ConversionPool(max_concurrent=1, queue_size=1, queue_timeout=10)
+        pool.acquire()
+        self.assertRaises(PoolBusy, pool.acquire, timeout=0.01)
+        self.assertEqual(0, pool.waiting)
+
+    def test_fair_share(self):
+        pool = ConversionPool(max_concurrent=2)
+        pool.acquire(owner='bulk')
+        pool.acquire(owner='bulk')
+        order = []
+
+        def wait(owner, priority):
+            pool.acquire(owner=owner, priority=priority)
+            order.append(owner)
+
+        threads = []
+        for owner, priority in (('bulk', 0), ('low', 1), ('user', 0)):
+            threads.append(threading.Thread(target=wait, args=(owner, priority)))
+            threads[-1].start()
+            while pool.waiting < len(threads):
+                time.sleep(0.001)
+        for owner in ('bulk', 'bulk', 'user'):
+            count = len(order)
+            pool.release(owner)
+            while len(order) == count:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        # The user running nothing goes first, the low priority last
+        self.assertEqual(['user', 'bulk', 'low'], order)
+
+
+class ResultCacheTestCase(TestCase):
+    def test_memory_cache_is_bounded_by_size(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.set('a', b'12345', ttl=60)
+        cache.set('b', b'12345', ttl=60)
+        cache.get('a')
+        cache.set('c', b'12345', ttl=60)
+        self.assertEqual(b'12345', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(10, cache.size)
+
+    def test_disk_cache_expiry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(directory)
+            cache.set('abcdef', b'%PDF', ttl=60)
+            expires, content = cache.get('abcdef')
+            self.assertEqual(b'%PDF', content)
+            cache.set('abcdef', b'%PDF', ttl=60)
+            path = cache._path('abcdef')
+            os.utime(path, (time.time() - 1, time.time() - 1))
+            self.assertIsNone(cache.get('abcdef'))
+            self.assertFalse(os.path.exists(path))
+
+    def test_disk_cache_sweep(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(directory, max_bytes=10, sweep_interval=3600)
+            cache.set('expired', b'%PDF', ttl=60)
+            os.utime(cache._path('expired'), (time.time() - 1, time.time() - 1))
+            cache.set('first', b'12345', ttl=60)
+            cache.set('second', b'12345', ttl=120)
+            cache.set('third', b'12345', ttl=180)
+            self.assertTrue(os.path.exists(cache._path('expired')))
+            cache.sweep()
+            self.assertFalse(os.path.exists(cache._path('expired')))
+            self.assertIsNone(cache.get('first'))
+            self.assertEqual(b'12345', cache.get('second')[1])
+            self.assertEqual(b'12345', cache.get('third')[1])
+
+
+class AssetCacheTestCase(TestCase):
+    assets = {
+        'http://cdn.example.com/logo.png': (b'PNG', 'image/png'),
+        'http://cdn.example.com/css/style.css': (b'body { font-family: url("../font.woff"); }', 'text/css'),
+        'http://cdn.example.com/font.woff': (b'WOFF', 'font/woff'),
+    }
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = AssetCache(directory.name, ttl=60)
+        patcher = mock.patch.object(AssetCache, '_download', side_effect=self.fake_download)
+        self.download = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_download(self, url, timeout):
+        if url not in self.assets:
+            raise IOError("HTTP Error 404: Not Found")
+        return self.assets[url]
+
+    def test_rewrite_html(self):
+        html = ('<link rel="stylesheet" href="http://cdn.example.com/css/style.css">'
+                '<img src="http://cdn.example.com/logo.png"><a href="http://cdn.example.com/logo.png">'
+                '<img src="http://cdn.example.com/missing.png">')
+        content = self.cache.rewrite_html(html)
+        self.assertEqual(4, self.download.call_count)
+        self.assertEqual(2, content.count('file://'))
+        self.assertIn('<a href="http://cdn.example.com/logo.png">', content)
+        self.assertIn('src="http://cdn.example.com/missing.png"', content)
+        stylesheet = self.cache.lookup('http://cdn.example.com/css/style.css')
+        with open(stylesheet) as f:
+            self.assertIn('file://', f.read())
+
+        self.assertEqual(content, self.cache.rewrite_html(html))
+        # The missing asset isn't tried again before failure_ttl
+        self.assertEqual(4, self.download.call_count)
+        self.cache._failures['http://cdn.example.com/missing.png'] = time.time() - 1
+        self.assertEqual(content, self.cache.rewrite_html(html))
+        self.assertEqual(5, self.download.call_count)
+
+    def test_fetch_budget(self):
+        self.cache.fetch_budget = 10
+        html = '<img src="http://cdn.example.com/logo.png"><img src="http://cdn.example.com/font.woff">'
+        now = [1000]
+
+        def slow_download(url, timeout):
+            now[0] += timeout
+            return self.fake_download(url, timeout)
+        self.download.side_effect = slow_download
+        with mock.patch('pdf.assets.time.time', side_effect=lambda: now[0]):
+            content = self.cache.rewrite_html(html)
+        self.assertEqual(1, self.download.call_count)
+        self.assertEqual(10, self.download.call_args[0][1])
+        self.assertIn('src="http://cdn.example.com/font.woff"', content)
+
+    def test_eviction(self):
+        self.cache.max_bytes = 5
+        png = self.cache.resolve('http://cdn.example.com/logo.png')
+        os.utime(png, (0, 0))
+        self.cache.resolve('http://cdn.example.com/font.woff')
+        self.cache.evict()
+        self.assertIsNone(self.cache.lookup('http://cdn.example.com/logo.png'))
+        self.assertIsNotNone(self.cache.lookup('http://cdn.example.com/font.woff'))
+
+        self.cache.ttl = -1
+        self.cache.fetch('http://cdn.example.com/font.woff')
+        self.assertIsNone(self.cache.lookup('http://cdn.example.com/font.woff'))
+
+
+class FragmentCacheTestCase(TestCase):
+    def test_rendered_once_per_content(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FragmentCache(directory)
+            path = cache.get_file('<p>{{ company }} <img src="{{ assets.logo }}"></p>', {'company': 'ACME'},
+                                  {'logo': 'file:///logo.png'})
+            with open(path) as f:
+                self.assertEqual('<p>ACME <img src="file:///logo.png"></p>', f.read())
+            self.assertEqual(path, cache.get_file('<p>{{ company }} <img src="{{ assets.logo }}"></p>',
+                                                  {'company': 'ACME'}, {'logo': 'file:///logo.png'}))
+            self.assertNotEqual(path, cache.get_file('<p>{{ company }}</p>', {'company': 'Other'}))
+            self.assertEqual({'hits': 1, 'misses': 2}, cache.stats())
+
+            os.utime(path, (0, 0))
+            cache.evict()
+            self.assertFalse(os.path.exists(path))
+
+
+class TemplateCacheTestCase(TestCase):
+    def test_compiled_templates_are_reused(self):
+        cache = TemplateCache(jinja2.Environment(), max_size=1)
+        template = cache.get_template('Hello {{ name }}')
+        self.assertEqual('Hello World', template.render(name='World'))
+        self.assertIs(template, cache.get_template('Hello {{ name }}'))
+        cache.get_template('Bye {{ name }}')
+        self.assertIsNot(template, cache.get_template('Hello {{ name }}'))
+        self.assertEqual({'hits': 1, 'misses': 3, 'size': 1}, cache.stats())
+
+    def test_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            environment = jinja2.Environment(bytecode_cache=jinja2.FileSystemBytecodeCache(directory))
+            TemplateCache(environment).get_template('{{ 1 + 1 }}')
+            self.assertEqual(1, len(os.listdir(directory)))
+            template = TemplateCache(environment).get_template('{{ 1 + 1 }}')
+            self.assertEqual('2', template.render())
+
+
+class APITestCase(TestCase):
+    def setUp(self):
+        User.objects.create_user('client', password='secret')
+        self.authorization = 'Basic ' + base64.b64encode(b'client:secret').decode()
+
+    def post(self, params, path='/pdf', **extra):
+        return self.client.post(path, json.dumps(params), content_type='application/json',
+                                HTTP_AUTHORIZATION=self.authorization, **extra)
+
+    def get(self, path, **extra):
+        return self.client.get(path, HTTP_AUTHORIZATION=self.authorization, **extra)
+
+
+class AuthenticationTestCase(APITestCase):
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_credential_cache(self, wkhtmltopdf):
+        params = {'url': 'http://example.com/'}
+        with mock.patch('pdf.authentication.authenticate', wraps=authenticate) as authenticate_mock:
+            self.assertEqual(200, self.post(params).status_code)
+            self.assertEqual(200, self.post(params).status_code)
+            self.assertEqual(1, authenticate_mock.call_count)
+
+            user = User.objects.get(username='client')
+            user.is_active = False
+            user.save()
+            self.assertEqual(401, self.post(params).status_code)
+
+    @override_settings(PDF_API_KEYS={'robot': hashlib.sha256(b'key').hexdigest()})
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_api_keys(self, wkhtmltopdf):
+        self.authorization = 'Basic ' + base64.b64encode(b'robot:key').decode()
+        self.assertEqual(200, self.post({'url': 'http://example.com/'}).status_code)
+        self.authorization = 'Basic ' + base64.b64encode(b'robot:wrong').decode()
+        self.assertEqual(401, self.post({'url': 'http://example.com/'}).status_code)
+
+
+class PDFViewTestCase(APITestCase):
+    @override_settings(PDF_CACHE_ENABLED=True, PDF_CACHE_DIR=None)
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_result_cache(self, wkhtmltopdf):
+        params = {'template': 'Hello {{ name }}', 'data': {'name': 'World'}}
+        first = self.post(params)
+        second = self.post(params)
+        self.assertEqual(1, wkhtmltopdf.call_count)
+        self.assertEqual(b'%PDF-1.4', second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+        self.assertEqual(304, self.post(params, HTTP_IF_NONE_MATCH=first['ETag']).status_code)
+
+        self.post(dict(params, cache=False))
+        self.assertEqual(2, wkhtmltopdf.call_count)
+        self.assertEqual(400, self.post(dict(params, **{'cache-ttl': 'abc'})).status_code)
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import sys; sys.stdout.buffer.write(b'%PDF-1.4')"))
+    def test_streaming(self):
+        response = self.post({'template': 'Hello', 'data': {}, 'stream': True})
+        self.assertTrue(response.streaming)
+        self.assertEqual(b'%PDF-1.4', b''.join(response.streaming_content))
+        response.close()
+        self.assertEqual(0, get_pool().running)
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import sys; sys.stdout.buffer.write(sys.stdin.buffer.read())"),
+                       PDF_PIPELINE=True)
+    def test_pipeline(self):
+        response = self.post({'template': 'Hello {{ name }}', 'data': {'name': 'World'}})
+        self.assertEqual(b'Hello World', response.content)
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import time; time.sleep(30)"), WKHTMLTOPDF_MAX_TIMEOUT=0.5)
+    def test_timeout(self):
+        response = self.post({'url': 'http://example.com/', 'timeout': 60})
+        self.assertEqual(504, response.status_code)
+        for timeout in ('abc', 0, -1, [1]):
+            self.assertEqual(400, self.post({'url': 'http://example.com/', 'timeout': timeout}).status_code)
+        self.assertEqual(400, self.post({'url': 'http://example.com/', 'queue-timeout': 'abc'}).status_code)
+
+    @override_settings(PDF_BACKENDS={'wkhtmltopdf': 'pdf.backends.WkhtmltopdfBackend',
+                                     'fake': 'pdf.backends.FakeBackend'})
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_backend_choice(self, wkhtmltopdf):
+        response = self.post({'template': 'Hello', 'data': {}, 'backend': 'fake', 'stream': True})
+        self.assertFalse(response.streaming)
+        self.assertEqual(FAKE_PDF, response.content)
+        self.assertEqual(0, wkhtmltopdf.call_count)
+        self.assertEqual(400, self.post({'template': 'Hello', 'data': {}, 'backend': 'weasyprint'}).status_code)
+        self.assertEqual(400, self.post({'template': 'Hello', 'data': {}, 'backend': ['fake']}).status_code)
+        with override_settings(PDF_BACKEND='fake'):
+            self.assertEqual(FAKE_PDF, self.post({'template': 'Hello', 'data': {}}).content)
+        self.assertRaises(BackendError, get_backend, 'unknown')
+
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_metrics(self, wkhtmltopdf):
+        with tempfile.TemporaryDirectory() as directory, self.settings(PDF_METRICS_DIR=directory):
+            self.post({'template': 'Hello', 'data': {}})
+            text = self.client.get('/metrics').content.decode()
+        self.assertRegex(text, r'pdf_requests_total{outcome="ok",view="pdf"} \d+')
+        self.assertRegex(text, r'pdf_conversion_seconds_count{backend="wkhtmltopdf"} \d+')
+        self.assertIn('pdf_conversions_in_flight 0', text)
+
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_profiles(self, wkhtmltopdf):
+        self.assertEqual(200, self.post({'template': 'Hello', 'data': {}, 'profile': 'draft'}).status_code)
+        options = wkhtmltopdf.call_args[1]
+        self.assertTrue(options['lowquality'])
+        self.assertTrue(options['disable-javascript'])
+        self.assertEqual(200, self.post({'url': 'http://example.com/', 'profile': 'print'}).status_code)
+        self.assertEqual(600, wkhtmltopdf.call_args[1]['image-dpi'])
+        response = self.post({'template': 'Hello', 'data': {}, 'profile': 'unknown'})
+        self.assertEqual(400, response.status_code)
+        self.assertIn(b'draft', response.content)
+
+    @override_settings(PDF_RATE_LIMITS={'*': (0.01, 2), 'robot': None})
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_rate_limits(self, wkhtmltopdf):
+        params = {'template': 'Hello', 'data': {}}
+        self.assertEqual(200, self.post(params).status_code)
+        self.assertEqual(400, self.post(dict(params, priority='urgent')).status_code)
+        response = self.post(params)
+        self.assertEqual(429, response.status_code)
+        self.assertLessEqual(int(response['Retry-After']), 100)
+        with self.settings(PDF_API_KEYS={'robot': hashlib.sha256(b'key').hexdigest()}):
+            self.authorization = 'Basic ' + base64.b64encode(b'robot:key').decode()
+            for _ in range(3):
+                self.assertEqual(200, self.post(params).status_code)
+
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_compressed_body(self, wkhtmltopdf):
+        body = json.dumps({'template': '{{ rows|length }}', 'data': {'rows': ['x' * 100] * 1000}}).encode()
+
+        def post(content, encoding):
+            return self.client.post('/pdf', content, content_type='application/json', HTTP_CONTENT_ENCODING=encoding,
+                                    HTTP_AUTHORIZATION=self.authorization)
+
+        with mock.patch('pdf.views.MakePDFViewFromHtml.get_context', return_value={}) as get_context:
+            self.assertEqual(200, post(gzip.compress(body), 'gzip').status_code)
+            self.assertEqual(200, post(zlib.compress(body), 'deflate').status_code)
+        self.assertEqual(2, get_context.call_count)
+        self.assertEqual(1000, len(get_context.call_args[0][0]['data']['rows']))
+        self.assertEqual(415, post(body, 'br').status_code)
+        self.assertEqual(400, post(gzip.compress(body)[:100], 'gzip').status_code)
+        self.assertEqual(400, post(b'{"template": ', 'identity').status_code)
+        with self.settings(PDF_MAX_DATA_SIZE=10000):
+            self.assertEqual(413, post(gzip.compress(body), 'gzip').status_code)
+        with self.settings(PDF_MAX_BODY_SIZE=1000):
+            self.assertEqual(413, post(body, 'identity').status_code)
+
+    def test_spool(self):
+        params = {'template': 'Hello', 'data': {}}
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(PDF_SPOOL_ENABLED=True, PDF_SPOOL_DIR=directory, PDF_SPOOL_THRESHOLD=50000,
+                              WKHTMLTOPDF_CMD=stub_command(0, 100000)):
+            response = self.post(params)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('100000', response['Content-Length'])
+            content = b''.join(response.streaming_content)
+            response.close()
+            self.assertTrue(content.startswith(b'%PDF'))
+            self.assertEqual(100000, len(content))
+
+            with self.settings(PDF_SPOOL_ACCEL_REDIRECT='/spool/'):
+                response = self.post(params)
+            self.assertEqual(b'', response.content)
+            name = response['X-Accel-Redirect'][len('/spool/'):]
+            self.assertTrue(os.path.exists(os.path.join(directory, name)))
+
+            with self.settings(PDF_SPOOL_THRESHOLD=200000):
+                response = self.post(params)
+            self.assertEqual(100000, len(response.content))
+            self.assertNotIn('X-Accel-Redirect', response)
+
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_header_and_footer(self, wkhtmltopdf):
+        with tempfile.TemporaryDirectory() as directory, self.settings(PDF_FRAGMENTS_DIR=directory):
+            for _ in range(2):
+                response = self.post({'template': 'Hello', 'data': {}, 'header': '<p>{{ title }}</p>',
+                                      'header_data': {'title': 'ACME'}, 'footer': '<p>Footer</p>'})
+                self.assertEqual(200, response.status_code)
+            first, second = [call[1] for call in wkhtmltopdf.call_args_list]
+            self.assertEqual(first['header-html'], second['header-html'])
+            with open(first['header-html']) as f:
+                self.assertEqual('<p>ACME</p>', f.read())
+            self.assertTrue(first['footer-html'].startswith(directory))
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import sys; sys.stdout.buffer.write(b'%PDF-1.4')"),
+                       PDF_PIPELINE=False, PDF_SLOW_REQUEST_THRESHOLD=0)
+    def test_server_timing(self):
+        with self.assertLogs('pdf.slow') as logs:
+            response = self.post({'template': 'Hello', 'data': {}})
+        stages = [stage.split(';')[0] for stage in response['Server-Timing'].split(', ')]
+        self.assertEqual(['auth', 'parse', 'render', 'paths', 'assets', 'tempfile', 'queue', 'spawn', 'convert',
+                          'total'], stages)
+        self.assertIn('POST /pdf 200', logs.output[0])
+        self.assertIn(' send=', logs.output[0])
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import sys; sys.stdout.buffer.write(sys.stdin.buffer.read())"),
+                       PDF_PIPELINE=True, PDF_SLOW_REQUEST_THRESHOLD=0)
+    def test_server_timing_pipeline(self):
+        with self.assertLogs('pdf.slow') as logs:
+            response = self.post({'template': 'Hello', 'data': {}})
+        self.assertEqual(b'Hello', response.content)
+        self.assertIn('render;dur=', response['Server-Timing'])
+        self.assertIn(' render=', logs.output[0])
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import sys; sys.stdout.buffer.write(sys.stdin.buffer.read())"))
+    def test_template_errors(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(PDF_FRAGMENTS_DIR=directory):
+            response = self.post({'template': 'Hello', 'data': {}, 'header': '{{ title.text.value }}'})
+            self.assertEqual(400, response.status_code)
+            self.assertIn(b'Template error', response.content)
+        for pipeline in (True, False):
+            with self.settings(PDF_PIPELINE=pipeline):
+                response = self.post({'template': '{{ title.text.value }}', 'data': {}})
+            self.assertEqual(400, response.status_code)
+
+    @override_settings(PDF_POOL_MAX_CONCURRENT=0, PDF_POOL_QUEUE_SIZE=0)
+    def test_busy_pool(self):
+        response = self.post({'url': 'http://example.com/'})
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('5', response['Retry-After'])
+
+
+class PDFBatchTestCase(APITestCase):
+    template = 'Hello {{ person.name }}'
+
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_combined_output(self, wkhtmltopdf):
+        response = self.post({'template': self.template, 'records': [{'person': {'name': 'A'}},
+                                                                     {'person': {'name': 'B'}}]},
+                             path='/pdf/batch')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, wkhtmltopdf.call_count)
+        self.assertEqual(2, len(wkhtmltopdf.call_args[1]['pages']))
+
+        response = self.post({'template': self.template, 'records': [{'person': {'name': 'A'}}, {}]},
+                             path='/pdf/batch')
+        self.assertEqual(422, response.status_code)
+        self.assertEqual([1], [e['index'] for e in json.loads(response.content.decode())['errors']])
+
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_zip_output(self, wkhtmltopdf):
+        response = self.post({'template': self.template, 'output': 'zip',
+                              'records': [{'person': {'name': 'A'}}, {}, {'person': {'name': 'C'}}]},
+                             path='/pdf/batch')
+        self.assertEqual('application/zip', response['Content-Type'])
+        archive = zipfile.ZipFile(io.BytesIO(response.content))
+        self.assertEqual(['document-0.pdf', 'document-2.pdf', 'errors.json'], sorted(archive.namelist()))
+        self.assertEqual(2, wkhtmltopdf.call_count)
+        errors = json.loads(archive.read('errors.json').decode())
+        self.assertEqual(1, errors[0]['index'])
+
+
+class TemplateRegistryTestCase(APITestCase):
+    def setUp(self):
+        super(TemplateRegistryTestCase, self).setUp()
+        self.templates_dir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(PDF_TEMPLATES_DIR=self.templates_dir.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.templates_dir.cleanup()
+
+    def upload(self, source, assets=None):
+        assets = dict((path, base64.b64encode(content).decode()) for path, content in (assets or {}).items())
+        return self.post({'source': source, 'assets': assets}, path='/pdf/templates/invoice')
+
+    @override_settings(WKHTMLTOPDF_CMD=python_command("import sys; sys.stdout.buffer.write(sys.stdin.buffer.read())"),
+                       PDF_PIPELINE=True, WKHTMLTOPDF_DEBUG=False)
+    def test_render_registered_template(self):
+        response = self.upload('<img src="{{ assets["logo.png"] }}">{{ name }}', {'logo.png': b'PNG'})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(1, json.loads(response.content.decode())['version'])
+        self.assertEqual(201, self.upload('v2 {{ name }} {{ assets["logo.png"] }}').status_code)
+
+        content = self.post({'template_name': 'invoice', 'data': {'name': 'Bob'}}).content.decode()
+        self.assertTrue(content.startswith('v2 Bob file://'))
+        logo = content.split(' ')[-1]
+        self.assertTrue(logo.startswith('file://' + self.templates_dir.name))
+        content = self.post({'template_name': 'invoice', 'template_version': 1, 'data': {'name': 'Bob'}}).content
+        self.assertEqual(('<img src="%s">Bob' % logo).encode(), content)
+
+        self.assertEqual([2], [t['version'] for t in json.loads(self.get('/pdf/templates').content.decode())
+                               ['templates']])
+        self.assertEqual(404, self.post({'template_name': 'invoice', 'template_version': 3, 'data': {}}).status_code)
+        self.assertEqual(400, self.upload('{% if %}').status_code)
+        self.assertEqual(204, self.client.delete('/pdf/templates/invoice',
+                                                 HTTP_AUTHORIZATION=self.authorization).status_code)
+        self.assertEqual(404, self.post({'template_name': 'invoice', 'data': {}}).status_code)
+        self.assertEqual(404, self.get('/pdf/templates/invoice/1').status_code)
+
+        # Versions of a template registered again are numbered from 1 again
+        self.assertEqual(201, self.upload('NEW {{ name }}').status_code)
+        self.assertEqual(b'NEW Bob', self.post({'template_name': 'invoice', 'template_version': 1,
+                                                'data': {'name': 'Bob'}}).content)
+
+
+@override_settings(PDF_JOBS_WORKERS=0)
+class PDFJobTestCase(APITestCase):
+    def setUp(self):
+        super(PDFJobTestCase, self).setUp()
+        self.jobs_dir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(PDF_JOBS_DIR=self.jobs_dir.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.jobs_dir.cleanup()
+
+    @mock.patch('pdf.backends.wkhtmltopdf', return_value=b'%PDF-1.4')
+    def test_job_lifecycle(self, wkhtmltopdf):
+        response = self.post({'url': 'http://example.com/', 'filename': 'a.pdf'}, path='/pdf/jobs')
+        self.assertEqual(202, response.status_code)
+        job = json.loads(response.content.decode())
+        self.assertEqual('pending', job['status'])
+        self.assertEqual(409, self.get(job['url'] + '/result').status_code)
+
+        self.assertTrue(run_job(job['id']))
+        self.assertFalse(run_job(job['id']))
+
+        job = json.loads(self.get(job['url']).content.decode())
+        self.assertEqual('done', job['status'])
+        response = self.get(job['result'])
+        self.assertEqual(b'%PDF-1.4', response.content)
+        self.assertIn('a.pdf', response['Content-Disposition'])
+
+    def test_interrupted_jobs_fail(self):
+        job = ConversionJob.objects.create(owner='client', params='{}', filename='a.pdf',
+                                           status=ConversionJob.RUNNING, started=timezone.now())
+        fail_stale_jobs()
+        self.assertEqual('running', json.loads(self.get('/pdf/jobs/%s' % job.id).content.decode())['status'])
+        ConversionJob.objects.filter(pk=job.id).update(started=timezone.now() - timedelta(hours=1))
+        fail_stale_jobs()
+        description = json.loads(self.get('/pdf/jobs/%s' % job.id).content.decode())
+        self.assertEqual('failed', description['status'])
+        self.assertIn('Interrupted', description['error'])
+        self.assertIsNotNone(description['expires'])
+
+    def test_jobs_are_private(self):
+        job = ConversionJob.objects.create(owner='someone-else', params='{}', filename='a.pdf')
+        self.assertEqual(404, self.get('/pdf/jobs/%s' % job.id).status_code)
+
+
+class WarmUpTestCase(TestCase):
+    @override_settings(WKHTMLTOPDF_WARM_WORKERS=0, WKHTMLTOPDF_CMD=python_command(
+        "import sys; sys.stdout.write('wkhtmltopdf 0.12.6 (with patched qt)' if '--version' in sys.argv "
+        "else '%PDF-1.4')"))
+    def test_warmup(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(PDF_TEMPLATES_DIR=directory):
+            create_version('client', 'invoice', '<p>{{ total }}</p>')
+            warmup = WarmUp()
+            with mock.patch('pdf.warmup._warmup', warmup):
+                self.assertEqual(503, self.client.get('/health').status_code)
+                warmup.run()
+                response = self.client.get('/health')
+            self.assertEqual(200, response.status_code)
+            checks = json.loads(response.content.decode())['checks']
+            self.assertEqual('wkhtmltopdf 0.12.6 (with patched qt)', checks['renderer']['version'])
+            self.assertEqual(8, checks['render']['bytes'])
+            self.assertEqual(1, checks['templates']['count'])
+
+            with self.settings(WKHTMLTOPDF_MIN_VERSION='0.13'):
+                warmup = WarmUp()
+                warmup.run()
+            self.assertEqual('failed', warmup.status)
+            self.assertIn('older than 0.13', warmup.checks['renderer']['error'])
+
+            # Conversions run the command when the render workers can't start
+            with self.settings(WKHTMLTOPDF_WARM_WORKERS=1, WKHTMLTOPDF_WARM_LIBRARY='/missing/libwkhtmltox.so'):
+                warmup = WarmUp()
+                warmup.run()
+            self.assertEqual('failed', warmup.status)
+            self.assertIn('at startup', warmup.checks['workers']['error'])
+            self.assertEqual(8, warmup.checks['render']['bytes'])
@@ -0,0 +1,131 @@
+"""Time spent by requests in each stage of a conversion.
+
+ServerTimingMiddleware gives every request a StageTimer, which the code of
+each stage (parsing, rendering, conversion...) feeds through stage() or
+timed_iter(). The breakdown is sent in the Server-Timing header, and
+requests lasting more than ``PDF_SLOW_REQUEST_THRESHOLD`` seconds (sending
+the response included) are written to the ``pdf.slow`` log.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+slow_log = logging.getLogger('pdf.slow')
+
+_local = threading.local()
+
+
+class StageTimer(object):
+    """Seconds spent in each stage of a request, in order of appearance.
+
+    Stages met several times (e.g. rendering each record of a batch) are
+    added up.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def header(self):
+        """Returns the value of the Server-Timing header (milliseconds)."""
+        with self._lock:
+            stages = list(self.stages.items())
+        stages.append(('total', self.elapsed()))
+        return ', '.join('%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in stages)
+
+    def describe(self):
+        with self._lock:
+            return ' '.join('%s=%.3f' % (name, seconds) for name, seconds in self.stages.items())
+
+
+def current():
+    """Returns the timer of the request handled by this thread, or None."""
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def stage(name):
+    """Context manager adding its duration to the stage ``name`` of the
+    current request."""
+    timer = current()
+    if timer is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timer.add(name, time.time() - start)
+
+
+def timed_iter(name, iterable):
+    """Returns an iterator over the items of ``iterable``, adding the time
+    spent producing them to the stage ``name`` of the current request, even
+    when iterated by another thread."""
+    # Not a generator: the timer of this thread is looked up now, not when
+    # another thread (e.g. feeding wkhtmltopdf) asks for the first item
+    timer = current()
+    if timer is None:
+        return iter(iterable)
+    return _timed_iter(timer, name, iter(iterable))
+
+
+def _timed_iter(timer, name, iterator):
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            timer.add(name, time.time() - start)
+        yield item
+
+
+class ServerTimingMiddleware(object):
+    """Times requests, see the module documentation."""
+
+    def process_request(self, request):
+        request.timer = _local.timer = StageTimer()
+
+    def process_response(self, request, response):
+        timer = getattr(request, 'timer', None)
+        _local.timer = None
+        if timer is None:
+            return response
+        response['Server-Timing'] = timer.header()
+
+        threshold = getattr(settings, 'PDF_SLOW_REQUEST_THRESHOLD', None)
+        if threshold is not None:
+            close = response.close
+            sent = time.time()
+
+            def close_and_log():
+                # Called once the response has been sent
+                close()
+                timer.add('send', time.time() - sent)
+                elapsed = timer.elapsed()
+                if elapsed >= threshold:
+                    slow_log.warning("%s %s %d %.3fs user=%s %s", request.method, request.path,
+                                     response.status_code, elapsed, _username(request), timer.describe())
+            response.close = close_and_log
+        return response
+
+
+def _username(request):
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated():
+        return None
+    return user.get_username()
@@ -1,28 +1,145 @@
+import base64
+import io
 import json
 import logging
+import math
+import os
 import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import subprocess
 
 import sys
+import jinja2
 from django.conf import settings
-from django.http import HttpRequest, HttpResponseForbidden, HttpResponseServerError, HttpResponseNotFound
+from django.db.models import Max
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden, HttpResponseServerError, \
+    HttpResponseNotFound, HttpResponseNotModified, JsonResponse, Http404, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404
+from django.core.urlresolvers import reverse
+from django.utils import six
 from django.utils.decorators import method_decorator
 from django.utils.encoding import smart_text
+from django.utils.http import parse_etags, quote_etag
 from django.views.decorators.csrf import csrf_exempt
 
 from django.views.generic import TemplateView, View
-import jinja2 as jinja2
+from pdf.assets import resolve_assets
 from pdf.authentication import basic_auth_required
+from pdf.backends import BackendError, get_backend
+from pdf.cache import cache_key, get_cache
+from pdf.coalesce import get_single_flight
+from pdf.fragments import fragment_options
+from pdf.jinja import get_template
+from pdf import metrics
+from pdf.jobs import describe_job, result_path, submit_job
+from pdf.logs import log_request
+from pdf.models import ConversionJob, Template, TemplateVersion
+from pdf.payload import PayloadError, read_params
+from pdf.pool import PoolBusy, UnknownPriority, get_pool, get_priorities, get_priority
+from pdf.profiles import UnknownProfile, get_profile_options
+from pdf.ratelimit import rate_limit_response
+from pdf.registry import TemplateNotFound, create_version, delete_template, describe_version, \
+    get_registered_template
+from pdf.spool import SpooledPDF, get_spool
+from pdf.timing import stage, timed_iter
+from pdf.warmup import get_warmup
 
-from .wkhtmltopdf import make_absolute_paths, wkhtmltopdf
-from .wkhtmltopdf import PDFResponse
+from .wkhtmltopdf import effective_options, iter_absolute_paths, make_absolute_paths
+from .wkhtmltopdf import OutputTooLarge, PDFResponse, StreamingPDFResponse
 
 log = logging.getLogger('pdf')
 
+# Exceptions of a failed conversion, see MakePDFViewFromHtml.conversion_error_response()
+CONVERSION_ERRORS = (subprocess.CalledProcessError, subprocess.TimeoutExpired, OutputTooLarge)
+
+
+# Outcome of the API requests in metrics, by status code (see response_outcome())
+OUTCOMES = {
+    200: 'ok',
+    202: 'accepted',
+    304: 'not_modified',
+    400: 'bad_request',
+    403: 'forbidden',
+    404: 'not_found',
+    409: 'conflict',
+    413: 'too_large',
+    422: 'invalid',
+    429: 'rate_limited',
+    503: 'busy',
+    504: 'timeout',
+}
+
+
+def response_outcome(response):
+    """Returns the outcome of an API request answered with ``response``."""
+    return getattr(response, 'outcome', None) or OUTCOMES.get(response.status_code, 'error')
+
+
+def resolve_template(request, params):
+    """Replaces the ``template_name`` (and ``template_version``) of ``params``
+    by the source and the assets of that registered template, and so on for
+    ``header_name`` and ``footer_name``. Returns an error response if it
+    can't."""
+    for part in ('template', 'header', 'footer'):
+        if part + '_name' not in params:
+            continue
+        version = params.get(part + '_version')
+        if version is not None and not isinstance(version, int):
+            return HttpResponseBadRequest("'%s_version' must be an integer" % part)
+        try:
+            with stage('registry'):
+                registered = get_registered_template(request.user.get_username(), params[part + '_name'],
+                                                     version)
+        except TemplateNotFound as ex:
+            return HttpResponseNotFound(str(ex))
+        params[part] = registered.source
+        params[part + '_version'] = registered.version
+        params[part + '_assets'] = registered.assets
+    return None
+
+
+# Numeric parameters (seconds): name, whether 0 is valid
+NUMBER_PARAMS = (
+    ('timeout', False),
+    ('queue-timeout', True),
+    ('cache-ttl', True),
+)
+
+
+def check_numbers(params):
+    """Returns an error response if a parameter of NUMBER_PARAMS in
+    ``params`` isn't a (positive or non-negative) number, None otherwise."""
+    for name, zero_valid in NUMBER_PARAMS:
+        value = params.get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) \
+                or value < 0 or (value == 0 and not zero_valid):
+            return HttpResponseBadRequest("'%s' must be a %s number of seconds"
+                                          % (name, 'non-negative' if zero_valid else 'positive'))
+    return None
+
+
+def service_unavailable(message):
+    """Returns a 503 response asking the client to retry later."""
+    response = HttpResponse(message, status=503, content_type='text/plain')
+    response['Retry-After'] = str(getattr(settings, 'PDF_POOL_RETRY_AFTER', 5))
+    return response
+
 
 class MakePDFViewFromHtml(View):
 
+    # Name of the view in metrics
+    metrics_name = 'pdf'
+
+    # Who the conversions are for and the rank of their priority class, to
+    # share the conversion pool fairly (see set_scheduling())
+    owner = None
+    priority = 0
+
     # Command-line options to pass to wkhtmltopdf
     cmd_options = {
         # 'orientation': 'portrait',
@@ -44,8 +161,9 @@ class MakePDFViewFromHtml(View):
                                           dir=dir, delete=delete)
 
         try:
-            temp_file.write(content.encode('utf-8'))
-            temp_file.flush()
+            with stage('tempfile'):
+                temp_file.write(content.encode('utf-8'))
+                temp_file.flush()
             return temp_file
         except:
             # Clean-up temp_file if an Exception is raised.
@@ -54,7 +172,8 @@ class MakePDFViewFromHtml(View):
 
     def convert_to_pdf(self, filename_or_url,
                        header_filename=None, footer_filename=None,
-                       cmd_options=None):
+                       cmd_options=None, queue_timeout=None, stream=False, input=None,
+                       timeout=None, backend=None, output=None):
         _cmd_options = self.cmd_options.copy()
         if cmd_options is not None:
             _cmd_options.update(cmd_options)
@@ -65,78 +184,656 @@ class MakePDFViewFromHtml(View):
             _cmd_options['header_html'] = header_filename
         if footer_filename is not None:
             _cmd_options['footer_html'] = footer_filename
-        return wkhtmltopdf(pages=[filename_or_url], **cmd_options)
+        if isinstance(filename_or_url, (list, tuple)):
+            pages = filename_or_url
+        else:
+            pages = [filename_or_url]
+        backend = get_backend(backend)
+        pool = get_pool()
+        owner = self.owner
+        if stream:
+            # The conversion slot is held until the stream is closed
+            with stage('queue'):
+                pool.acquire(timeout=queue_timeout, owner=owner, priority=self.priority)
+            try:
+                start = time.time()
+                pdf_stream = backend.render(pages, input=input, timeout=timeout, stream=True,
+                                            **_cmd_options)
+            except:
+                pool.release(owner)
+                raise
+            pdf_stream.add_close_callback(lambda: pool.release(owner))
+
+            def observe():
+                metrics.observe('pdf_conversion_seconds', time.time() - start, backend=backend.name)
+                metrics.observe('pdf_output_bytes', pdf_stream.size)
+            pdf_stream.add_close_callback(observe)
+            return pdf_stream
+        with stage('queue'):
+            pool.acquire(timeout=queue_timeout, owner=owner, priority=self.priority)
+        try:
+            start = time.time()
+            pdf_content = backend.render(pages, input=input, timeout=timeout, output=output, **_cmd_options)
+            size = len(pdf_content) if output is None else os.path.getsize(output)
+            elapsed = time.time() - start
+            log.info("Converted %d page(s) with %s in %.3fs", len(pages), backend.name, elapsed)
+            metrics.observe('pdf_conversion_seconds', elapsed, backend=backend.name)
+            metrics.observe('pdf_output_bytes', size)
+            return pdf_content
+        finally:
+            pool.release(owner)
 
     def post(self, request, *args, **kwargs):
         assert(isinstance(request, HttpRequest))
         if not request.user.is_authenticated():
             log.warn("Unauthenticated user can't use PDF API")
             return HttpResponseForbidden()
+        error = rate_limit_response(request)
+        if error is not None:
+            return error
 
         debug = getattr(settings, 'WKHTMLTOPDF_DEBUG', settings.DEBUG)
 
-        params = json.loads(request.body.decode('utf-8'))
-        log.info("%s %s (%s)", request.method, request.path, request.body)
+        with stage('parse'):
+            try:
+                params = read_params(request)
+            except PayloadError as ex:
+                return ex.response()
+        log_request(request, mode='url' if 'url' in params else 'template')
+        error = resolve_template(request, params)
+        if error is not None:
+            return error
+        error = check_numbers(params)
+        if error is not None:
+            return error
+        try:
+            self.set_scheduling(request.user.get_username(), params)
+            return self.make_pdf_response(request, params, debug)
+        except PoolBusy as ex:
+            log.warning("PDF conversion rejected: %s", ex)
+            return service_unavailable("PDF service is busy: %s" % ex)
+        except jinja2.TemplateError as ex:
+            # Of the template, or of its header or footer
+            return HttpResponseBadRequest("Template error: %s" % ex)
+        except (BackendError, UnknownProfile, UnknownPriority) as ex:
+            return HttpResponseBadRequest(str(ex))
+
+    def set_scheduling(self, owner, params, default_priority=None):
+        """Makes the conversions of this view run for ``owner`` with the
+        priority class requested by ``params``. Raises UnknownPriority."""
+        self.owner = owner
+        self.priority = get_priority(params.get('priority'), owner, default_priority)
+
+    def make_pdf_response(self, request, params, debug):
         if 'url' in params:
             # content is from remote URL
-            remote_url = params['url']
             pdf_filename = params.get('filename', 'document.pdf')
+            show_content_in_browser = None
+        else:
+            pdf_filename = 'expense-claim.pdf'
+            show_content_in_browser = False
+        cmd_options = self.get_cmd_options(params)
 
+        pdf_content = None
+        key = None
+        etag = None
+        cache = get_cache() if params.get('cache', True) else None
+        if cache is not None:
+            key = self.get_cache_key(params, cmd_options)
+            etag = quote_etag(key)
+            with stage('cache'):
+                pdf_content = cache.get(key)
+            if pdf_content is not None:
+                if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+                if key in if_none_match or '*' in if_none_match:
+                    response = HttpResponseNotModified()
+                    response['ETag'] = etag
+                    return response
+
+        if pdf_content is None:
+            stream = self.use_stream(params)
             try:
-                pdf_content = self.convert_to_pdf(
-                    filename_or_url=remote_url,
-                    cmd_options={
-                        'print-media-type': params.get('print-media-type', True),
-                        'cookie': params.get('cookies', None),#(('sessionid', request.COOKIES.get('sessionid')),)
-                    })
-                return PDFResponse(pdf_content, filename=pdf_filename)
-            except subprocess.CalledProcessError as ex:
-                log.error("Error running wkhtmltopdf: %s", ex)
-                if sys.version_info >= (3, 5):
-                    # if hasattr(ex, 'stderr'):
-                    # Python 3.5 and up
-                    # print(ex.stderr)
-                    output = ex.stderr.decode('utf-8', errors='replace')  #.strip().splitlines()[-1]
+                if stream:
+                    pdf_content = self.render_pdf(params, cmd_options, debug, stream=True)
                 else:
-                    output = ex.output.decode('utf-8', errors='replace')  #.strip().splitlines()[-1]
+                    spool = self.use_spool(params)
+                    pdf_content = self.render_coalesced(params, cmd_options, debug, key, spool=spool)
+            except CONVERSION_ERRORS as ex:
+                return self.conversion_error_response(ex, params.get('url'))
+            if stream:
+                # Streamed documents never go through memory, hence aren't cached
+                return StreamingPDFResponse(pdf_content, show_content_in_browser=show_content_in_browser,
+                                            filename=pdf_filename)
+            if isinstance(pdf_content, SpooledPDF):
+                # Neither are spooled ones
+                return spool.response(pdf_content, filename=pdf_filename,
+                                      show_content_in_browser=show_content_in_browser)
+            if cache is not None:
+                cache.set(key, pdf_content, params.get('cache-ttl', None))
+
+        response = PDFResponse(pdf_content, show_content_in_browser=show_content_in_browser,
+                               filename=pdf_filename)
+        if etag is not None:
+            response['ETag'] = etag
+        return response
+
+    def get_cmd_options(self, params):
+        """Returns the wkhtmltopdf options requested by ``params``: those of
+        its profile, then its own. Raises UnknownProfile."""
+        options = get_profile_options(params.get('profile'))
+        options.update(fragment_options(params))
+        if 'url' in params:
+            options.update({
+                'print-media-type': params.get('print-media-type', options.get('print-media-type', True)),
+                'cookie': params.get('cookies', None),#(('sessionid', request.COOKIES.get('sessionid')),)
+                # Remote pages can't be rewritten to cached assets, let wkhtmltopdf cache them
+                'cache-dir': getattr(settings, 'WKHTMLTOPDF_CACHE_DIR', None),
+            })
+        return options
+
+    def get_cache_key(self, params, cmd_options):
+        """Returns the result cache key of the document described by ``params``."""
+        options = effective_options(**dict(self.cmd_options, **cmd_options))
+        backend = get_backend(params.get('backend')).name
+        if 'url' in params:
+            return cache_key(url=params['url'], options=options, backend=backend)
+        parts = {}
+        if 'template_assets' in params:
+            parts['assets'] = params['template_assets']
+        return cache_key(template=params['template'], data=params['data'], options=options,
+                         backend=backend, **parts)
+
+    def render_coalesced(self, params, cmd_options, debug, key=None, spool=None):
+        """Same as render_pdf(), sharing the conversion with the identical
+        requests in progress (``key`` being their result cache key). With a
+        ``spool``, large documents are returned as SpooledPDF (see
+        render_spooled())."""
+        if spool is not None:
+            render = lambda: self.render_spooled(params, cmd_options, debug, spool)
+        else:
+            render = lambda: self.render_pdf(params, cmd_options, debug)
+        flights = get_single_flight()
+        if flights is None:
+            return render()
+        if key is None:
+            key = self.get_cache_key(params, cmd_options)
+        if spool is not None:
+            # Callers without a spool expect bytes
+            key += '-spooled'
+        return flights.run(key, render, shared_errors=CONVERSION_ERRORS)
+
+    def render_spooled(self, params, cmd_options, debug, spool):
+        """Converts the document described by ``params`` into a file of
+        ``spool``, returns its content if it is small, a SpooledPDF otherwise."""
+        path = spool.create()
+        try:
+            self.render_pdf(params, cmd_options, debug, output=path)
+        except:
+            os.unlink(path)
+            raise
+        return spool.collect(path)
+
+    def use_spool(self, params):
+        """Returns the spool the document is written to, or None."""
+        spool = get_spool()
+        if spool is None or self.use_stream(params) or not get_backend(params.get('backend')).supports_output:
+            return None
+        return spool
+
+    def use_stream(self, params):
+        """Tells whether the document is sent while it is produced, which
+        requires a backend able to."""
+        stream = params.get('stream', getattr(settings, 'PDF_STREAMING', False))
+        return stream and get_backend(params.get('backend')).supports_stream
+
+    def render_pdf(self, params, cmd_options, debug, stream=False, output=None):
+        """Returns the PDF document described by ``params``, as bytes or as a
+        PDFStream when ``stream`` is True, or writes it to the file ``output``."""
+        queue_timeout = params.get('queue-timeout', None)
+        if 'url' in params:
+            return self.convert_to_pdf(filename_or_url=params['url'],
+                                       cmd_options=cmd_options,
+                                       queue_timeout=queue_timeout,
+                                       timeout=self.get_timeout(params),
+                                       stream=stream,
+                                       output=output,
+                                       backend=params.get('backend'))
+
+        if self.use_pipeline(params, debug):
+            # The template is rendered while wkhtmltopdf reads it from stdin
+            chunks = (chunk.encode('utf-8') for chunk in self.generate_jinja2(params))
+            return self.convert_to_pdf(filename_or_url='-',
+                                       cmd_options=cmd_options,
+                                       queue_timeout=queue_timeout,
+                                       timeout=self.get_timeout(params),
+                                       stream=stream,
+                                       input=chunks,
+                                       output=output,
+                                       backend=params.get('backend'))
+
+        content = self.render_jinja2(params)
+        log.debug("Rendered template: %d characters", len(content))
+
+        input_file = None
+        try:
+            input_file = self.render_to_temporary_file(
+                content=content,
+                prefix='wkhtmltopdf-', suffix='.html',
+                delete=(not debug)
+            )
+            pdf_content = self.convert_to_pdf(filename_or_url=input_file.name,
+                                              cmd_options=cmd_options,
+                                              queue_timeout=queue_timeout,
+                                              timeout=self.get_timeout(params),
+                                              stream=stream,
+                                              output=output,
+                                              backend=params.get('backend'))
+            if stream:
+                # wkhtmltopdf is still running: keep the input until the stream is closed
+                pdf_content.add_close_callback(input_file.close)
+                input_file = None
+            return pdf_content
+        finally:
+            # Clean up temporary files
+            for f in filter(None, (input_file, )):
+                f.close()
 
-                log.error("wkhtmltopdf output was: %s", output)
-                if 'ConnectionRefusedError' in output:
-                    return HttpResponseServerError("PDF service can't connect to '%s'" % remote_url)
-                if 'ContentNotFoundError' in output:
-                    return HttpResponseNotFound("URL '%s' not found" % remote_url)
-                return HttpResponseServerError("WKHTMLTOPDF error: %s" % output)
+    def use_pipeline(self, params, debug):
+        """Tells whether the rendered template can be sent to wkhtmltopdf's
+        standard input instead of going through a temporary file.
 
+        The temporary file is kept in debug mode, to be inspected.
+        """
+        if debug:
+            return False
+        return params.get('pipeline', getattr(settings, 'PDF_PIPELINE', False))
+
+    def get_timeout(self, params):
+        """Returns the conversion timeout requested by ``params`` (None for the
+        default one), capped by WKHTMLTOPDF_MAX_TIMEOUT."""
+        timeout = params.get('timeout', None)
+        max_timeout = getattr(settings, 'WKHTMLTOPDF_MAX_TIMEOUT', None)
+        if timeout is not None and max_timeout is not None:
+            timeout = min(timeout, max_timeout)
+        return timeout
+
+    def conversion_error_response(self, ex, remote_url=None):
+        """Returns the response describing a failed wkhtmltopdf run."""
+        log.error("Error running wkhtmltopdf: %s", ex)
+        if isinstance(ex, subprocess.TimeoutExpired):
+            return HttpResponse("PDF conversion timed out after %s seconds" % ex.timeout,
+                                status=504, content_type='text/plain')
+        if isinstance(ex, OutputTooLarge):
+            return HttpResponse("PDF document is larger than %d bytes" % ex.max_size,
+                                status=413, content_type='text/plain')
+        if sys.version_info >= (3, 5):
+            # if hasattr(ex, 'stderr'):
+            # Python 3.5 and up
+            # print(ex.stderr)
+            output = ex.stderr.decode('utf-8', errors='replace')  #.strip().splitlines()[-1]
         else:
-            content = self.render_jinja2(params)
-            log.debug(content)
+            output = ex.output.decode('utf-8', errors='replace')  #.strip().splitlines()[-1]
+
+        log.error("wkhtmltopdf output was: %s", output)
+        if ex.returncode < 0:
+            # Killed, most likely for exceeding WKHTMLTOPDF_MEMORY_LIMIT or WKHTMLTOPDF_CPU_LIMIT
+            response = HttpResponseServerError("wkhtmltopdf was killed by signal %d: %s" % (-ex.returncode, output))
+            response.outcome = 'killed'
+            return response
+        if remote_url is not None:
+            if 'ConnectionRefusedError' in output:
+                response = HttpResponseServerError("PDF service can't connect to '%s'" % remote_url)
+                response.outcome = 'connection_refused'
+                return response
+            if 'ContentNotFoundError' in output:
+                response = HttpResponseNotFound("URL '%s' not found" % remote_url)
+                response.outcome = 'content_not_found'
+                return response
+        response = HttpResponseServerError("WKHTMLTOPDF error: %s" % output)
+        response.outcome = 'conversion_error'
+        return response
+
+    def get_context(self, params):
+        """Returns the template context of ``params``: its data, and the URLs
+        of the assets of registered templates."""
+        if 'template_assets' not in params:
+            return params['data']
+        return dict(params['data'], assets=params['template_assets'])
+
+    def render_jinja2(self, params):
+        context_data = self.get_context(params)
+        with metrics.timer('pdf_template_render_seconds'):
+            with stage('render'):
+                template = get_template(params['template'])
+                content = smart_text(template.render(context_data))
+            with stage('paths'):
+                content = make_absolute_paths(content)
+            with stage('assets'):
+                content = resolve_assets(content)
+        return content
+
+    def generate_jinja2(self, params):
+        """Same as render_jinja2(), yielding the content in chunks."""
+        template = get_template(params['template'])
+        # Chunks end with a line, hence never in the middle of a reference
+        chunks = (resolve_assets(chunk) for chunk in iter_absolute_paths(template.generate(self.get_context(params))))
+        # Rendering (paths and assets included) happens while wkhtmltopdf reads its input
+        return timed_iter('render', metrics.timed_iter('pdf_template_render_seconds', chunks))
+
+
+    @method_decorator(csrf_exempt)
+    @method_decorator(basic_auth_required)
+    def dispatch(self, request, *args, **kwargs):
+        response = super(MakePDFViewFromHtml, self).dispatch(request, *args, **kwargs)
+        metrics.inc('pdf_requests_total', view=self.metrics_name, outcome=response_outcome(response))
+        return response
+
+
+class MakePDFBatchView(MakePDFViewFromHtml):
+    """Renders one template for each record of a list (mail merge).
 
-            input_file = None
+    The output is either a single PDF holding all the records (one
+    wkhtmltopdf run) or a ZIP of one PDF per record, converted in parallel.
+    """
+
+    metrics_name = 'batch'
+
+    def post(self, request, *args, **kwargs):
+        error = rate_limit_response(request)
+        if error is not None:
+            return error
+        debug = getattr(settings, 'WKHTMLTOPDF_DEBUG', settings.DEBUG)
+
+        with stage('parse'):
             try:
-                input_file = self.render_to_temporary_file(
+                params = read_params(request)
+            except PayloadError as ex:
+                return ex.response()
+        records = params.get('records')
+        log_request(request, records=len(records) if isinstance(records, list) else None)
+        if not isinstance(records, list) or not records:
+            return HttpResponseBadRequest("'records' must be a non-empty list")
+        max_records = getattr(settings, 'PDF_BATCH_MAX_RECORDS', 1000)
+        if len(records) > max_records:
+            return HttpResponseBadRequest("Too many records (at most %d)" % max_records)
+        error = resolve_template(request, params)
+        if error is not None:
+            return error
+        error = check_numbers(params)
+        if error is not None:
+            return error
+        output = params.get('output', 'pdf')
+        if output not in ('pdf', 'zip'):
+            return HttpResponseBadRequest("'output' must be 'pdf' or 'zip'")
+        try:
+            get_template(params['template'])
+            get_backend(params.get('backend'))
+            get_profile_options(params.get('profile'))
+            # Batches are bulk work by default
+            self.set_scheduling(request.user.get_username(), params, get_priorities()[-1])
+        except jinja2.TemplateSyntaxError as ex:
+            return HttpResponseBadRequest("Template error: %s" % ex)
+        except (BackendError, UnknownProfile, UnknownPriority) as ex:
+            return HttpResponseBadRequest(str(ex))
+
+        try:
+            if output == 'zip':
+                return self.make_zip_response(params, records, debug)
+            return self.make_combined_response(params, records, debug)
+        except PoolBusy as ex:
+            log.warning("PDF conversion rejected: %s", ex)
+            return service_unavailable("PDF service is busy: %s" % ex)
+
+    def render_records(self, params, records):
+        """Renders the template for each record.
+
+        Returns the list of contents (None for failed records) and the list of
+        errors.
+        """
+        contents = []
+        errors = []
+        for index, record in enumerate(records):
+            try:
+                contents.append(self.render_jinja2(dict(params, data=record)))
+            except Exception as ex:
+                contents.append(None)
+                errors.append({'index': index, 'error': '%s: %s' % (type(ex).__name__, ex)})
+        return contents, errors
+
+    def make_combined_response(self, params, records, debug):
+        contents, errors = self.render_records(params, records)
+        if errors:
+            return JsonResponse({'errors': errors}, status=422)
+
+        input_files = []
+        try:
+            for content in contents:
+                input_files.append(self.render_to_temporary_file(
                     content=content,
                     prefix='wkhtmltopdf-', suffix='.html',
                     delete=(not debug)
-                )
-                pdf_content = self.convert_to_pdf(filename_or_url=input_file.name)
-                return PDFResponse(pdf_content, show_content_in_browser=False,
-                                   filename='expense-claim.pdf')
+                ))
+            pdf_content = self.convert_to_pdf(filename_or_url=[f.name for f in input_files],
+                                              cmd_options=self.get_cmd_options(params),
+                                              queue_timeout=params.get('queue-timeout', None),
+                                              timeout=self.get_timeout(params),
+                                              backend=params.get('backend'))
+        except CONVERSION_ERRORS as ex:
+            return self.conversion_error_response(ex)
+        finally:
+            # Clean up temporary files
+            for f in input_files:
+                f.close()
+        return PDFResponse(pdf_content, filename=params.get('filename', 'documents.pdf'))
+
+    def make_zip_response(self, params, records, debug):
+        contents, errors = self.render_records(params, records)
+        cmd_options = self.get_cmd_options(params)
+        queue_timeout = params.get('queue-timeout', None)
 
+        def convert(content):
+            input_file = self.render_to_temporary_file(
+                content=content,
+                prefix='wkhtmltopdf-', suffix='.html',
+                delete=(not debug)
+            )
+            try:
+                return self.convert_to_pdf(filename_or_url=input_file.name,
+                                           cmd_options=cmd_options,
+                                           queue_timeout=queue_timeout,
+                                           timeout=self.get_timeout(params),
+                                           backend=params.get('backend'))
             finally:
-                # Clean up temporary files
-                for f in filter(None, (input_file, )):
-                    f.close()
+                input_file.close()
 
-    def render_jinja2(self, params):
-        context_data = params['data']
-        template = jinja2.Template(params['template'])
-        content = smart_text(template.render(context_data))
-        content = make_absolute_paths(content)
-        return content
+        # No need for more threads than conversions allowed to run at once
+        workers = max(1, min(get_pool().max_concurrent, len(records)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(index, executor.submit(convert, content))
+                       for index, content in enumerate(contents) if content is not None]
+
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w') as archive:
+                for index, future in futures:
+                    try:
+                        archive.writestr('document-%d.pdf' % index, future.result())
+                    except CONVERSION_ERRORS as ex:
+                        error = self.conversion_error_response(ex).content.decode('utf-8')
+                        errors.append({'index': index, 'error': error})
+                    except PoolBusy as ex:
+                        errors.append({'index': index, 'error': "PDF service is busy: %s" % ex})
+                if errors:
+                    errors.sort(key=lambda e: e['index'])
+                    archive.writestr('errors.json', json.dumps(errors, indent=2))
+        return PDFResponse(buffer.getvalue(), content_type='application/zip',
+                           filename=params.get('filename', 'documents.zip'))
 
+class BasicAuthView(View):
+    """View of the API, authenticated with BASIC-AUTH."""
+
+    # Name of the view in metrics
+    metrics_name = None
 
     @method_decorator(csrf_exempt)
     @method_decorator(basic_auth_required)
     def dispatch(self, request, *args, **kwargs):
-        print("DISPATCH")
-        return super(MakePDFViewFromHtml, self).dispatch(request, *args, **kwargs)
+        response = super(BasicAuthView, self).dispatch(request, *args, **kwargs)
+        metrics.inc('pdf_requests_total', view=self.metrics_name, outcome=response_outcome(response))
+        return response
+
+
+class PDFJobListView(BasicAuthView):
+    """Starts background conversions; accepts the same parameters as /pdf."""
+
+    metrics_name = 'jobs'
+
+    def post(self, request, *args, **kwargs):
+        error = rate_limit_response(request)
+        if error is not None:
+            return error
+        try:
+            params = read_params(request)
+        except PayloadError as ex:
+            return ex.response()
+        log_request(request, mode='url' if 'url' in params else 'template')
+        filename = params.get('filename', 'document.pdf' if 'url' in params else 'expense-claim.pdf')
+        # Jobs render the version registered now
+        error = resolve_template(request, params)
+        if error is not None:
+            return error
+        error = check_numbers(params)
+        if error is not None:
+            return error
+        try:
+            get_backend(params.get('backend'))
+            get_profile_options(params.get('profile'))
+            get_priority(params.get('priority'), request.user.get_username(), get_priorities()[-1])
+        except (BackendError, UnknownProfile, UnknownPriority) as ex:
+            return HttpResponseBadRequest(str(ex))
+        job = submit_job(request.user.get_username(), params, filename)
+        response = JsonResponse(describe_job(job, request), status=202)
+        response['Location'] = reverse('pdf-job', args=[job.id])
+        return response
+
+
+class PDFJobView(BasicAuthView):
+    """Reports the status of a background conversion."""
+
+    metrics_name = 'job'
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = get_object_or_404(ConversionJob, pk=job_id, owner=request.user.get_username())
+        return JsonResponse(describe_job(job, request))
+
+
+class PDFJobResultView(BasicAuthView):
+    """Downloads the document produced by a background conversion."""
+
+    metrics_name = 'job-result'
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = get_object_or_404(ConversionJob, pk=job_id, owner=request.user.get_username())
+        if job.status != ConversionJob.DONE:
+            return JsonResponse(describe_job(job, request), status=409)
+        try:
+            with open(result_path(job), 'rb') as f:
+                pdf_content = f.read()
+        except (IOError, OSError):
+            raise Http404("Result of job %s has expired" % job.id)
+        return PDFResponse(pdf_content, filename=job.filename)
+
+
+class PDFTemplateListView(BasicAuthView):
+    """Lists the templates registered by the user."""
+
+    metrics_name = 'templates'
+
+    def get(self, request, *args, **kwargs):
+        templates = Template.objects.filter(owner=request.user.get_username()) \
+            .annotate(latest=Max('versions__version'))
+        return JsonResponse({'templates': [{
+            'name': template.name,
+            'version': template.latest,
+            'url': request.build_absolute_uri(reverse('pdf-template', args=[template.name])),
+        } for template in templates]})
+
+
+class PDFTemplateView(BasicAuthView):
+    """Registers a new version of a template (POST), describes its latest
+    version (GET) or deletes it with all its versions (DELETE)."""
+
+    metrics_name = 'template'
+
+    def get(self, request, name, *args, **kwargs):
+        template = get_object_or_404(Template, owner=request.user.get_username(), name=name)
+        version = template.versions.order_by('-version').first()
+        description = describe_version(version)
+        description['versions'] = list(template.versions.values_list('version', flat=True))
+        description['url'] = request.build_absolute_uri(reverse('pdf-template-version',
+                                                                args=[name, version.version]))
+        return JsonResponse(description)
+
+    def post(self, request, name, *args, **kwargs):
+        try:
+            params = read_params(request)
+        except PayloadError as ex:
+            return ex.response()
+        log_request(request, template=name)
+        source = params.get('source')
+        assets = params.get('assets', {})
+        if not isinstance(source, six.string_types):
+            return HttpResponseBadRequest("'source' must be a string")
+        if not isinstance(assets, dict):
+            return HttpResponseBadRequest("'assets' must map paths to base64 contents")
+        try:
+            assets = dict((path, base64.b64decode(content, validate=True)) for path, content in assets.items())
+            version = create_version(request.user.get_username(), name, source, assets)
+        except jinja2.TemplateSyntaxError as ex:
+            return HttpResponseBadRequest("Template error: %s" % ex)
+        except (TypeError, ValueError) as ex:
+            return HttpResponseBadRequest(str(ex))
+        url = reverse('pdf-template-version', args=[name, version.version])
+        description = describe_version(version)
+        description['url'] = request.build_absolute_uri(url)
+        response = JsonResponse(description, status=201)
+        response['Location'] = url
+        return response
+
+    def delete(self, request, name, *args, **kwargs):
+        try:
+            delete_template(request.user.get_username(), name)
+        except TemplateNotFound as ex:
+            raise Http404(str(ex))
+        return HttpResponse(status=204)
+
+
+class PDFTemplateVersionView(BasicAuthView):
+    """Describes a version of a template, its source included."""
+
+    metrics_name = 'template-version'
+
+    def get(self, request, name, version, *args, **kwargs):
+        version = get_object_or_404(TemplateVersion, template__owner=request.user.get_username(),
+                                    template__name=name, version=version)
+        description = describe_version(version)
+        description['source'] = version.source
+        return JsonResponse(description)
+
+
+class HealthView(View):
+    """Readiness of the process: 503 until its warm-up is done (see
+    pdf.warmup), or if it failed."""
+
+    def get(self, request, *args, **kwargs):
+        warmup = get_warmup()
+        if warmup is None:
+            return JsonResponse({'status': 'ok', 'checks': {}})
+        return JsonResponse(warmup.describe(), status=200 if warmup.ready else 503)
+
+
+class MetricsView(View):
+    """Service metrics in the Prometheus text format, for all processes."""
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.render(metrics.load_snapshots()),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
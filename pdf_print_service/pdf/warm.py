@@ -0,0 +1,347 @@
+"""Conversions in long-lived render workers.
+
+Running the wkhtmltopdf command means loading Qt, WebKit and fontconfig for
+every document, which is most of the time spent on small ones. With
+``WKHTMLTOPDF_WARM_WORKERS`` > 0, conversions are sent instead to worker
+processes (see pdf/warm_worker.py) holding libwkhtmltox
+(``WKHTMLTOPDF_WARM_LIBRARY``) loaded. A worker is replaced after
+``WKHTMLTOPDF_WARM_MAX_JOBS`` conversions, or as soon as its resident memory
+grows past ``WKHTMLTOPDF_WARM_MAX_RSS`` bytes.
+
+Options libwkhtmltox can't be given (see translate_options()) raise
+WarmUnsupported so that the caller can fall back to the command. So do
+workers exiting before they are ready (e.g. the library can't be loaded):
+no other worker is started for ``STARTUP_RETRY_INTERVAL`` seconds.
+"""
+from __future__ import absolute_import
+
+import atexit
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import six
+from django.utils.six.moves import queue
+
+from .timing import stage
+from .wkhtmltopdf import OutputTooLarge, _resource_limiter, _spawn, effective_options
+
+log = logging.getLogger('pdf.warm')
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warm_worker.py')
+STARTUP_RETRY_INTERVAL = 60
+
+# Command-line option: libwkhtmltox setting, or (setting, value) for flags
+GLOBAL_SETTINGS = {
+    'collate': ('collate', 'true'),
+    'no-collate': ('collate', 'false'),
+    'copies': 'copies',
+    'dpi': 'dpi',
+    'grayscale': ('colorMode', 'Grayscale'),
+    'image-dpi': 'imageDPI',
+    'image-quality': 'imageQuality',
+    'margin-bottom': 'margin.bottom',
+    'margin-left': 'margin.left',
+    'margin-right': 'margin.right',
+    'margin-top': 'margin.top',
+    'orientation': 'orientation',
+    'outline': ('outline', 'true'),
+    'no-outline': ('outline', 'false'),
+    'page-height': 'size.height',
+    'page-size': 'size.paperSize',
+    'page-width': 'size.width',
+    'title': 'documentTitle',
+}
+OBJECT_SETTINGS = {
+    'disable-javascript': ('web.enableJavascript', 'false'),
+    'enable-javascript': ('web.enableJavascript', 'true'),
+    'disable-local-file-access': ('load.blockLocalFileAccess', 'true'),
+    'enable-local-file-access': ('load.blockLocalFileAccess', 'false'),
+    'disable-smart-shrinking': ('web.enableIntelligentShrinking', 'false'),
+    'enable-smart-shrinking': ('web.enableIntelligentShrinking', 'true'),
+    'encoding': 'web.defaultEncoding',
+    'footer-html': 'footer.htmlUrl',
+    'footer-spacing': 'footer.spacing',
+    'header-html': 'header.htmlUrl',
+    'header-spacing': 'header.spacing',
+    'images': ('web.loadImages', 'true'),
+    'no-images': ('web.loadImages', 'false'),
+    'javascript-delay': 'load.jsdelay',
+    'load-error-handling': 'load.loadErrorHandling',
+    'load-media-error-handling': 'load.mediaLoadErrorHandling',
+    'minimum-font-size': 'web.minimumFontSize',
+    'print-media-type': ('web.printMediaType', 'true'),
+    'no-print-media-type': ('web.printMediaType', 'false'),
+    'zoom': 'load.zoomFactor',
+}
+# Options without effect on the library
+IGNORED_OPTIONS = {'quiet'}
+
+
+class WarmUnsupported(Exception):
+    """Raised for a conversion the render workers can't run."""
+
+
+def translate_options(options):
+    """Returns the (global, object) libwkhtmltox settings equivalent to the
+    wkhtmltopdf command-line ``options``.
+
+    Raises WarmUnsupported for an option without equivalent.
+    """
+    global_settings = {}
+    object_settings = {}
+    for name, value in options.items():
+        if value is None:
+            continue
+        name = name.replace('_', '-')
+        if name in IGNORED_OPTIONS:
+            continue
+        if name in GLOBAL_SETTINGS:
+            setting, target = GLOBAL_SETTINGS[name], global_settings
+        elif name in OBJECT_SETTINGS:
+            setting, target = OBJECT_SETTINGS[name], object_settings
+        else:
+            raise WarmUnsupported("option %s" % name)
+        if isinstance(setting, tuple):
+            if value is not True:
+                raise WarmUnsupported("value %r of option %s" % (value, name))
+            setting, value = setting
+        elif value is True or isinstance(value, (list, tuple)):
+            raise WarmUnsupported("value %r of option %s" % (value, name))
+        target[setting] = six.text_type(value)
+    return global_settings, object_settings
+
+
+def _error_output(messages, http_error_code):
+    """Returns the messages of a failed conversion the way the command
+    writes them on its standard error."""
+    output = '\n'.join(messages)
+    if http_error_code == 404:
+        # Reported by the command as a network error, see
+        # MakePDFViewFromHtml.conversion_error_response()
+        output += '\nExit with code 1 due to network error: ContentNotFoundError'
+    elif http_error_code:
+        output += '\nExit with code 1 due to http error: %d' % http_error_code
+    return output.encode('utf-8')
+
+
+class WarmWorker(object):
+    """One render worker process, used by a single conversion at a time."""
+
+    def __init__(self, command):
+        self.command = command
+        self.jobs = 0
+        self.rss = 0
+        self.timeout = None
+        self.timed_out = False
+        # No CPU limit: it would add up over the life of the worker
+        self.process = _spawn(command, _resource_limiter(limit_cpu=False),
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        if not self.process.stdout.readline():
+            self.close()
+            raise WarmUnsupported("render worker exited with code %d at startup" % self.process.returncode)
+        log.debug("Started render worker %d", self.process.pid)
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        """Kills the worker and everything it started."""
+        if self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _expire(self):
+        self.timed_out = True
+        self.kill()
+
+    def _died(self):
+        if self.timed_out:
+            raise subprocess.TimeoutExpired(self.command, self.timeout, output=b'', stderr=b'')
+        self.kill()
+        raise subprocess.CalledProcessError(self.process.wait(), self.command,
+                                            output=b'', stderr=b'Render worker died')
+
+    def render(self, pages, html=None, global_settings=None, object_settings=None,
+               timeout=None, max_output_size=None):
+        """Converts ``pages`` (``html`` standing for '-') and returns the PDF."""
+        request = {
+            'pages': list(pages),
+            'global': global_settings or {},
+            'object': object_settings or {},
+            'html_size': len(html) if html else 0,
+        }
+        self.timeout = timeout
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self._expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            try:
+                self.process.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+                if html:
+                    self.process.stdin.write(html)
+                self.process.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                self._died()
+            line = self.process.stdout.readline()
+            if not line:
+                self._died()
+            reply = json.loads(line.decode('utf-8'))
+            if max_output_size is not None and reply['size'] > max_output_size:
+                # Rather than reading it all, drop the worker
+                self.kill()
+                raise OutputTooLarge(self.command, max_output_size)
+            pdf = self.process.stdout.read(reply['size'])
+            if len(pdf) < reply['size']:
+                self._died()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        self.jobs += 1
+        self.rss = reply['rss']
+        if not reply['ok']:
+            raise subprocess.CalledProcessError(1, self.command, output=b'',
+                                                stderr=_error_output(reply['errors'],
+                                                                     reply['http_error_code']))
+        return pdf
+
+    def close(self):
+        """Asks the worker to exit, kills it if it doesn't."""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        log.debug("Stopped render worker %d after %d jobs (%d bytes)",
+                  self.process.pid, self.jobs, self.rss)
+
+
+class WarmRendererPool(object):
+    """At most ``size`` render workers, started on demand and reused.
+
+    A worker is recycled after ``max_jobs`` conversions or when its resident
+    memory exceeds ``max_rss`` bytes, and replaced when a conversion killed it.
+    """
+
+    def __init__(self, command, size, max_jobs=None, max_rss=None):
+        self.command = command
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.startup_error = None
+        self._retry_at = 0
+        self._idle = queue.LifoQueue()
+        self._semaphore = threading.BoundedSemaphore(size)
+
+    def render(self, pages, input=None, timeout=None, max_output_size=None, **kwargs):
+        """Same as wkhtmltopdf() in a render worker.
+
+        Raises WarmUnsupported, before ``input`` is read, if the options
+        can't be run by a worker or no worker could be started.
+        """
+        global_settings, object_settings = translate_options(effective_options(**kwargs))
+        if isinstance(pages, six.string_types):
+            pages = [pages]
+        if timeout is None:
+            timeout = getattr(settings, 'WKHTMLTOPDF_TIMEOUT', None)
+        if max_output_size is None:
+            max_output_size = getattr(settings, 'WKHTMLTOPDF_MAX_OUTPUT_SIZE', None)
+
+        with self._semaphore:
+            with stage('spawn'):
+                worker = self._checkout()
+            try:
+                html = b''.join(input) if input is not None else None
+                with stage('convert'):
+                    return worker.render(pages, html, global_settings, object_settings,
+                                         timeout=timeout, max_output_size=max_output_size)
+            finally:
+                self._checkin(worker)
+
+    def start(self):
+        """Starts a worker if none is idle. Raises WarmUnsupported if it
+        exits at startup."""
+        with self._semaphore:
+            self._checkin(self._checkout())
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        if time.monotonic() < self._retry_at:
+            raise WarmUnsupported(self.startup_error)
+        try:
+            worker = WarmWorker(self.command)
+        except (OSError, WarmUnsupported) as ex:
+            self.startup_error = str(ex)
+            self._retry_at = time.monotonic() + STARTUP_RETRY_INTERVAL
+            log.error("Can't start render worker %s: %s", self.command, ex)
+            raise WarmUnsupported(self.startup_error)
+        self.startup_error = None
+        return worker
+
+    def _checkin(self, worker):
+        if not worker.alive \
+                or (self.max_jobs and worker.jobs >= self.max_jobs) \
+                or (self.max_rss and worker.rss > self.max_rss):
+            worker.close()
+        else:
+            self._idle.put(worker)
+
+    def close(self):
+        """Stops the idle workers."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_warm_pool():
+    """Returns the process-wide render worker pool, or None if conversions
+    run the wkhtmltopdf command."""
+    global _pool
+    size = getattr(settings, 'WKHTMLTOPDF_WARM_WORKERS', 0)
+    if not size:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                command = [getattr(settings, 'WKHTMLTOPDF_WARM_PYTHON', sys.executable),
+                           WORKER_SCRIPT,
+                           getattr(settings, 'WKHTMLTOPDF_WARM_LIBRARY', 'libwkhtmltox.so.0')]
+                _pool = WarmRendererPool(command, size,
+                                         max_jobs=getattr(settings, 'WKHTMLTOPDF_WARM_MAX_JOBS', 100),
+                                         max_rss=getattr(settings, 'WKHTMLTOPDF_WARM_MAX_RSS', None))
+                atexit.register(_pool.close)
+    return _pool
+
+
+@receiver(setting_changed)
+def _reset_pool(setting, **kwargs):
+    global _pool
+    if setting.startswith('WKHTMLTOPDF_WARM_'):
+        if _pool is not None:
+            _pool.close()
+        _pool = None
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Long-lived render worker holding libwkhtmltox in memory (see pdf.warm).
+
+Usage: warm_worker.py <path of libwkhtmltox>
+
+The worker doesn't depend on Django. Once the library is loaded, it writes
+``{"ready": true}`` on stdout, then reads requests from stdin, one JSON line
+each::
+
+    {"pages": [...], "global": {...}, "object": {...}, "html_size": n}
+
+followed by ``html_size`` bytes of HTML used for '-' pages. Each request is
+answered on stdout by a JSON line::
+
+    {"ok": true, "size": n, "errors": [...], "http_error_code": 0, "rss": bytes}
+
+followed by ``size`` bytes of PDF.
+"""
+import ctypes
+import json
+import os
+import sys
+
+ERROR_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_char_p)
+
+
+def load_library(path):
+    lib = ctypes.CDLL(path)
+    lib.wkhtmltopdf_init.argtypes = [ctypes.c_int]
+    lib.wkhtmltopdf_create_global_settings.restype = ctypes.c_void_p
+    lib.wkhtmltopdf_set_global_setting.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+    lib.wkhtmltopdf_create_object_settings.restype = ctypes.c_void_p
+    lib.wkhtmltopdf_set_object_setting.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+    lib.wkhtmltopdf_create_converter.argtypes = [ctypes.c_void_p]
+    lib.wkhtmltopdf_create_converter.restype = ctypes.c_void_p
+    lib.wkhtmltopdf_set_error_callback.argtypes = [ctypes.c_void_p, ERROR_CALLBACK]
+    lib.wkhtmltopdf_set_warning_callback.argtypes = [ctypes.c_void_p, ERROR_CALLBACK]
+    lib.wkhtmltopdf_add_object.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p]
+    lib.wkhtmltopdf_convert.argtypes = [ctypes.c_void_p]
+    lib.wkhtmltopdf_http_error_code.argtypes = [ctypes.c_void_p]
+    lib.wkhtmltopdf_get_output.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte))]
+    lib.wkhtmltopdf_get_output.restype = ctypes.c_long
+    lib.wkhtmltopdf_destroy_converter.argtypes = [ctypes.c_void_p]
+    return lib
+
+
+def rss():
+    """Returns the resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return 0
+
+
+def convert(lib, request, html):
+    """Returns (pdf or None, error messages, http error code)."""
+    messages = []
+
+    def on_message(converter, message):
+        messages.append(message.decode('utf-8', 'replace'))
+    callback = ERROR_CALLBACK(on_message)
+
+    global_settings = lib.wkhtmltopdf_create_global_settings()
+    for name, value in request['global'].items():
+        lib.wkhtmltopdf_set_global_setting(global_settings, name.encode('utf-8'), value.encode('utf-8'))
+    # The converter owns the settings from now on
+    converter = lib.wkhtmltopdf_create_converter(global_settings)
+    try:
+        lib.wkhtmltopdf_set_error_callback(converter, callback)
+        lib.wkhtmltopdf_set_warning_callback(converter, callback)
+        for page in request['pages']:
+            object_settings = lib.wkhtmltopdf_create_object_settings()
+            for name, value in request['object'].items():
+                lib.wkhtmltopdf_set_object_setting(object_settings, name.encode('utf-8'), value.encode('utf-8'))
+            if page == '-':
+                lib.wkhtmltopdf_add_object(converter, object_settings, html)
+            else:
+                lib.wkhtmltopdf_set_object_setting(object_settings, b'page', page.encode('utf-8'))
+                lib.wkhtmltopdf_add_object(converter, object_settings, None)
+
+        if not lib.wkhtmltopdf_convert(converter):
+            return None, messages, lib.wkhtmltopdf_http_error_code(converter)
+        data = ctypes.POINTER(ctypes.c_ubyte)()
+        size = lib.wkhtmltopdf_get_output(converter, ctypes.byref(data))
+        return ctypes.string_at(data, size), messages, 0
+    finally:
+        lib.wkhtmltopdf_destroy_converter(converter)
+
+
+def main():
+    lib = load_library(sys.argv[1])
+    lib.wkhtmltopdf_init(0)
+
+    requests = sys.stdin.buffer
+    # Keep stdout for the protocol, and send anything libwkhtmltox prints to stderr
+    replies = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    replies.write(json.dumps({'ready': True}).encode('utf-8') + b'\n')
+    replies.flush()
+
+    while True:
+        line = requests.readline()
+        if not line:
+            break
+        request = json.loads(line.decode('utf-8'))
+        html = requests.read(request['html_size']) if request.get('html_size') else None
+        try:
+            pdf, messages, http_error_code = convert(lib, request, html)
+        except Exception as ex:
+            pdf, messages, http_error_code = None, [repr(ex)], 0
+        reply = {
+            'ok': pdf is not None,
+            'size': len(pdf) if pdf is not None else 0,
+            'errors': messages,
+            'http_error_code': http_error_code,
+            'rss': rss(),
+        }
+        replies.write(json.dumps(reply).encode('utf-8') + b'\n')
+        if pdf is not None:
+            replies.write(pdf)
+        replies.flush()
+
+    lib.wkhtmltopdf_deinit()
+
+
+if __name__ == '__main__':
+    main()
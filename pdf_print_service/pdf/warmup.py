@@ -0,0 +1,189 @@
+"""Warm-up of the worker processes, and their readiness.
+
+The first conversions of a new process are slow: wkhtmltopdf builds the
+fontconfig cache, its binary and libraries are paged in, and templates get
+compiled. start_warmup() (called by wsgi.py and asgi.py when
+``PDF_WARMUP_ENABLED`` is set) does all this in a background thread:
+
+- imports: the URL configuration, hence the views, Jinja2 and the backends,
+  are imported, and a template compiled;
+- renderer: WKHTMLTOPDF_CMD runs and reports a version of at least
+  ``WKHTMLTOPDF_MIN_VERSION``;
+- workers: a render worker (WKHTMLTOPDF_WARM_WORKERS) starts, if they are
+  enabled; conversions would otherwise silently run the command;
+- render: a small document using the common font families is converted
+  with the default backend;
+- templates: the latest versions of the most recently updated registered
+  templates are compiled into the version cache.
+
+/health answers 503 until they are done, and if one of them failed, so that
+load balancers only send traffic to warm workers.
+"""
+import logging
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from importlib import import_module
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Max
+
+from pdf.backends import WkhtmltopdfBackend, get_backend
+from pdf.warm import get_warm_pool
+from pdf.wkhtmltopdf import renderer_command
+
+log = logging.getLogger('pdf.warmup')
+
+WARMUP_HTML = '''<html><body>
+<p style="font-family: serif">Warm-up</p>
+<p style="font-family: sans-serif"><b>Warm-up</b></p>
+<p style="font-family: monospace"><i>Warm-up</i></p>
+</body></html>'''
+
+
+def parse_version(text):
+    """Returns the version numbers (tuple of ints) found in ``text``, or None."""
+    match = re.search(r'(\d+(?:\.\d+)+)', text)
+    if match is None:
+        return None
+    return tuple(int(number) for number in match.group(1).split('.'))
+
+
+def import_modules():
+    """Imports what Django only imports on the first request."""
+    from pdf.jinja import get_template
+
+    import_module(settings.ROOT_URLCONF)
+    get_template('{{ warm }}').render(warm='up')
+    return {}
+
+
+def check_renderer():
+    """Runs the renderer with --version, raises RuntimeError if it is missing
+    or too old."""
+    if not isinstance(get_backend(), WkhtmltopdfBackend):
+        return {'backend': get_backend().name}
+    args = renderer_command() + ['--version']
+    try:
+        output = subprocess.check_output(args, stderr=subprocess.STDOUT, timeout=30)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as ex:
+        raise RuntimeError("Can't run %s: %s" % (args[0], ex))
+    output = output.decode('utf-8', 'replace').strip()
+    version = parse_version(output)
+    min_version = getattr(settings, 'WKHTMLTOPDF_MIN_VERSION', None)
+    if min_version:
+        if version is None:
+            raise RuntimeError("Unknown renderer version: %s" % output)
+        if version < parse_version(min_version):
+            raise RuntimeError("Renderer version %s is older than %s" % ('.'.join(map(str, version)), min_version))
+    return {'version': output}
+
+
+def start_workers():
+    """Starts a render worker, raises WarmUnsupported if it can't."""
+    pool = get_warm_pool()
+    if pool is None:
+        return {}
+    pool.start()
+    return {'workers': pool.size}
+
+
+def prime_renderer():
+    """Converts WARMUP_HTML with the default backend."""
+    backend = get_backend()
+    pdf_content = backend.render(['-'], input=[WARMUP_HTML.encode('utf-8')])
+    return {'backend': backend.name, 'bytes': len(pdf_content)}
+
+
+def preload_templates():
+    """Loads the latest versions of the most recently updated registered
+    templates into the version cache."""
+    from pdf.models import Template
+    from pdf.registry import get_registered_template
+
+    size = getattr(settings, 'PDF_TEMPLATES_CACHE_SIZE', 100)
+    templates = Template.objects.annotate(updated=Max('versions__created')) \
+        .filter(updated__isnull=False).order_by('-updated')[:size]
+    count = 0
+    for template in templates:
+        get_registered_template(template.owner, template.name)
+        count += 1
+    return {'count': count}
+
+
+CHECKS = OrderedDict([
+    ('imports', import_modules),
+    ('renderer', check_renderer),
+    ('workers', start_workers),
+    ('render', prime_renderer),
+    ('templates', preload_templates),
+])
+
+
+class WarmUp(object):
+    """Runs CHECKS once and keeps their outcome."""
+
+    def __init__(self):
+        self.status = 'starting'
+        self.checks = OrderedDict()
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def ready(self):
+        return self.status == 'ok'
+
+    def run(self):
+        for name, check in CHECKS.items():
+            start = time.time()
+            try:
+                result = OrderedDict([('ok', True)])
+                result.update(check())
+            except Exception as ex:
+                log.exception("Warm-up check %s failed", name)
+                result = OrderedDict([('ok', False), ('error', str(ex))])
+            result['seconds'] = round(time.time() - start, 3)
+            self.checks[name] = result
+        self.finished = time.time()
+        self.status = 'ok' if all(result['ok'] for result in self.checks.values()) else 'failed'
+        log.info("Warm-up %s in %.3fs", self.status, self.finished - self.started)
+
+    def describe(self):
+        """Returns the JSON-serializable state of the warm-up."""
+        return OrderedDict([
+            ('status', self.status),
+            ('seconds', round((self.finished or time.time()) - self.started, 3)),
+            ('checks', self.checks),
+        ])
+
+
+_warmup = None
+_warmup_lock = threading.Lock()
+
+
+def _run_in_thread(warmup):
+    try:
+        warmup.run()
+    finally:
+        close_old_connections()
+
+
+def start_warmup():
+    """Starts the warm-up of this process in a thread (once), unless
+    ``PDF_WARMUP_ENABLED`` is False. Returns the WarmUp, or None."""
+    global _warmup
+    if not getattr(settings, 'PDF_WARMUP_ENABLED', True):
+        return None
+    with _warmup_lock:
+        if _warmup is None:
+            _warmup = WarmUp()
+            threading.Thread(target=_run_in_thread, args=(_warmup,), name='pdf-warmup', daemon=True).start()
+    return _warmup
+
+
+def get_warmup():
+    """Returns the WarmUp of this process, None if it wasn't started."""
+    return _warmup
@@ -1,11 +1,20 @@
 from __future__ import absolute_import
 
+from collections import deque
 from copy import copy
 from itertools import chain
 import os
 import re
+import signal
 import sys
 import shlex
+import tempfile
+import threading
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 try:
     from urllib.request import pathname2url
@@ -16,9 +25,11 @@ except ImportError:  # Python2
     from urlparse import urljoin
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.utils import six
 
+from .timing import stage
+
 import logging
 import subprocess
 
@@ -47,12 +58,65 @@ def _options_to_args(**options):
     return flags
 
 
-def wkhtmltopdf(pages, output=None, **kwargs):
+def effective_options(**kwargs):
+    """Returns the options wkhtmltopdf() actually runs with for ``kwargs``:
+    WKHTMLTOPDF_CMD_OPTIONS defaults overridden by ``kwargs``."""
+    # Default options:
+    options = getattr(settings, 'WKHTMLTOPDF_CMD_OPTIONS', None)
+    if options is None:
+        options = {'quiet': True}
+    else:
+        options = copy(options)
+    options.update(kwargs)
+
+    # Force --encoding utf8 unless the user has explicitly overridden this.
+    options.setdefault('encoding', 'utf8')
+    return options
+
+
+def renderer_command():
+    """Returns the command line of the renderer (WKHTMLTOPDF_CMD)."""
+    cmd = 'WKHTMLTOPDF_CMD'
+    cmd = getattr(settings, cmd, os.environ.get(cmd, 'wkhtmltopdf'))
+    return shlex.split(cmd)
+
+
+def _command(pages, output=None, **kwargs):
+    """Returns the command-line and the environment of a wkhtmltopdf run."""
+    if isinstance(pages, six.string_types):
+        # Support a single page.
+        pages = [pages]
+
+    if output is None:
+        # Standard output.
+        output = '-'
+
+    options = effective_options(**kwargs)
+
+    env = getattr(settings, 'WKHTMLTOPDF_ENV', None)
+    if env is not None:
+        env = dict(os.environ, **env)
+
+    args = list(chain(renderer_command(),
+                      _options_to_args(**options),
+                      list(pages),
+                      [output]))
+    return args, env
+
+
+def wkhtmltopdf(pages, output=None, input=None, timeout=None, max_output_size=None, **kwargs):
     """
     Converts html to PDF using http://wkhtmltopdf.org/.
 
     pages: List of file paths or URLs of the html to be converted.
     output: Optional output file path. If None, the output is returned.
+    input: Optional iterable of bytes written to wkhtmltopdf's standard
+           input, for pages given as '-'.
+    timeout: Seconds after which wkhtmltopdf is killed and TimeoutExpired
+             raised (default: WKHTMLTOPDF_TIMEOUT).
+    max_output_size: Number of bytes of output after which wkhtmltopdf is
+                     killed and OutputTooLarge raised (default:
+                     WKHTMLTOPDF_MAX_OUTPUT_SIZE).
     **kwargs: Passed to wkhtmltopdf via _extra_args() (See
               https://github.com/antialize/wkhtmltopdf/blob/master/README_WKHTMLTOPDF
               for acceptable args.)
@@ -77,61 +141,266 @@ def wkhtmltopdf(pages, output=None, **kwargs):
                     orientation='Landscape',
                     disable_javascript=True)
     """
-    if isinstance(pages, six.string_types):
-        # Support a single page.
-        pages = [pages]
+    stream = wkhtmltopdf_stream(pages, output=output, input=input, timeout=timeout,
+                                max_output_size=max_output_size, **kwargs)
+    try:
+        with stage('convert'):
+            return b''.join(stream)
+    finally:
+        stream.close()
 
-    if output is None:
-        # Standard output.
-        output = '-'
 
-    # Default options:
-    options = getattr(settings, 'WKHTMLTOPDF_CMD_OPTIONS', None)
-    if options is None:
-        options = {'quiet': True}
-    else:
-        options = copy(options)
-    options.update(kwargs)
+class OutputTooLarge(Exception):
+    """Raised when wkhtmltopdf produces more than the allowed output size."""
 
-    # Force --encoding utf8 unless the user has explicitly overridden this.
-    options.setdefault('encoding', 'utf8')
+    def __init__(self, cmd, max_size):
+        super(OutputTooLarge, self).__init__(cmd, max_size)
+        self.cmd = cmd
+        self.max_size = max_size
 
-    env = getattr(settings, 'WKHTMLTOPDF_ENV', None)
-    if env is not None:
-        env = dict(os.environ, **env)
+    def __str__(self):
+        return "Command '%s' produced more than %d bytes" % (self.cmd, self.max_size)
 
-    cmd = 'WKHTMLTOPDF_CMD'
-    cmd = getattr(settings, cmd, os.environ.get(cmd, 'wkhtmltopdf'))
 
-    ck_args = list(chain(shlex.split(cmd),
-                         _options_to_args(**options),
-                         list(pages),
-                         [output]))
-    ck_kwargs = {
-        'env': env,
-    }
-    ck_kwargs['stdout'] = subprocess.PIPE
-    ck_kwargs['stderr'] = subprocess.PIPE
-
-    logging.debug("CMDLINE: %s %s", str(ck_args), ck_kwargs)
-    timeout = None
-    with subprocess.Popen(ck_args, **ck_kwargs) as process:
+def _resource_limiter(output_to_file=False, max_output_size=None, limit_cpu=True):
+    """Returns a function applying WKHTMLTOPDF_MEMORY_LIMIT (bytes of address
+    space) and, unless ``limit_cpu`` is False, WKHTMLTOPDF_CPU_LIMIT (seconds)
+    to the process of a given pid, or None if there is nothing to limit.
+
+    When wkhtmltopdf writes to a file, the file size is limited too.
+
+    The limits are applied with prlimit() right after the process is spawned
+    rather than by a preexec_fn: the service runs threads (uwsgi threads,
+    input feeders...), and code run between fork() and exec() in a threaded
+    process may deadlock. Without prlimit() (Linux only), nothing is limited.
+    """
+    if resource is None or not hasattr(resource, 'prlimit'):
+        return None
+    limits = []
+    memory_limit = getattr(settings, 'WKHTMLTOPDF_MEMORY_LIMIT', None)
+    if memory_limit:
+        limits.append((resource.RLIMIT_AS, memory_limit))
+    cpu_limit = getattr(settings, 'WKHTMLTOPDF_CPU_LIMIT', None)
+    if limit_cpu and cpu_limit:
+        limits.append((resource.RLIMIT_CPU, cpu_limit))
+    if output_to_file and max_output_size:
+        limits.append((resource.RLIMIT_FSIZE, max_output_size))
+    if not limits:
+        return None
+
+    def limit_resources(pid):
         try:
-            stdout, stderr = process.communicate(None, timeout=timeout)
-        except subprocess.TimeoutExpired:
-            process.kill()
-            stdout, stderr = process.communicate()
-            raise subprocess.TimeoutExpired(process.args, timeout, output=stdout,
-                                 stderr=stderr)
-        except:
-            process.kill()
-            process.wait()
-            raise
-        retcode = process.poll()
+            for limit, value in limits:
+                resource.prlimit(pid, limit, (value, value))
+        except ProcessLookupError:
+            # Already exited
+            pass
+    return limit_resources
+
+
+def _spawn(args, limiter=None, **kwargs):
+    """Starts ``args`` in a new session with the limits of ``limiter`` (see
+    _resource_limiter())."""
+    process = subprocess.Popen(args, start_new_session=True, **kwargs)
+    if limiter is not None:
+        limiter(process.pid)
+    return process
+
+
+class _InputFeeder(threading.Thread):
+    """Thread writing chunks of bytes to the standard input of a process.
+
+    An exception raised while producing the chunks is kept in ``error``.
+    """
+
+    def __init__(self, stdin, chunks):
+        super(_InputFeeder, self).__init__(name='wkhtmltopdf-input')
+        self.daemon = True
+        self.stdin = stdin
+        self.chunks = chunks
+        self.error = None
+
+    def run(self):
+        try:
+            for chunk in self.chunks:
+                self.stdin.write(chunk)
+        except BrokenPipeError:
+            # wkhtmltopdf stopped reading, its exit status will tell why
+            pass
+        except Exception as ex:
+            self.error = ex
+        finally:
+            try:
+                self.stdin.close()
+            except OSError:
+                pass
+
+
+class PDFStream(six.Iterator):
+    """Iterator over the standard output of a running wkhtmltopdf process.
+
+    Raises CalledProcessError at the end of the output if wkhtmltopdf
+    failed, TimeoutExpired if it was killed at its deadline and
+    OutputTooLarge as soon as it writes more than ``max_output_size``.
+    close() kills the process if it is still running and calls the callbacks
+    registered with add_close_callback().
+    """
+
+    def __init__(self, process, stderr, chunk_size, feeder=None,
+                 timeout=None, max_output_size=None):
+        self.process = process
+        self.stderr = stderr
+        self.feeder = feeder
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.max_output_size = max_output_size
+        self.size = 0
+        self.timed_out = False
+        self._chunks = deque()
+        self._close_callbacks = []
+        self._closed = False
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def add_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def _expire(self):
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        """Kills wkhtmltopdf and everything it started."""
+        if self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _read(self):
+        chunk = self.process.stdout.read1(self.chunk_size)
+        self.size += len(chunk)
+        if self.max_output_size is not None and self.size > self.max_output_size:
+            self.kill()
+            raise OutputTooLarge(self.process.args, self.max_output_size)
+        return chunk
+
+    def prefetch(self, size):
+        """Reads up to ``size`` bytes ahead. If the output ends within them,
+        the exit status is checked (see check_returncode())."""
+        buffered = 0
+        while buffered < size:
+            chunk = self._read()
+            if not chunk:
+                self.check_returncode()
+                break
+            self._chunks.append(chunk)
+            buffered += len(chunk)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._chunks:
+            return self._chunks.popleft()
+        chunk = self._read()
+        if chunk:
+            return chunk
+        self.check_returncode()
+        raise StopIteration
+
+    def _read_stderr(self):
+        self.stderr.seek(0)
+        return self.stderr.read()
+
+    def check_returncode(self):
+        """Waits for the end of the process, raises CalledProcessError on failure.
+
+        If producing the standard input failed, that error is raised instead.
+        """
+        retcode = self.process.wait()
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.timed_out:
+            raise subprocess.TimeoutExpired(self.process.args, self.timeout,
+                                            output=b'', stderr=self._read_stderr())
+        if self.feeder is not None:
+            self.feeder.join()
+            if self.feeder.error is not None:
+                raise self.feeder.error
+        if retcode == -signal.SIGXFSZ:
+            raise OutputTooLarge(self.process.args, self.max_output_size)
         if retcode:
-            raise subprocess.CalledProcessError(retcode, process.args,
-                                     output=stdout, stderr=stderr)
-    return stdout
+            raise subprocess.CalledProcessError(retcode, self.process.args,
+                                                output=b'', stderr=self._read_stderr())
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._timer is not None:
+                self._timer.cancel()
+            if self.process.poll() is None:
+                self.kill()
+                self.process.wait()
+            self.process.stdout.close()
+            self.stderr.close()
+        finally:
+            for callback in self._close_callbacks:
+                callback()
+
+
+def wkhtmltopdf_stream(pages, output=None, input=None, timeout=None, max_output_size=None,
+                       buffer_size=1024 * 1024, chunk_size=64 * 1024, **kwargs):
+    """
+    Same as wkhtmltopdf() but returns a PDFStream yielding the document in
+    chunks of at most ``chunk_size`` bytes as wkhtmltopdf writes it.
+
+    Up to ``buffer_size`` bytes are read before returning: when the whole
+    document fits in it, a failing conversion raises CalledProcessError
+    right away, before anything was sent to the client. Bigger documents can
+    only fail while streaming.
+
+    The returned stream must be closed.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'WKHTMLTOPDF_TIMEOUT', None)
+    if max_output_size is None:
+        max_output_size = getattr(settings, 'WKHTMLTOPDF_MAX_OUTPUT_SIZE', None)
+
+    args, env = _command(pages, output, **kwargs)
+    # Errors go to a file so that a chatty wkhtmltopdf can't block on a full pipe
+    stderr = tempfile.TemporaryFile()
+    logging.debug("CMDLINE: %s", str(args))
+    try:
+        # A new session makes wkhtmltopdf the leader of a process group that
+        # can be killed as a whole.
+        with stage('spawn'):
+            process = _spawn(args, _resource_limiter(output not in (None, '-'), max_output_size),
+                             env=env, stdout=subprocess.PIPE, stderr=stderr,
+                             stdin=subprocess.PIPE if input is not None else None)
+    except:
+        stderr.close()
+        raise
+
+    feeder = None
+    if input is not None:
+        feeder = _InputFeeder(process.stdin, input)
+        feeder.start()
+
+    stream = PDFStream(process, stderr, chunk_size, feeder=feeder,
+                       timeout=timeout, max_output_size=max_output_size)
+    try:
+        with stage('convert'):
+            stream.prefetch(buffer_size)
+    except:
+        stream.close()
+        raise
+    return stream
 
 
 def content_disposition_filename(filename):
@@ -194,30 +463,51 @@ def make_absolute_paths(content):
         if not x['root'].endswith('/'):
             x['root'] += '/'
 
-        occur_pattern = '''["|']({0}.*?)["|']'''
-        occurences = re.findall(occur_pattern.format(x['url']), content)
-        occurences = list(set(occurences))  # Remove dups
-        for occur in occurences:
-            content = content.replace(occur,
-                                      pathname2fileurl(x['root']) +
-                                      occur[len(x['url']):])
+        # Single pass, so that a URL prefix of another one (/static/a and
+        # /static/ab) can't rewrite it twice.
+        occur_pattern = '''(["|']){0}(.*?["|'])'''
+        file_url = pathname2fileurl(x['root'])
+        content = re.sub(occur_pattern.format(re.escape(x['url'])),
+                         lambda m: m.group(1) + file_url + m.group(2),
+                         content)
 
     return content
 
 
-class PDFResponse(HttpResponse):
-    """HttpResponse that sets the headers for PDF output."""
+def iter_absolute_paths(chunks, buffer_size=64 * 1024):
+    """Same as make_absolute_paths() for content given as an iterable of
+    strings, yielding the rewritten content in chunks.
 
-    def __init__(self, content, status=200, content_type=None,
-            filename=None, show_content_in_browser=None, *args, **kwargs):
+    URLs never span lines, so chunks are gathered until they hold at least
+    ``buffer_size`` characters and rewritten up to their last line break;
+    the rest is held back until the next chunks.
+    """
+    pending = []
+    size = 0
+    threshold = buffer_size
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size < threshold:
+            continue
+        content = ''.join(pending)
+        end = content.rfind('\n') + 1
+        if not end:
+            # No line break yet: wait for another buffer_size characters
+            pending = [content]
+            threshold = size + buffer_size
+            continue
+        yield make_absolute_paths(content[:end])
+        pending = [content[end:]]
+        size = len(pending[0])
+        threshold = buffer_size
+    content = ''.join(pending)
+    if content:
+        yield make_absolute_paths(content)
 
-        if content_type is None:
-            content_type = 'application/pdf'
 
-        super(PDFResponse, self).__init__(content=content,
-                                          status=status,
-                                          content_type=content_type)
-        self.set_filename(filename, show_content_in_browser)
+class PDFResponseMixin(object):
+    """Sets the Content-Disposition header of PDF responses."""
 
     def set_filename(self, filename, show_content_in_browser):
         self.filename = filename
@@ -232,3 +522,47 @@ class PDFResponse(HttpResponse):
         else:
             del self['Content-Disposition']
 
+
+class PDFResponse(PDFResponseMixin, HttpResponse):
+    """HttpResponse that sets the headers for PDF output."""
+
+    def __init__(self, content, status=200, content_type=None,
+            filename=None, show_content_in_browser=None, *args, **kwargs):
+
+        if content_type is None:
+            content_type = 'application/pdf'
+
+        super(PDFResponse, self).__init__(content=content,
+                                          status=status,
+                                          content_type=content_type)
+        self.set_filename(filename, show_content_in_browser)
+
+
+class StreamingPDFResponse(PDFResponseMixin, StreamingHttpResponse):
+    """StreamingHttpResponse that sets the headers for PDF output."""
+
+    def __init__(self, streaming_content, status=200, content_type=None,
+                 filename=None, show_content_in_browser=None, *args, **kwargs):
+
+        if content_type is None:
+            content_type = 'application/pdf'
+
+        super(StreamingPDFResponse, self).__init__(streaming_content=streaming_content,
+                                                   status=status,
+                                                   content_type=content_type)
+        self.set_filename(filename, show_content_in_browser)
+
+
+class FilePDFResponse(PDFResponseMixin, FileResponse):
+    """FileResponse that sets the headers for PDF output."""
+
+    def __init__(self, file, status=200, content_type=None,
+                 filename=None, show_content_in_browser=None, *args, **kwargs):
+
+        if content_type is None:
+            content_type = 'application/pdf'
+
+        super(FilePDFResponse, self).__init__(file,
+                                              status=status,
+                                              content_type=content_type)
+        self.set_filename(filename, show_content_in_browser)
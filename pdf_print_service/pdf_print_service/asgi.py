@@ -0,0 +1,26 @@
+"""
+ASGI config for pdf_print_service project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+to be served by an ASGI server, e.g.:
+
+    uvicorn pdf_print_service.asgi:application
+
+Conversions posted to /pdf run in the event loop (see pdf.asgi), everything
+else goes through the WSGI application.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pdf_print_service.settings")
+
+wsgi_application = get_wsgi_application()
+
+# Needs the applications loaded by get_wsgi_application()
+from pdf.asgi import ASGIApplication  # noqa: E402
+from pdf.warmup import start_warmup  # noqa: E402
+
+application = ASGIApplication(wsgi_application)
+start_warmup()
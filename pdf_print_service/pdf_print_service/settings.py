@@ -11,13 +11,25 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 """
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
+import atexit
 import os
+import shutil
 import sys
+import tempfile
 
 # Base dir is parent folder of project
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 BASE_DIR = os.path.dirname(PROJECT_DIR)
-LOG_DIR = os.path.join(BASE_DIR, 'log')
+
+# Files written by the service (logs, caches, jobs...) go to VAR_DIR; test
+# runs use a temporary directory instead of the checkout
+if sys.argv[1:2] == ['test']:
+    VAR_DIR = tempfile.mkdtemp(prefix='pdf-print-service-test-')
+    atexit.register(shutil.rmtree, VAR_DIR, ignore_errors=True)
+else:
+    VAR_DIR = BASE_DIR
+LOG_DIR = os.path.join(VAR_DIR, 'log')
+CACHE_DIR = os.path.join(VAR_DIR, 'cache')
 
 os.makedirs(LOG_DIR, exist_ok=True)
 
@@ -47,6 +59,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'pdf.timing.ServerTimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -121,6 +134,9 @@ LOGGING = {
         'simple': {
             'format': '%(levelname)s %(message)s'
         },
+        'json': {
+            '()': 'pdf.logs.JSONFormatter',
+        },
     },
     'handlers': {
         'console': {
@@ -137,10 +153,31 @@ LOGGING = {
             'maxBytes': 10 * 1024 * 1024,
             'backupCount': 10,
         },
+        # Writes to the handlers above from a thread, so that requests never wait for the disk
+        'background': {
+            'level': 'NOTSET',
+            'class': 'pdf.logs.BackgroundHandler',
+            'handlers': ['console', 'file'],
+            'queue_size': 10000,
+        },
+        'slow_file': {
+            'level': 'NOTSET',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'formatter': 'verbose',
+            'filename': os.path.join(LOG_DIR, 'slow-requests.log'),
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+        },
+        'slow_background': {
+            'level': 'NOTSET',
+            'class': 'pdf.logs.BackgroundHandler',
+            'handlers': ['slow_file'],
+            'queue_size': 1000,
+        },
     },
     'root': {
-        'handlers': ['console', 'file'],
-        'level': 'DEBUG',
+        'handlers': ['background'],
+        'level': 'DEBUG' if DEBUG else 'INFO',
     },
     'loggers': {
         'django': {
@@ -156,6 +193,12 @@ LOGGING = {
         'LeaveController': {
             'level': 'INFO',
         },
+        # Requests slower than PDF_SLOW_REQUEST_THRESHOLD, with their time per stage
+        'pdf.slow': {
+            'handlers': ['slow_background'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     },
     # 'loggers': {
     #     'django.request': {
@@ -171,6 +214,223 @@ WKHTMLTOPDF_CMD_OPTIONS = {
     'quiet': None,
 }
 
+# Render profiles requests choose with the 'profile' parameter (see
+# pdf/profiles.py): wkhtmltopdf options applied on top of
+# WKHTMLTOPDF_CMD_OPTIONS. 'draft' is the fastest and smallest, 'print' the
+# most faithful. Compare them with ./manage.py pdf_profile_benchmark.
+WKHTMLTOPDF_PROFILES = {
+    'draft': {
+        'lowquality': True,
+        'image-dpi': 96,
+        'image-quality': 50,
+        'disable-javascript': True,
+        'load-error-handling': 'ignore',
+        'load-media-error-handling': 'ignore',
+    },
+    'standard': {},
+    'print': {
+        'image-dpi': 600,
+        'image-quality': 100,
+        'javascript-delay': 1000,
+        'print-media-type': True,
+    },
+}
+WKHTMLTOPDF_DEFAULT_PROFILE = 'standard'
+
+# Limits of each wkhtmltopdf run: it is killed (with all its children) after
+# WKHTMLTOPDF_TIMEOUT seconds, or as soon as it writes more than
+# WKHTMLTOPDF_MAX_OUTPUT_SIZE bytes. Requests can ask for a 'timeout' up to
+# WKHTMLTOPDF_MAX_TIMEOUT. Memory (address space, bytes) and CPU time (seconds)
+# are capped with rlimits, set with prlimit() once wkhtmltopdf is started (a
+# preexec_fn isn't safe with uwsgi threads).
+WKHTMLTOPDF_TIMEOUT = 60
+WKHTMLTOPDF_MAX_TIMEOUT = 300
+WKHTMLTOPDF_MAX_OUTPUT_SIZE = 200 * 1024 * 1024
+WKHTMLTOPDF_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+WKHTMLTOPDF_CPU_LIMIT = 120
+
+# Warm-up of each process (see pdf/warmup.py): checks that WKHTMLTOPDF_CMD is
+# at least WKHTMLTOPDF_MIN_VERSION, converts a small document and preloads the
+# registered templates. /health answers 503 until it is done.
+PDF_WARMUP_ENABLED = True
+WKHTMLTOPDF_MIN_VERSION = '0.12'
+
+# Metrics (/metrics): each process writes its values to PDF_METRICS_DIR every
+# PDF_METRICS_FLUSH_INTERVAL seconds so that they are added up across uwsgi
+# workers. Empty the directory when the service starts.
+PDF_METRICS_DIR = os.path.join(CACHE_DIR, 'metrics')
+PDF_METRICS_FLUSH_INTERVAL = 1
+
+# Requests lasting more than PDF_SLOW_REQUEST_THRESHOLD seconds are logged to
+# log/slow-requests.log with their time per stage (None to disable).
+PDF_SLOW_REQUEST_THRESHOLD = 10
+
+# Request logs summarize bodies by their size, hash and first
+# PDF_LOG_PAYLOAD_MAX_CHARS characters; a fraction PDF_LOG_PAYLOAD_SAMPLE_RATE
+# (0 to 1) of the requests are logged in full.
+PDF_LOG_PAYLOAD_MAX_CHARS = 200
+PDF_LOG_PAYLOAD_SAMPLE_RATE = 0
+
+# Verified credentials are remembered PDF_AUTH_CACHE_TTL seconds (0 to disable)
+# by each process, for at most PDF_AUTH_CACHE_SIZE clients. PDF_API_KEYS maps
+# user names to the SHA-256 hex digest of their key; these clients are
+# authenticated without the database (and take precedence over its users).
+PDF_AUTH_CACHE_TTL = 60
+PDF_AUTH_CACHE_SIZE = 1000
+PDF_API_KEYS = {}
+
+# Rendering backends, by name (see pdf.backends). PDF_BACKEND is the default
+# one; requests can pick another with the 'backend' parameter. The weasyprint
+# backend requires the WeasyPrint package.
+PDF_BACKEND = 'wkhtmltopdf'
+PDF_BACKENDS = {
+    'wkhtmltopdf': 'pdf.backends.WkhtmltopdfBackend',
+    'weasyprint': 'pdf.backends.WeasyPrintBackend',
+}
+
+# Asset cache: with PDF_ASSETS_ENABLED, images, stylesheets and fonts referenced
+# by templates are downloaded once into PDF_ASSETS_DIR and kept PDF_ASSETS_TTL
+# seconds, evicting the least recently used ones beyond PDF_ASSETS_MAX_BYTES.
+# Assets that failed are not tried again for PDF_ASSETS_FAILURE_TTL seconds, and
+# a document spends at most PDF_ASSETS_FETCH_BUDGET seconds downloading assets.
+# Remote pages (url) use wkhtmltopdf's own cache in WKHTMLTOPDF_CACHE_DIR.
+PDF_ASSETS_ENABLED = False
+PDF_ASSETS_DIR = os.path.join(CACHE_DIR, 'assets')
+PDF_ASSETS_TTL = 24 * 3600
+PDF_ASSETS_MAX_BYTES = 256 * 1024 * 1024
+PDF_ASSETS_MAX_SIZE = 10 * 1024 * 1024
+PDF_ASSETS_FETCH_TIMEOUT = 10
+PDF_ASSETS_FAILURE_TTL = 60
+PDF_ASSETS_FETCH_BUDGET = 30
+WKHTMLTOPDF_CACHE_DIR = None
+
+# Render workers: with WKHTMLTOPDF_WARM_WORKERS > 0, conversions run in that
+# many long-lived processes holding libwkhtmltox loaded, instead of starting
+# wkhtmltopdf each time. A worker is replaced after WKHTMLTOPDF_WARM_MAX_JOBS
+# conversions or once its resident memory exceeds WKHTMLTOPDF_WARM_MAX_RSS bytes.
+# Workers are run by the WKHTMLTOPDF_WARM_PYTHON interpreter; when they can't
+# start (e.g. missing library), conversions run wkhtmltopdf and the warm-up fails.
+WKHTMLTOPDF_WARM_WORKERS = 0
+WKHTMLTOPDF_WARM_LIBRARY = 'libwkhtmltox.so.0'
+WKHTMLTOPDF_WARM_PYTHON = sys.executable
+WKHTMLTOPDF_WARM_MAX_JOBS = 100
+WKHTMLTOPDF_WARM_MAX_RSS = 512 * 1024 * 1024
+
+# Conversion pool: at most PDF_POOL_MAX_CONCURRENT renderers run at once, up to
+# PDF_POOL_QUEUE_SIZE requests wait PDF_POOL_QUEUE_TIMEOUT seconds for a slot,
+# others get a 503 with a Retry-After of PDF_POOL_RETRY_AFTER seconds.
+PDF_POOL_MAX_CONCURRENT = 2
+PDF_POOL_QUEUE_SIZE = 10
+PDF_POOL_QUEUE_TIMEOUT = 30
+PDF_POOL_RETRY_AFTER = 5
+
+# Waiting conversions get the freed slots by priority class (highest first;
+# 'priority' in the request, /pdf defaulting to the first class, batches and
+# jobs to the last one), then fairly between users. Users of
+# PDF_POOL_USER_PRIORITIES get that class by default and can't ask for a
+# higher one.
+PDF_POOL_PRIORITIES = ('interactive', 'bulk')
+PDF_POOL_USER_PRIORITIES = {
+    # 'erp': 'bulk',
+}
+
+# Per-user rate limits of conversion requests, as (requests per second, burst)
+# by user name, '*' for the others (None: unlimited). Requests beyond them get
+# a 429 with a Retry-After header.
+PDF_RATE_LIMITS = {
+    # '*': (5, 20),
+}
+
+# ASGI entry point (pdf_print_service/asgi.py): at most PDF_ASYNC_MAX_CONCURRENT
+# conversions run in the event loop (with the queue settings above), the rest
+# of the work runs in PDF_ASGI_THREADS threads.
+PDF_ASYNC_MAX_CONCURRENT = 8
+PDF_ASGI_THREADS = 10
+
+# Result cache (opt-in): rendered documents are kept in memory, up to
+# PDF_CACHE_MEMORY_BYTES, and in PDF_CACHE_DIR (shared by all workers) when set,
+# up to PDF_CACHE_DISK_BYTES.
+PDF_CACHE_ENABLED = False
+PDF_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+PDF_CACHE_DIR = os.path.join(CACHE_DIR, 'pdf')
+PDF_CACHE_DISK_BYTES = 1024 * 1024 * 1024
+PDF_CACHE_TTL = 3600
+PDF_CACHE_MAX_TTL = 24 * 3600
+
+# Identical conversions requested at the same time run once and share their
+# result, within a process, and between the processes of the host through the
+# lock files of PDF_COALESCE_DIR (when set), deleted after
+# PDF_COALESCE_RESULT_TTL seconds.
+PDF_COALESCE_ENABLED = True
+PDF_COALESCE_DIR = os.path.join(CACHE_DIR, 'coalesce')
+PDF_COALESCE_RESULT_TTL = 60
+
+# Compiled Jinja2 templates kept in memory, and their bytecode on disk when
+# PDF_JINJA2_BYTECODE_CACHE_DIR is set (e.g. os.path.join(CACHE_DIR, 'jinja2')).
+# Nothing deletes its files, one per distinct template source: only enable it
+# when templates are registered (/pdf/templates) rather than sent with each
+# request.
+PDF_JINJA2_CACHE_SIZE = 100
+PDF_JINJA2_BYTECODE_CACHE_DIR = None
+
+# Registered templates (/pdf/templates): assets are stored in
+# PDF_TEMPLATES_DIR, each process keeps PDF_TEMPLATES_CACHE_SIZE versions in
+# memory.
+PDF_TEMPLATES_DIR = os.path.join(VAR_DIR, 'templates')
+PDF_TEMPLATES_CACHE_SIZE = 100
+
+# Headers and footers (header/footer, or header_name/footer_name) are rendered
+# once into PDF_FRAGMENTS_DIR, and deleted when unused for PDF_FRAGMENTS_TTL
+# seconds.
+PDF_FRAGMENTS_DIR = os.path.join(CACHE_DIR, 'fragments')
+PDF_FRAGMENTS_TTL = 24 * 3600
+
+# Background jobs (/pdf/jobs): PDF_JOBS_WORKERS threads of each web process run
+# them (0: leave them to the run_pdf_jobs command); results are kept
+# PDF_JOBS_RESULT_TTL seconds in PDF_JOBS_DIR.
+PDF_JOBS_WORKERS = 1
+PDF_JOBS_DIR = os.path.join(VAR_DIR, 'jobs')
+PDF_JOBS_RESULT_TTL = 3600
+# Jobs running for longer than this (seconds since their last conversion
+# attempt, which takes at most PDF_POOL_QUEUE_TIMEOUT + WKHTMLTOPDF_MAX_TIMEOUT)
+# were interrupted by their worker's death and are marked failed.
+PDF_JOBS_STALE_AFTER = 900
+
+# Streaming (PDF_STREAMING, or 'stream' in the request): wkhtmltopdf output is
+# forwarded in chunks of PDF_STREAM_CHUNK_SIZE bytes; only the first
+# PDF_STREAM_BUFFER_SIZE bytes are held before answering, so that short
+# conversions still report errors with a proper status.
+PDF_STREAMING = False
+PDF_STREAM_BUFFER_SIZE = 1024 * 1024
+PDF_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Spool (opt-in): wkhtmltopdf writes the documents of /pdf to PDF_SPOOL_DIR;
+# those of PDF_SPOOL_THRESHOLD bytes or more are sent from there without
+# entering the worker's memory, by nginx when PDF_SPOOL_ACCEL_REDIRECT is the
+# prefix of an internal location aliasing PDF_SPOOL_DIR (see
+# deployment/pdf-print-service.yml), by the WSGI server otherwise. Spooled
+# files are deleted after PDF_SPOOL_TTL seconds.
+PDF_SPOOL_ENABLED = False
+PDF_SPOOL_DIR = os.path.join(CACHE_DIR, 'spool')
+PDF_SPOOL_THRESHOLD = 10 * 1024 * 1024
+PDF_SPOOL_TTL = 600
+PDF_SPOOL_ACCEL_REDIRECT = None
+
+# Template output is fed to wkhtmltopdf's standard input while it is rendered,
+# instead of being written to a temporary file first (except in debug mode).
+PDF_PIPELINE = True
+
+# Request bodies may be compressed (Content-Encoding: gzip or deflate): they
+# are rejected with a 413 beyond PDF_MAX_BODY_SIZE bytes as sent, or
+# PDF_MAX_DATA_SIZE bytes decompressed. JSON is parsed by PDF_JSON_PARSER
+# ('orjson', 'ujson' or 'json'; None: the fastest one installed).
+PDF_MAX_BODY_SIZE = 20 * 1024 * 1024
+PDF_MAX_DATA_SIZE = 100 * 1024 * 1024
+PDF_JSON_PARSER = None
+
+# Maximum number of records of a /pdf/batch request
+PDF_BATCH_MAX_RECORDS = 1000
+
 CORS_ORIGIN_ALLOW_ALL = True
 CORS_ORIGIN_WHITELIST = (
     '127.0.0.1',
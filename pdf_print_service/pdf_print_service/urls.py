@@ -15,9 +15,24 @@ Including another URLconf
 """
 from django.conf.urls import include, url
 from django.contrib import admin
-from pdf.views import MakePDFViewFromHtml
+from pdf.registry import NAME_PATTERN
+from pdf.views import HealthView, MakePDFViewFromHtml, MakePDFBatchView, MetricsView, PDFJobListView, PDFJobView, \
+    PDFJobResultView, PDFTemplateListView, PDFTemplateView, PDFTemplateVersionView
+
+UUID_PATTERN = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^pdf/?$', MakePDFViewFromHtml.as_view(), name='pdf'),
+    url(r'^pdf/batch/?$', MakePDFBatchView.as_view(), name='pdf-batch'),
+    url(r'^pdf/jobs/?$', PDFJobListView.as_view(), name='pdf-jobs'),
+    url(r'^pdf/jobs/(?P<job_id>%s)/?$' % UUID_PATTERN, PDFJobView.as_view(), name='pdf-job'),
+    url(r'^pdf/jobs/(?P<job_id>%s)/result/?$' % UUID_PATTERN, PDFJobResultView.as_view(),
+        name='pdf-job-result'),
+    url(r'^pdf/templates/?$', PDFTemplateListView.as_view(), name='pdf-templates'),
+    url(r'^pdf/templates/(?P<name>%s)/?$' % NAME_PATTERN, PDFTemplateView.as_view(), name='pdf-template'),
+    url(r'^pdf/templates/(?P<name>%s)/(?P<version>[0-9]+)/?$' % NAME_PATTERN, PDFTemplateVersionView.as_view(),
+        name='pdf-template-version'),
+    url(r'^metrics/?$', MetricsView.as_view(), name='metrics'),
+    url(r'^health/?$', HealthView.as_view(), name='health'),
 ]
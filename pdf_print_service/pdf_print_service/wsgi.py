@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pdf_print_service.settings")
 
 application = get_wsgi_application()
+
+# Needs the applications loaded by get_wsgi_application()
+from pdf.warmup import start_warmup  # noqa: E402
+
+start_warmup()